@@ -1,137 +1,96 @@
 #!/usr/bin/env python
 
+# Backs up the sources of a profile. "plan" only scans and prints how long a
+# backup would take judging by the previous runs.
+#
+# Usage: backup.py [<profile> [run|plan]]
+
 import logging
-from os.path import join
-from time import time
-import gzip
+from datetime import datetime
 import sys
-from gi.repository import Gio
 
 from lib.config import get_config
-from lib.dtree import scan
-from lib.index import Index
-from lib.backup import Backup
+from lib.jobs import BackupJob, COMMANDS, COMMAND_RUN, COMMAND_PLAN, STATE_DONE
 from lib.human_size import human_size
-from lib.util import expandvars
-from lib import volume
+from lib.runstats import format_dev, format_rate
+
+
+def _format_secs(secs):
+    return '?' if secs is None else '%.2f secs' % secs
+
+
+def print_plan(plan):
+    '''Prints what a backup to a destination would copy and how long it
+    would take judging by the previous runs (see BackupJob.get_plans).'''
+    prediction = plan['prediction']
+    changed = plan['changed']
+    scan_secs = plan['scan_secs']
+    print('Destination %s: %s' % (plan['name'], plan['path']))
+    print('    Found %d dirs and %d files in %.2f secs.' %
+          (plan['dirs'], plan['files'], scan_secs))
+    print('    %d files to copy (%s).' % (
+          sum(row[1] for row in changed),
+          human_size(sum(row[2] for row in changed))))
+    if plan['pending_files']:
+        print('    %d of them (%s) left pending by the last run.' % (
+              plan['pending_files'], human_size(plan['pending_bytes'])))
+    for dev, files, bytes_ in changed:
+        print('    Device %s: %d files (%s) in %s.' % (
+              format_dev(dev), files, human_size(bytes_),
+              _format_secs(prediction['devices'][dev])))
+    print('    Copying: %s, finishing: %s.' % (_format_secs(prediction['copy']),
+                                             _format_secs(prediction['finish'])))
+    if prediction['copy'] is None or prediction['finish'] is None:
+        print('    Not enough previous runs to estimate the duration.')
+    else:
+        print('    Estimated duration: %.2f secs.' % (
+              scan_secs + prediction['copy'] + prediction['finish']))
+    if plan['runs']:
+        print('    Previous runs:')
+    for (generation, started, dirs, files, changed_files, changed_bytes,
+            scan_secs_, copy_secs, finish_secs, total_secs) in plan['runs']:
+        date = datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S')
+        print('        %s  %d files  %d copied (%s)  scan %s  copy %s  '
+              'finish %s  total %s  %s' % (
+                  date, files, changed_files, human_size(changed_bytes),
+                  _format_secs(scan_secs_), _format_secs(copy_secs),
+                  _format_secs(finish_secs), _format_secs(total_secs),
+                  format_rate(changed_files, changed_bytes, copy_secs)))
 
 
 def main():
-    start = time()
-
-    # Determine profile to use.
+    # Determine profile to use. The plan command only scans and predicts
+    # how long a backup would take.
     try:
         profile = sys.argv[1]
     except IndexError:
         profile = 'default'
+    command = sys.argv[2] if len(sys.argv) > 2 else COMMAND_RUN
+    if command not in COMMANDS:
+        print('Usage: %s [<profile> [%s]]' % (sys.argv[0], '|'.join(COMMANDS)))
+        sys.exit(1)
 
     # Load and extract our config.
     config = get_config('%s.ini' % profile)
-    SOURCE_PATHS = config.getlist('source', 'paths')
-    SOURCE_EXCLUDES = config.getlist('source', 'excludes')
-    BACKUP_PATH = config.get('destination', 'path')
     LOG_LEVEL = config.get('logging', 'level')
     LOG_FORMAT = config.get('logging', 'format')
-    DISABLE_TIMEOUTS = config.get('power-management', 'disable_sleep_timeouts')
-
-    # Support ~, ~user and other constructions.
-    SOURCE_PATHS = map(expandvars, SOURCE_PATHS)
-    SOURCE_EXCLUDES = map(expandvars, SOURCE_EXCLUDES)
-    BACKUP_PATH = expandvars(BACKUP_PATH)
 
     logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 
     logger = logging.getLogger('process')
 
-    BACKUP_PATH_REAL = BACKUP_PATH
-    mounted_volume = None
     try:
-        if BACKUP_PATH.startswith('volume://'):
-            mounted_volume, BACKUP_PATH_REAL = volume.mount(BACKUP_PATH)
-        backup = Backup(BACKUP_PATH_REAL)
+        job = BackupJob(profile, command)
     except Exception as reason:
         logger.error(reason)
-        # logger.error('Perhaps you forgot to mount your backup medium first?')
+        sys.exit(1)
+    job.run()
+    if job.get_state() != STATE_DONE:
         sys.exit(1)
 
-    logger.info('Preparing backup.')
-
-    # Backup and disable sleep timeout settings.
-    if DISABLE_TIMEOUTS:
-        logging.info('Disabling system sleep mode timeouts.')
-        power_settings = Gio.Settings('org.gnome.settings-daemon.plugins.power')
-        ac_timeout = power_settings.get_int('sleep-inactive-ac-timeout')
-        bat_timeout = power_settings.get_int('sleep-inactive-battery-timeout')
-        power_settings.set_int('sleep-inactive-ac-timeout', 0)
-        power_settings.set_int('sleep-inactive-battery-timeout', 0)
-
-    try:
-        db_path = join(BACKUP_PATH_REAL, 'index.sqlite3')
-        index = Index(db_path)
-        for path in SOURCE_PATHS:
-            logger.info('Scanning directory tree: %s' % path)
-            index.update(scan(path, excludes=SOURCE_EXCLUDES))
-
-        dirs_found, files_found = index.get_cur_stats()
-        logger.info('Found %d dirs and %d files.' % (dirs_found, files_found))
-
-        bytes = index.get_added_bytes() + index.get_modified_bytes()
-        logger.info('%s to copy.' % human_size(bytes))
-
-        # Only create new backup if files or dirs have changed or been added.
-        if index.get_num_added_or_modified_dirs_or_files():
-            backup.create(bytes)
-
-            logger.info('Backing up tree structure.')
-            # backup.create_tree(index.get_all_dirs())
-            backup.create_tree(index.get_added_or_modified_dirs())
-
-            # TODO Collect errors also in extra log file.
-            # TODO Try to add some nice sleeps not to hug the cpu and io too much.
-            # TODO Try to collect 1MB chunks even with small files etc.
-            logger.info('Backing up files.')
-            backup.copy_files(index.get_added_or_modified_files())
-
-            # logger.info('Linking unmodified files.')
-            # backup.link_old_files(index.get_unmodified_files())
-
-            missing_bytes = backup.get_sum_missing_bytes()
-            if missing_bytes:
-                logger.info('Backing up missing files.')
-                logger.info('%s to copy.' % human_size(missing_bytes))
-                backup.copy_missing_files()
-
-            logger.info('Backing up dir stats.')
-            backup.copy_dir_stats()
-
-            logger.info('Updating database.')
-            index.commit()
-
-            # Disconnect from index database.
-            del index
-
-            logger.info('Backing up database.')
-            db_backup_path = join(backup.get_path(), 'index.sqlite3.gz')
-            f_in = open(db_path, 'rb')
-            f_out = gzip.open(db_backup_path, 'wb')
-            f_out.writelines(f_in)
-            f_out.close()
-            f_in.close()
-
-            # Rename backup directory and finalize backup.
-            backup.commit()
-    finally:
-        # Restore sleep timeout settings.
-        if DISABLE_TIMEOUTS:
-            logger.info('Restoring system sleep mode timeouts.')
-            power_settings.set_int('sleep-inactive-ac-timeout', ac_timeout)
-            power_settings.set_int('sleep-inactive-battery-timeout', bat_timeout)
-
-        if mounted_volume:
-            volume.umount(mounted_volume)
-
-    secs = time() - start
-    logger.info('Backup finished after %.2f secs.' % secs)
+    if command == COMMAND_PLAN:
+        for plan in job.get_plans():
+            print_plan(plan)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# Small benchmarks for the tuning knobs in default.ini.
+#
+# Usage: benchmark.py seek <path>
+#        benchmark.py durability <path> [num_files] [file_size]
+#        benchmark.py startup [runs]
+
+from os import walk, lstat, dup, urandom, devnull
+from os.path import join, dirname, abspath
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+import subprocess
+import stat
+import sys
+
+from lib.fiemap import ExtentMap
+from lib.human_size import human_size
+from lib.durability import (Flusher, syncfs, fsync_dir, DURABILITY_MODES,
+                            DURABILITY_NONE, DURABILITY_BATCHED)
+
+
+# Run by backups and restores right after starting: the power backend always,
+# the volume backend for volume:// destinations.
+BACKEND_INIT = '''
+from lib import power, volume
+power.get_backend()
+try:
+    volume.get_backend()
+except Exception:
+    pass
+'''
+
+# Jumps below this distance are considered to be served by readahead.
+SEEK_THRESHOLD = 1024 * 1024  # Bytes
+
+
+def _collect_files(path):
+    files = []
+    for root, dirs, names in walk(path):
+        for name in names:
+            filepath = join(root, name)
+            try:
+                st = lstat(filepath)
+            except (IOError, OSError):
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size:
+                files.append((filepath, st.st_ino, st.st_size))
+    return files
+
+
+def _measure_seeks(files, extent_map):
+    distance, seeks, pos = 0, 0, None
+    for filepath, inode, size in files:
+        offset = extent_map.get_offset(filepath)
+        if offset is None:
+            continue
+        if pos is not None:
+            jump = abs(offset - pos)
+            distance += jump
+            if jump > SEEK_THRESHOLD:
+                seeks += 1
+        pos = offset + size
+    return distance, seeks
+
+
+def bench_seek(path):
+    start = time()
+    files = _collect_files(path)
+    print('Found %d files in %.2f secs.' % (len(files), time() - start))
+
+    extent_map = ExtentMap()
+    files.sort(key=lambda item: item[1])
+    start = time()
+    distance, seeks = _measure_seeks(files, extent_map)
+    print('FIEMAP queries took %.2f secs.' % (time() - start))
+    if not extent_map.is_supported():
+        print('FIEMAP is not supported on this filesystem.')
+        return
+    print('inode order:    %d seeks, %s head travel' % (seeks, human_size(distance)))
+
+    extent_map.sort(files, lambda item: (item[0], item[1]))
+    distance_phys, seeks_phys = _measure_seeks(files, extent_map)
+    print('physical order: %d seeks, %s head travel' % (seeks_phys, human_size(distance_phys)))
+    if seeks:
+        print('Seek reduction: %.1f%%' % (100.0 - 100.0 / seeks * seeks_phys))
+
+
+def _write_files(path, num_files, data, mode):
+    flusher = None
+    if mode == DURABILITY_BATCHED:
+        flusher = Flusher()
+        flusher.start()
+    for i in range(num_files):
+        with open(join(path, '%d' % i), 'wb') as handle:
+            handle.write(data)
+            if flusher:
+                flusher.add(dup(handle.fileno()))
+    if flusher:
+        flusher.stop()
+    if mode != DURABILITY_NONE:
+        syncfs(path)
+        fsync_dir(path)
+
+
+def bench_durability(path, num_files=1000, file_size=256 * 1024):
+    num_files, file_size = int(num_files), int(file_size)
+    data = urandom(file_size)
+    num_bytes = num_files * file_size
+    print('Writing %d files of %s per mode.' % (num_files, human_size(file_size)))
+    for mode in DURABILITY_MODES:
+        tmp_path = mkdtemp(prefix='benchmark-', dir=path)
+        try:
+            syncfs(path)  # Do not pay for the previous mode.
+            start = time()
+            _write_files(tmp_path, num_files, data, mode)
+            secs = time() - start
+            print('%-8s %.2f secs, %s/s' % (mode, secs,
+                                           human_size(num_bytes / secs)))
+        finally:
+            rmtree(tmp_path)
+    print('Note: "none" leaves the data in the page cache.')
+
+
+def _time_import(statement, runs):
+    # Every run gets a fresh interpreter, so nothing is cached in memory.
+    cwd = dirname(abspath(__file__))
+    best = None
+    with open(devnull, 'w') as null:
+        for i in range(runs):
+            start = time()
+            if subprocess.call([sys.executable, '-c', statement], cwd=cwd,
+                               stderr=null) != 0:
+                return None
+            secs = time() - start
+            best = secs if best is None else min(best, secs)
+    return best
+
+
+def bench_startup(runs=5):
+    '''Measures how long the scripts take to start up.'''
+    from lib.dtree import SCANDIR_BACKEND
+    runs = int(runs)
+    print('Best of %d runs, scandir backend: %s' % (runs, SCANDIR_BACKEND))
+    for name, statement in (('python', 'pass'),
+                            ('gi', 'from gi.repository import Gio'),
+                            ('backends', BACKEND_INIT),
+                            ('backup', 'import backup' + BACKEND_INIT),
+                            ('restore', 'import restore' + BACKEND_INIT),
+                            ('verify', 'import verify'),
+                            ('consolidate', 'import consolidate'),
+                            ('history', 'import history')):
+        secs = _time_import(statement, runs)
+        if secs is None:
+            print('%-12s not available' % name)
+        else:
+            print('%-12s %.3f secs' % (name, secs))
+
+
+def main():
+    try:
+        command, args = sys.argv[1], sys.argv[2:]
+    except IndexError:
+        print('Usage: %s seek <path>' % sys.argv[0])
+        print('       %s durability <path> [num_files] [file_size]' % sys.argv[0])
+        print('       %s startup [runs]' % sys.argv[0])
+        sys.exit(1)
+    if command == 'seek':
+        bench_seek(*args)
+    elif command == 'durability':
+        bench_durability(*args)
+    elif command == 'startup':
+        bench_startup(*args)
+    else:
+        print('Unknown benchmark: %s' % command)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Shows any generation of a backup as a complete tree without restoring it.
+#
+# Usage: browse.py <profile> generations
+#        browse.py <profile> ls <generation|latest> [<dir>]
+#        browse.py <profile> stat <generation|latest> <path>
+#        browse.py <profile> cat <generation|latest> <file>
+
+import logging
+from os.path import join
+from datetime import datetime
+import shutil
+import sys
+
+from lib.config import get_config
+from lib.index import Index, OPEN_READ_ONLY
+from lib.browse import Browser, KIND_DIR
+from lib.human_size import human_size
+from lib.util import expandvars
+from lib import volume
+
+
+def _format_date(timestamp):
+    if timestamp is None:
+        return '-'
+    return datetime.fromtimestamp(float(timestamp)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def generations(browser):
+    for generation in browser.get_generations():
+        print('%s  %s' % (generation, _format_date(generation)))
+
+
+def ls(browser, generation, path='/'):
+    for entry in browser.listdir(generation, path):
+        if entry['kind'] == KIND_DIR:
+            print('%-19s  %10s  %-18s  %s/' % ('-', '-', '', entry['name']))
+        else:
+            print('%-19s  %10s  %-18s  %s' % (
+                  _format_date(entry['mtime']),
+                  human_size(entry['size']) if entry['size'] is not None else '?',
+                  entry['generation'], entry['name']))
+
+
+def stat(browser, generation, path):
+    info = browser.stat(generation, path)
+    print('Path: %s' % info['path'])
+    print('Kind: %s' % info['kind'])
+    if info['kind'] == KIND_DIR:
+        return
+    if info['target'] is not None:
+        print('Target: %s' % info['target'])
+    print('Size: %s (%d bytes)' % (human_size(info['size']), info['size']))
+    print('Modified: %s' % _format_date(info['mtime']))
+    print('Mode: %04o  Uid: %d  Gid: %d' % (info['mode'], info['uid'], info['gid']))
+    print('Stored in: %s (%s)' % (info['generation'],
+                                  _format_date(info['generation'])))
+
+
+def cat(browser, generation, path):
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    with browser.open(generation, path) as handle:
+        shutil.copyfileobj(handle, output)
+    output.flush()
+
+
+COMMANDS = dict(generations=generations, ls=ls, stat=stat, cat=cat)
+
+
+def main():
+    try:
+        profile, command, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    except IndexError:
+        print('Usage: %s <profile> generations' % sys.argv[0])
+        print('       %s <profile> ls <generation|latest> [<dir>]' % sys.argv[0])
+        print('       %s <profile> stat <generation|latest> <path>' % sys.argv[0])
+        print('       %s <profile> cat <generation|latest> <file>' % sys.argv[0])
+        sys.exit(1)
+
+    # Load and extract our config.
+    config = get_config('%s.ini' % profile)
+    BACKUP_PATH = config.get('destination', 'path')
+    LOG_LEVEL = config.get('logging', 'level')
+    LOG_FORMAT = config.get('logging', 'format')
+
+    # Support ~, ~user and other constructions.
+    BACKUP_PATH = expandvars(BACKUP_PATH)
+
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    logger = logging.getLogger('process')
+
+    BACKUP_PATH_REAL = BACKUP_PATH
+    mounted_volume = None
+    try:
+        if BACKUP_PATH.startswith('volume://'):
+            mounted_volume, BACKUP_PATH_REAL = volume.mount(BACKUP_PATH)
+        db_path = join(BACKUP_PATH_REAL, 'index.sqlite3')
+        browser = Browser(BACKUP_PATH_REAL,
+                          Index(db_path, open_mode=OPEN_READ_ONLY))
+    except Exception as reason:
+        logger.error(reason)
+        sys.exit(1)
+
+    try:
+        if command not in COMMANDS:
+            raise Exception('Unknown command: %s' % command)
+        COMMANDS[command](browser, *args)
+    except Exception as reason:
+        logger.error(reason)
+        sys.exit(1)
+    finally:
+        if mounted_volume:
+            volume.umount(mounted_volume)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import logging
+from os.path import join
+from time import time
+import sys
+
+from lib.config import get_config
+from lib.index import Index, OPEN_SHARED
+from lib.consolidate import Consolidate
+from lib.util import expandvars
+from lib import volume
+
+
+def main():
+    start = time()
+
+    # Determine profile to use. Optionally a range of generations to merge
+    # into the newest one of the range instead of applying the retention.
+    try:
+        profile = sys.argv[1]
+    except IndexError:
+        profile = 'default'
+    merge_range = sys.argv[2:4]
+
+    # Load and extract our config.
+    config = get_config('%s.ini' % profile)
+    BACKUP_PATH = config.get('destination', 'path')
+    LOG_LEVEL = config.get('logging', 'level')
+    LOG_FORMAT = config.get('logging', 'format')
+    KEEP_HOURLY = int(config.get('retention', 'hourly'))
+    KEEP_DAILY = int(config.get('retention', 'daily'))
+    KEEP_WEEKLY = int(config.get('retention', 'weekly'))
+
+    # Support ~, ~user and other constructions.
+    BACKUP_PATH = expandvars(BACKUP_PATH)
+
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    logger = logging.getLogger('process')
+
+    BACKUP_PATH_REAL = BACKUP_PATH
+    mounted_volume = None
+    try:
+        if BACKUP_PATH.startswith('volume://'):
+            mounted_volume, BACKUP_PATH_REAL = volume.mount(BACKUP_PATH)
+        index = Index(join(BACKUP_PATH_REAL, 'index.sqlite3'),
+                      open_mode=OPEN_SHARED)
+        consolidate = Consolidate(BACKUP_PATH_REAL, index)
+    except Exception as reason:
+        logger.error(reason)
+        sys.exit(1)
+
+    try:
+        if merge_range:
+            first, last = float(merge_range[0]), float(merge_range[-1])
+            generations = [generation for generation
+                           in consolidate.get_generations()
+                           if first <= float(generation) <= last]
+            if len(generations) > 1:
+                logger.info('Merging %d generations into: %s' %
+                            (len(generations) - 1, generations[-1]))
+                consolidate.merge(generations[-1], generations[-2::-1])
+        else:
+            logger.info('Applying retention policy: %d hourly, %d daily, '
+                        '%d weekly.' % (KEEP_HOURLY, KEEP_DAILY, KEEP_WEEKLY))
+            num_merged = consolidate.run(KEEP_HOURLY, KEEP_DAILY, KEEP_WEEKLY)
+            logger.info('Merged %d generations.' % num_merged)
+    finally:
+        index.renew_id()  # Invalidates cached copies.
+        if mounted_volume:
+            volume.umount(mounted_volume)
+
+    secs = time() - start
+    logger.info('Consolidation finished after %.2f secs.' % secs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Lists the stored versions of files from the version catalog.
+#
+# Usage: history.py <profile> show <file>
+#        history.py <profile> find <pattern> [<path>]
+
+import logging
+from os.path import join, abspath, split
+from datetime import datetime
+import sys
+
+from lib.config import get_config
+from lib.index import Index, OPEN_READ_ONLY
+from lib.human_size import human_size
+from lib.util import expandvars
+from lib import volume
+
+
+def _format_version(generation, size, deleted):
+    date = datetime.fromtimestamp(float(generation)).strftime('%Y-%m-%d %H:%M:%S')
+    if deleted:
+        return '%s  %s  deleted' % (generation, date)
+    return '%s  %s  %s' % (generation, date,
+                           human_size(size) if size is not None else '?')
+
+
+def show(index, filepath):
+    path, name = split(abspath(expandvars(filepath)))
+    rows = index.get_history(path, name)
+    if not rows:
+        print('No versions found: %s' % join(path, name))
+        return
+    for generation, size, mtime, deleted in rows:
+        print(_format_version(generation, size, deleted))
+
+
+def find(index, pattern, path=None):
+    if path:
+        path = abspath(expandvars(path))
+    last_file = None
+    for path_, name, generation, size, mtime, deleted in \
+            index.find_versions(pattern, path):
+        filepath = join(path_, name)
+        if filepath != last_file:
+            print(filepath)
+            last_file = filepath
+        print('    ' + _format_version(generation, size, deleted))
+
+
+def main():
+    try:
+        profile, command, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    except IndexError:
+        print('Usage: %s <profile> show <file>' % sys.argv[0])
+        print('       %s <profile> find <pattern> [<path>]' % sys.argv[0])
+        sys.exit(1)
+
+    # Load and extract our config.
+    config = get_config('%s.ini' % profile)
+    BACKUP_PATH = config.get('destination', 'path')
+    LOG_LEVEL = config.get('logging', 'level')
+    LOG_FORMAT = config.get('logging', 'format')
+
+    # Support ~, ~user and other constructions.
+    BACKUP_PATH = expandvars(BACKUP_PATH)
+
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    logger = logging.getLogger('process')
+
+    BACKUP_PATH_REAL = BACKUP_PATH
+    mounted_volume = None
+    try:
+        if BACKUP_PATH.startswith('volume://'):
+            mounted_volume, BACKUP_PATH_REAL = volume.mount(BACKUP_PATH)
+        db_path = join(BACKUP_PATH_REAL, 'index.sqlite3')
+        index = Index(db_path, open_mode=OPEN_READ_ONLY)
+    except Exception as reason:
+        logger.error(reason)
+        sys.exit(1)
+
+    try:
+        if command == 'show':
+            show(index, *args)
+        elif command == 'find':
+            find(index, *args)
+        else:
+            logger.error('Unknown command: %s' % command)
+            sys.exit(1)
+    finally:
+        if mounted_volume:
+            volume.umount(mounted_volume)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,30 @@
-from os.path import exists, join
-from os import (makedirs, link, rename, stat as os_stat, mknod)
+from os.path import exists, join, basename
+from os import (makedirs, link, rename, stat as os_stat, mknod, listdir)
+from shutil import rmtree
+from threading import Event
+import heapq
 import stat
 import time
 import logging
+import re
 
 from lib.dtree import scan, copystat
-from lib.copy import Reader, Writer, Queue, QUEUE_SIZE
+from lib.copy import (Reader, Writer, Progress, Queue, QUEUE_SIZE,
+                      CHUNK_SIZE, CHUNK_PART_SIZE)
+from lib.fiemap import ExtentMap, batched
+from lib.dirstats import get_ancestors, read_dir_stats, apply_dir_stats
+from lib.journal import Journal
+from lib.delta import BLOCK_SIZE, MAX_DELTA_DEPTH, get_depth, unpack_hashes
+from lib.dircache import DirCache
+from lib.durability import (Flusher, syncfs, fsync_dir, DURABILITY_MODES,
+                            DURABILITY_NONE, DURABILITY_BATCHED,
+                            DURABILITY_SYNCFS)
+from lib.pagecache import IO_MODES, IO_MODE_NORMAL, IO_MODE_GENTLE
+from lib.tuning import DepthTuner, MAX_QUEUE_BYTES
+
+
+READ_ORDER_INODE = 'inode'
+READ_ORDER_PHYSICAL = 'physical'
 
 
 class Backup(object):
@@ -18,33 +37,119 @@ class Backup(object):
         if not exists(base_path):
             raise Exception('Backup path not found: %s' % base_path)
 
-    def __init__(self, base_path):
+    def __init__(self, base_path, read_order=READ_ORDER_INODE, hash_name=None,
+                 resume=True, delta_min_size=0, durability=DURABILITY_NONE,
+                 io_mode=IO_MODE_NORMAL, direct_io_min_size=0,
+                 chunk_size=CHUNK_SIZE, part_size=CHUNK_PART_SIZE,
+                 queue_size=QUEUE_SIZE, adapt_queue=False, deadline=None):
         super(Backup, self).__init__()
         self._base_path = base_path
         self._logger = logging.getLogger('backup')
+        if read_order not in (READ_ORDER_INODE, READ_ORDER_PHYSICAL):
+            raise Exception('Unknown read order: %s' % read_order)
+        self._read_order = read_order
+        if durability not in DURABILITY_MODES:
+            raise Exception('Unknown durability mode: %s' % durability)
+        self._durability = durability
+        if io_mode not in IO_MODES:
+            raise Exception('Unknown I/O mode: %s' % io_mode)
+        self._io_mode = io_mode
+        self._direct_io_min_size = direct_io_min_size
+        self._chunk_size = chunk_size
+        self._part_size = part_size
+        self._queue_size = queue_size
+        self._adapt_queue = adapt_queue
+        self._depth_tuner = None
+        self._flusher = None
+        self._extent_map = None
+        self._hash_name = hash_name
+        self._resume = resume
+        self._journal = None
+        self._done_files = {}
+        self._resumed_checksums = []
+        self._hardlinks = {}
+        self._delta_min_size = delta_min_size
+        self._block_hashes = {}
+        self._deltas = {}
         self._reader, self._writer = None, None
+        self._progress = Progress()  # Of this destination.
+        self._dir_cache = DirCache()
         self._dirs_need_stats = []
         self._missing_files = []
         self._missing_bytes = 0
+        self._deadline = deadline
+        self._time_is_up = False
+        self._pending = []
+        self._gate = Event()  # Cleared while paused.
+        self._gate.set()
+        self._cancelled = False
         self.__init_base_path(base_path)
 
     def __init_threads(self, sum_bytes):
-        self._input_queue = Queue.Queue(maxsize=QUEUE_SIZE * 4)
-        self._output_queue = Queue.Queue(maxsize=QUEUE_SIZE)
-        self._reader = Reader(self._input_queue, self._output_queue, sum_bytes)
+        self._input_queue = Queue.Queue(maxsize=self._queue_size * 4)
+        self._output_queue = Queue.Queue(maxsize=self._queue_size)
+        self._reader = Reader(self._input_queue, self._output_queue, sum_bytes,
+                              io_mode=self._io_mode,
+                              direct_io_min_size=self._direct_io_min_size,
+                              chunk_size=self._chunk_size,
+                              part_size=self._part_size,
+                              gate=self._gate, progress=self._progress)
         self._reader.start()
-        self._writer = Writer(self._output_queue, self._dirs_need_stats)
+        if self._adapt_queue:
+            self._depth_tuner = DepthTuner(
+                self._output_queue,
+                max(self._queue_size, MAX_QUEUE_BYTES // self._chunk_size))
+        if self._durability == DURABILITY_BATCHED:
+            self._flusher = Flusher(on_synced=self._journal.add,
+                                    drop_cache=self._io_mode == IO_MODE_GENTLE)
+            self._flusher.start()
+        self._writer = Writer(self._output_queue, self._dirs_need_stats,
+                              hash_name=self._hash_name,
+                              journal=self._journal,
+                              dir_cache=self._dir_cache,
+                              flusher=self._flusher,
+                              io_mode=self._io_mode,
+                              part_size=self._part_size,
+                              progress=self._progress)
         self._writer.start()
 
-    def create(self, sum_bytes):
-        hash_ = str(time.time())
-        backup_path = join(self._base_path, hash_ + '-in-progress')
+    def __find_interrupted(self):
+        '''Returns the timestamp of the newest in-progress dir which has a
+        journal or None.'''
+        pattern = re.compile(r'^(\d+\.\d+)-in-progress$')
+        timestamps = []
+        for name in listdir(self._base_path):
+            match = pattern.match(name)
+            if match and exists(join(self._base_path, name + '.journal')):
+                timestamps.append(match.group(1))
+        if timestamps:
+            return max(timestamps, key=lambda v: float(v))
+        return None
+
+    def create(self, sum_bytes, sum_files=0):
+        hash_ = self.__find_interrupted() if self._resume else None
+        if hash_:
+            backup_path = join(self._base_path, hash_ + '-in-progress')
+            self._logger.info('Resuming interrupted backup dir: %s' % backup_path)
+        else:
+            hash_ = str(time.time())
+            backup_path = join(self._base_path, hash_ + '-in-progress')
+            self._logger.info('Creating backup dir: %s' % backup_path)
+            makedirs(backup_path)
         backup_path_final = join(self._base_path, hash_)
-        self._logger.info('Creating backup dir: %s' % backup_path)
-        makedirs(backup_path)
         self._backup_path = backup_path
         self._backup_path_final = backup_path_final
+        sync = None
+        if self._durability == DURABILITY_SYNCFS:
+            # Files get journaled only once the filesystem has been synced.
+            sync = lambda: syncfs(backup_path)
+        self._journal = Journal(backup_path + '.journal', sync=sync)
+        self._done_files = self._journal.load()
+        if self._done_files:
+            self._logger.info('Found %d already copied files.' %
+                              len(self._done_files))
         self.__init_threads(sum_bytes)
+        self.add_more_files(sum_files)
 
     def __join_threads(self):
         if self._reader:
@@ -53,46 +158,265 @@ class Backup(object):
         if self._writer:
             self._writer.stop()
             self._writer.join()
+        if self._flusher:
+            self._flusher.stop()
+            self._logger.info('Synced %d files.' % self._flusher.num_synced)
+            self._flusher = None
+            self._journal.flush()
 
     def __del__(self):
         self.__join_threads()
 
+    def load_deltas(self, index):
+        '''Loads the block hashes of the stored versions of large files.
+        Has to happen before the scan as long as the Feeder thread is
+        using the index.'''
+        if self._delta_min_size:
+            self._block_hashes = index.get_block_hashes()
+            self._deltas = index.get_deltas()
+            self._logger.info('Found block hashes of %d files.' %
+                              len(self._block_hashes))
+
+    def _get_delta(self, src_path, name):
+        '''Returns the delta info the Reader and Writer need for a large
+        file. Without a usable stored version, or if that one is stacked of
+        MAX_DELTA_DEPTH delta objects already, only its block hashes get
+        recorded for the next time.'''
+        delta = dict(block_size=BLOCK_SIZE, hashes=[], base_generation=None,
+                     base_file=None)
+        stored = self._block_hashes.get((src_path, name))
+        if not stored or stored[1] != BLOCK_SIZE:
+            return delta
+        generation = stored[0]
+        base_file = join(self._base_path, generation, src_path.lstrip('./'), name)
+        if not exists(base_file):
+            return delta
+        if get_depth(self._deltas, generation, src_path, name) >= MAX_DELTA_DEPTH:
+            return delta  # Gets written completely.
+        delta['hashes'] = unpack_hashes(stored[2])
+        delta['base_generation'] = generation
+        # A delta object of its own cannot be cloned.
+        if (generation, src_path, name) not in self._deltas:
+            delta['base_file'] = base_file
+        return delta
+
     def create_tree(self, dirs):
         num_dirs = 0
         for src_dir, mtime, inode in dirs:
             dst_dir = src_dir.lstrip('./')
             dst_dir = join(self._backup_path, dst_dir)
-            makedirs(dst_dir)
+            self._dir_cache.makedirs(dst_dir)  # Might exist if resumed.
             self._dirs_need_stats.append(src_dir)
             num_dirs += 1
         self._logger.info('Created %d dirs.' % num_dirs)
 
-    def copy_files(self, files):
-        num_files, num_symlinks = 0, 0
-        for src_path, name, mtime, size, is_link, is_file, inode in files:
+    def _schedule(self, files, get_row=None):
+        '''Yields the files in the order they should be read.
+
+        The index delivers them in priority order. In physical mode each
+        batch gets sorted by the location of the first extent on disk.
+        get_row returns the index row of an entry if files are no rows.
+        '''
+        if self._read_order != READ_ORDER_PHYSICAL:
+            for row in files:
+                yield row
+            return
+        if self._extent_map is None:
+            self._extent_map = ExtentMap()  # Cached for the whole run.
+        extent_map = self._extent_map
+        # Only regular files get mapped. Opening a fifo would block.
+        row_key = lambda row: (join(row[0], row[1])
+                               if row[5] and not row[4] else None, row[6])
+        key = (lambda entry: row_key(get_row(entry))) if get_row else row_key
+        # Sorting by location keeps all names of a hard link together.
+        for batch in batched(files):
+            if extent_map.is_supported():
+                extent_map.sort(batch, key)
+            for row in batch:
+                yield row
+
+    def time_is_up(self):
+        '''Returns True once the deadline has passed. No more files get
+        queued from then on and the queued ones are dropped, they are left
+        pending for the next run. Files being copied still get finished.'''
+        if self._deadline and not self._time_is_up and time.time() >= self._deadline:
+            self._logger.warning('Backup window is over, leaving the remaining '
+                                 'files for the next run.')
+            self._time_is_up = True
+            self._drain(self._leave_queued_pending)
+        return self._time_is_up
+
+    def leave_pending(self, item):
+        self._pending.append((item['src_dir'], basename(item['src_file'])))
+
+    def _leave_queued_pending(self, item):
+        # Items of fan_out are pending for all backups which need them.
+        for backup, target in zip(item.get('backups') or [self],
+                                  item.get('targets') or [item]):
+            backup.leave_pending(item)
+            if not target['link_to']:
+                backup.add_more_bytes(-item['size'])
+            backup.add_more_files(-1)
+
+    def _drain(self, on_item=None):
+        # Drops the items queued for the Reader.
+        if not self._reader:
+            return
+        try:
+            while True:
+                item = self._input_queue.get_nowait()
+                if on_item:
+                    on_item(item)
+                self._input_queue.task_done()
+        except Queue.Empty:
+            pass
+
+    def get_pending(self):
+        '''Returns (path, name) of the changed files which did not get
+        copied in time.'''
+        return self._pending
+
+    def make_items(self, files):
+        '''Yields the Reader items for the given index rows in read order.
+        Files already copied by an interrupted run are left out, so are all
+        files once the time is up.'''
+        return self._make_items(self._schedule(files))
+
+    def _make_items(self, files):
+        done_files = self._done_files
+        hardlinks = self._hardlinks
+        for (src_path, name, mtime, size, is_link, is_file, inode, dev,
+                nlink) in files:
+            if self._cancelled:
+                return
+            if self.time_is_up():
+                self._pending.append((src_path, name))
+                self.add_more_bytes(-size)
+                self.add_more_files(-1)
+                continue
             src_file = join(src_path, name)
             dst_file = src_file.lstrip('./')
             dst_file = join(self._backup_path, dst_file)
-            self._input_queue.put(dict(
+            # Files with several names are copied once. The other names
+            # become hard links to the first one within this generation.
+            link_to = None
+            if nlink and nlink > 1 and is_file and not is_link:
+                link_to = hardlinks.get((dev, inode))
+                if link_to is None:
+                    hardlinks[(dev, inode)] = dst_file
+            if done_files:
+                done = done_files.get(src_file)
+                if done and done[0] == size and done[1] == mtime:
+                    # Already copied by the interrupted run.
+                    if done[2]:
+                        self._resumed_checksums.append((src_file, size, done[2]))
+                    self._dirs_need_stats.append(src_path)
+                    self.add_more_bytes(-size)
+                    self.add_more_files(-1)
+                    continue
+            if link_to:
+                self.add_more_bytes(-size)
+            delta = None
+            if (self._delta_min_size and size >= self._delta_min_size and
+                    is_file and not is_link and not link_to):
+                delta = self._get_delta(src_path, name)
+            yield dict(
                 src_dir=src_path,
                 src_file=src_file,
                 src_resolver=None,
                 dst_file=dst_file,
                 size=size,
+                mtime=mtime,
                 is_link=is_link,
                 is_file=is_file,
-            ))
+                dev=dev,
+                link_to=link_to,
+                delta=delta,
+            )
+
+    def queue_files(self, files):
+        put = self._input_queue.put
+        for item in self.make_items(files):
+            put(item)
+
+    def pause(self):
+        '''Holds the Reader before its next chunk until resume.'''
+        self._gate.clear()
+
+    def resume(self):
+        self._gate.set()
+
+    def cancel(self):
+        '''Stops queuing files and drops the queued ones. Files being copied
+        still get finished. Thread safe, the backup can be resumed from its
+        journal after abort.'''
+        self._cancelled = True
+        self._gate.set()
+        self._drain()
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def put_item(self, item):
+        self._input_queue.put(item)
+
+    def add_more_bytes(self, count):
+        self._progress.add('bytes_total', count)
+
+    def add_more_files(self, count):
+        self._progress.add('files_total', count)
+
+    def wait(self):
         try:
             while not (self._reader._is_idle and self._writer._is_idle and
                        self._input_queue.empty() and
                        self._output_queue.empty() and
                        self._reader.is_alive() and self._writer.is_alive()):
+                self.time_is_up()  # Drops what is still queued then.
+                if self._depth_tuner:
+                    self._depth_tuner.update(self._reader.get_bytes_read())
                 time.sleep(0.5)
         except KeyboardInterrupt:
             pass
-        self._logger.info('Copied %d files and %d symlinks.' %
+        self._logger.info('Copied %d files, %d symlinks and %d hard links.' %
                           (self._writer._num_files,
-                           self._writer._num_symlinks))
+                           self._writer._num_symlinks,
+                           self._writer._num_hardlinks))
+
+    def copy_files(self, files):
+        self.queue_files(files)
+        self.wait()
+
+    def stream(self, dir_data, dir_changed, files):
+        '''Callback for Index.update_concurrently: Creates the dir if it is
+        new or has been modified and queues its changed files right away.'''
+        src_dir = dir_data[0]
+        if dir_changed:
+            dst_dir = join(self._backup_path, src_dir.lstrip('./'))
+            self._dir_cache.makedirs(dst_dir)  # Writer might be faster.
+            self._dirs_need_stats.append(src_dir)
+        if files:
+            self.add_more_bytes(sum(row[3] for row in files))
+            self.add_more_files(len(files))
+            self.queue_files(files)
+
+    def abort(self):
+        '''Stops without committing. The in-progress dir and its journal are
+        kept for the next run to resume.'''
+        self.cancel()  # Queued files would be copied first.
+        self.__join_threads()
+        self._reader, self._writer = None, None
+        if self._journal:
+            self._journal.close()
+        self._logger.info('Left backup dir for resuming: %s' % self._backup_path)
+
+    def discard(self):
+        '''Removes the in-progress dir again if nothing had to be copied.'''
+        self.__join_threads()
+        self._reader, self._writer = None, None
+        self._logger.info('Removing unneeded backup dir: %s' % self._backup_path)
+        rmtree(self._backup_path)
+        self._journal.remove()
 
     def link_old_files(self, files):
         # TODO replace with more low-level cached variant like in restore process.
@@ -101,8 +425,8 @@ class Backup(object):
         if not backup_dirs:
             self._logger.info('No previous backup found. Skipped linking.')
             return
-        prev_backup_path = join(backup_dirs[-1]._path, backup_dirs[-1].name)
-        for src_path, name, mtime, size, is_link, is_file, inode in files:
+        prev_backup_path = backup_dirs[-1].path
+        for src_path, name, mtime, size, is_link, is_file, inode, dev, nlink in files:
             org_file = join(src_path, name)
             src_file = org_file.lstrip('./')
             src_file = join(prev_backup_path, src_file)
@@ -132,7 +456,7 @@ class Backup(object):
                 # TODO perhaps mark unreadable files as such so that they won't be tried next time?
                 if exists(org_file):
                     self._logger.warn('File not found in previous backup. Queued file for copying: %s' % org_file)
-                    self._missing_files.append((src_path, name, mtime, size, is_link, is_file, inode))
+                    self._missing_files.append((src_path, name, mtime, size, is_link, is_file, inode, dev, nlink))
                     self._missing_bytes += size
                 else:  # This should not happen. Perhaps a race condition might trigger this.
                     self._logger.error('Linking failed: "%s" -> "%s"' % (src_file, dst_file))
@@ -145,36 +469,125 @@ class Backup(object):
         return self._missing_bytes
 
     def copy_missing_files(self):
-        self._reader.add_more_bytes(self._missing_bytes)
+        self.add_more_bytes(self._missing_bytes)
+        self.add_more_files(len(self._missing_files))
         self.copy_files(self._missing_files)
 
-    def _copy_dir_stats(self, path):
-        # TODO remember already seen dirs and skip them below.
-        parts = path.lstrip('./').split('/')
-        while parts:
-            src_dir = '/'.join([''] + parts)
-            # print src_dir
-            dst_dir = join(self._backup_path, '/'.join(parts))
-            # print dst_dir
-            try:
-                copystat(src_dir, dst_dir, follow_symlinks=False)
-            except KeyboardInterrupt:
-                raise
-            except Exception as reason:
-                self._logger.exception(reason)
-            del parts[-1]
-
-    def copy_dir_stats(self):
-        # TODO should be gathered from the database.
+    def copy_dir_stats(self, index):
+        # Every dir gets handled once, no matter how many of its children
+        # have been created. Stats come from the scan if possible.
+        paths = set()
         for path in self._dirs_need_stats:
-            self._copy_dir_stats(path)
+            paths.update(get_ancestors(path))
+        stats = index.get_dir_stats(paths)
+        dst_stats = {}
+        for src_dir in paths:
+            try:
+                dir_stats = stats[src_dir]
+            except KeyError:  # Parent of a source path.
+                try:
+                    dir_stats = read_dir_stats(src_dir)
+                except (IOError, OSError) as reason:
+                    self._logger.error(reason)
+                    continue
+            dst_stats[join(self._backup_path, src_dir.lstrip('./'))] = dir_stats
+        num_dirs = apply_dir_stats(dst_stats)
+        self._logger.info('Applied stats of %d dirs (%d from the index).' %
+                          (num_dirs, len(stats)))
 
     def commit(self):
+        self.__join_threads()
+        if self._durability != DURABILITY_NONE:
+            # Nothing may be missing once the generation has its final name.
+            syncfs(self._backup_path)
         self._logger.info('Renaming finished backup dir to: %s' % self._backup_path_final)
         rename(self._backup_path, self._backup_path_final)
+        if self._durability != DURABILITY_NONE:
+            fsync_dir(self._base_path)
+        self._journal.remove()
 
     def get_path(self):
         return self._backup_path
 
     def get_final_path(self):
         return self._backup_path_final
+
+    def get_generation(self):
+        return basename(self._backup_path_final)
+
+    def get_checksums(self):
+        return self._resumed_checksums + self._writer.get_checksums()
+
+    def get_output_queue(self):
+        return self._output_queue
+
+    def get_block_hashes(self):
+        return self._writer.get_block_hashes()
+
+    def get_device_stats(self):
+        return self._reader.get_dev_stats() if self._reader else {}
+
+    def get_progress(self):
+        '''Returns the progress of this destination (see Progress).'''
+        return self._progress.get()
+
+    def get_reader_queue_size(self):
+        return self._input_queue.qsize() if self._reader else 0
+
+    def get_writer_queue_size(self):
+        return self._output_queue.qsize() if self._writer else 0
+
+    def get_deltas(self):
+        return self._writer.get_deltas()
+
+
+def _merge_join(backups, file_lists, key):
+    # Yields lists of (backup, row) of the same file from the file lists
+    # sorted by key, without loading any of them as a whole.
+    def decorated(i, files):
+        for row in files:
+            yield key(row), i, row
+    group = []
+    for _, i, row in heapq.merge(*[decorated(i, files)
+                                   for i, files in enumerate(file_lists)]):
+        if group and group[0][1][:2] != row[:2]:
+            yield group
+            group = []
+        group.append((backups[i], row))
+    if group:
+        yield group
+
+
+def fan_out(backups, get_file_lists, key):
+    '''Copies the changed files of several destinations at once.
+
+    get_file_lists returns the changed files of each backup, sorted by key
+    (see Index.priority_key). Every file is read once by the Reader of the
+    first backup, which hands it to the Writers of all backups which need
+    it. Each Writer has a bounded queue of its own, so a slow destination
+    only holds up the others once its queue is full. The lists get merged
+    as they are read. Every backup counts the progress of its own
+    destination: its totals are the ones of its own list and what is done
+    gets counted by its Writer.
+    '''
+    primary = backups[0]
+    groups = _merge_join(backups, get_file_lists(), key)
+    for group in primary._schedule(groups, get_row=lambda group: group[0][1]):
+        if primary.is_cancelled():
+            break
+        entries = [(backup, item) for backup, row in group
+                   for item in backup._make_items([row])]
+        if not entries:
+            continue
+        item = dict(entries[0][1])
+        item['backups'] = [backup for backup, backup_item in entries]
+        item['targets'] = [dict(
+            output_queue=backup.get_output_queue(),
+            dst_file=backup_item['dst_file'],
+            delta=backup_item['delta'],
+            link_to=backup_item['link_to'],
+            progress=backup._progress,
+        ) for backup, backup_item in entries]
+        primary.put_item(item)
+    for backup in backups:
+        backup.wait()
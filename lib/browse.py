@@ -0,0 +1,196 @@
+from os.path import join, split, lexists
+from os import listdir, lstat, readlink
+from collections import OrderedDict
+import stat
+import re
+
+from lib.delta import get_layers, DeltaFile
+
+
+# Number of dir listings and of resolved file locations kept.
+LISTING_CACHE_SIZE = 256
+LOCATION_CACHE_SIZE = 4096
+
+KIND_DIR = 'dir'
+KIND_FILE = 'file'
+KIND_SYMLINK = 'symlink'
+KIND_OTHER = 'other'
+
+# Alias for the newest generation.
+LATEST = 'latest'
+
+
+class LRUCache(object):
+    '''Dict of limited size which drops the least recently used entry.'''
+
+    def __init__(self, size):
+        super(LRUCache, self).__init__()
+        self._size = size
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = value  # Most recently used.
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        while len(self._entries) >= self._size:
+            self._entries.popitem(last=False)
+        self._entries[key] = value
+
+    def clear(self):
+        self._entries.clear()
+
+
+def normpath(path):
+    '''Returns path the way the index stores it: absolute, without a
+    trailing slash.'''
+    return '/' + path.strip('/')
+
+
+class Browser(object):
+    '''Read-only view of every generation of a backup as a complete tree.
+
+    A generation only holds the files which changed with it. Which version
+    of a file belongs to the tree of a generation, and so which generation
+    dir it is stored in, comes from the version catalog of the index. Only
+    stat and open touch the generation dirs, and only the one of the file
+    asked for. Like the index it reads from, a browser must only be used
+    from the thread which created it.
+    '''
+
+    def __init__(self, base_path, index, listing_cache_size=LISTING_CACHE_SIZE,
+                 location_cache_size=LOCATION_CACHE_SIZE):
+        super(Browser, self).__init__()
+        if not lexists(base_path):
+            raise Exception('Backup path not found: %s' % base_path)
+        self._base_path = base_path
+        self._index = index
+        self._listings = LRUCache(listing_cache_size)
+        self._locations = LRUCache(location_cache_size)
+        self._deltas = None  # Loaded with the first delta object opened.
+        self._generations = None
+
+    def get_generations(self):
+        '''Returns the names of the finished generations, oldest first.'''
+        if self._generations is None:
+            pattern = re.compile(r'^\d+\.\d+$')
+            self._generations = sorted(
+                (name for name in listdir(self._base_path) if pattern.match(name)),
+                key=float)
+        return self._generations
+
+    def refresh(self):
+        '''Forgets everything cached, e.g. after a backup finished.'''
+        self._generations = None
+        self._deltas = None
+        self._listings.clear()
+        self._locations.clear()
+
+    def _get_generation(self, generation):
+        generations = self.get_generations()
+        if not generations:
+            raise Exception('No backups found: %s' % self._base_path)
+        if generation == LATEST:
+            return generations[-1]
+        if generation not in generations:
+            raise Exception('Backup not found: %s' % generation)
+        return generation
+
+    def _get_listing(self, generation, path):
+        key = (generation, path)
+        listing = self._listings.get(key)
+        if listing is None:
+            index = self._index
+            dirs = index.list_version_dirs(path, generation)
+            files = index.list_versions(path, generation)
+            for name, stored_in, size, mtime in files:
+                self._locations.put((generation, path, name),
+                                    (stored_in, size, mtime))
+            listing = (dirs, files)
+            self._listings.put(key, listing)
+        return listing
+
+    def _locate(self, generation, path, name):
+        # Returns (generation stored in, size, mtime) or None.
+        key = (generation, path, name)
+        location = self._locations.get(key, False)
+        if location is False:
+            location = self._index.get_version(path, name, generation)
+            self._locations.put(key, location)
+        return location
+
+    def _is_dir(self, generation, path):
+        if path == '/':
+            return True
+        parent, name = split(path)
+        return name in self._get_listing(generation, parent)[0]
+
+    def listdir(self, generation, path='/'):
+        '''Returns the entries of a dir of a generation as dicts of name,
+        kind (KIND_DIR or KIND_FILE), size, mtime and the generation the
+        file is stored in, dirs first.'''
+        generation = self._get_generation(generation)
+        path = normpath(path)
+        if not self._is_dir(generation, path):
+            raise Exception('No such dir in backup %s: %s' % (generation, path))
+        dirs, files = self._get_listing(generation, path)
+        entries = [dict(name=name, kind=KIND_DIR, size=None, mtime=None,
+                        generation=None) for name in dirs]
+        entries += [dict(name=name, kind=KIND_FILE, size=size, mtime=mtime,
+                         generation=stored_in)
+                    for name, stored_in, size, mtime in files]
+        return entries
+
+    def _get_stored_path(self, stored_in, path, name):
+        return join(self._base_path, stored_in, path.lstrip('/'), name)
+
+    def stat(self, generation, path):
+        '''Returns a dict of path, kind, size, mtime, mode, uid, gid, the
+        generation the file is stored in and, for symlinks, their target.'''
+        generation = self._get_generation(generation)
+        path = normpath(path)
+        if self._is_dir(generation, path):
+            return dict(path=path, kind=KIND_DIR, size=None, mtime=None,
+                        mode=None, uid=None, gid=None, generation=None,
+                        target=None)
+        dir_path, name = split(path)
+        location = self._locate(generation, dir_path, name)
+        if location is None:
+            raise Exception('No such file in backup %s: %s' % (generation, path))
+        stored_in, size, mtime = location
+        stored_path = self._get_stored_path(stored_in, dir_path, name)
+        try:
+            st = lstat(stored_path)
+        except OSError:
+            raise Exception('Stored copy missing: %s' % stored_path)
+        kind, target = KIND_OTHER, None
+        if stat.S_ISLNK(st.st_mode):
+            kind, target = KIND_SYMLINK, readlink(stored_path)
+        elif stat.S_ISREG(st.st_mode):
+            kind = KIND_FILE
+        return dict(path=path, kind=kind,
+                    size=size if size is not None else st.st_size,
+                    mtime=mtime if mtime is not None else int(st.st_mtime),
+                    mode=stat.S_IMODE(st.st_mode), uid=st.st_uid, gid=st.st_gid,
+                    generation=stored_in, target=target)
+
+    def open(self, generation, path):
+        '''Returns a binary file object for reading a regular file of a
+        generation. Files stored as delta objects get put back together.'''
+        info = self.stat(generation, path)
+        if info['kind'] != KIND_FILE:
+            raise Exception('Not a regular file: %s' % path)
+        dir_path, name = split(info['path'])
+        stored_in = info['generation']
+        if self._deltas is None:
+            self._deltas = self._index.get_deltas()
+        if (stored_in, dir_path, name) in self._deltas:
+            return DeltaFile(get_layers(self._base_path, self._deltas,
+                                        stored_in, dir_path, name),
+                             info['size'])
+        return open(self._get_stored_path(stored_in, dir_path, name), 'rb')
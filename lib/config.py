@@ -11,7 +11,10 @@ class ConfigParser(configparser.ConfigParser):
     def __csv_parse_value(self, value, list=True):
         parser = csv.reader([value], delimiter=',', quotechar='"', skipinitialspace=True)
         for fields in parser:
-            return fields if list else fields[0]
+            if list:
+                return fields
+            return fields[0] if fields else ''  # Empty value.
+        return [] if list else ''
 
     def get(self, *args, **kwargs):
         kwargs['raw'] = True
@@ -26,6 +29,28 @@ class ConfigParser(configparser.ConfigParser):
         return self.__csv_parse_value(value, True)
 
 
+# Options of the [destination] section which [destination:<name>] sections
+# may override.
+DESTINATION_OPTIONS = ('path', 'resume', 'durability', 'index_cache')
+
+
+def get_destinations(config):
+    '''Returns the [destination] section and all [destination:<name>] ones
+    as dicts. Options missing in the latter are taken from [destination].
+    Destinations with an empty path are left out.'''
+    sections = ['destination'] + sorted(section for section in config.sections()
+                                        if section.startswith('destination:'))
+    destinations = []
+    for section in sections:
+        destination = dict(name=section.partition(':')[2] or 'default')
+        for option in DESTINATION_OPTIONS:
+            source = section if config.has_option(section, option) else 'destination'
+            destination[option] = config.get(source, option)
+        if destination['path']:
+            destinations.append(destination)
+    return destinations
+
+
 def get_config(user_config):
     config = ConfigParser()
     config.read('default.ini')
@@ -0,0 +1,160 @@
+from os.path import exists, lexists, join, isdir, islink, getsize
+from os import listdir, rename
+from shutil import rmtree
+from datetime import datetime
+import logging
+import re
+
+from lib.delta import get_layers, materialize
+from lib.verify import VerifyState
+
+
+MERGING_SUFFIX = '-merging'
+
+
+class Consolidate(object):
+    '''Merges generations into newer ones and applies the retention policy.
+
+    Every generation only holds what changed since the one before, Restore
+    looks for everything else in the older ones. Merging a generation into a
+    newer one moves everything the newer one does not have yet over by
+    renaming it, so the newer one holds what Restore used to find in the
+    merged one. Files which did not change since even older generations
+    are still found in those. The merged generation gets renamed to
+    <timestamp>-merging first, which hides it from Restore and lets an
+    interrupted run finish the merge next time. Delta objects which take
+    unchanged blocks from the merged generation become complete files
+    beforehand.
+    '''
+
+    def __init_generations(self):
+        pattern = re.compile(r'^\d+\.\d+$')
+        generations = filter(lambda item: pattern.match(item),
+                             listdir(self._base_path))
+        self._generations = sorted(generations, key=lambda v: float(v))
+
+    def __init__(self, base_path, index):
+        super(Consolidate, self).__init__()
+        self._base_path = base_path
+        self._index = index
+        self._logger = logging.getLogger('consolidate')
+        if not exists(base_path):
+            raise Exception('Backup path not found: %s' % base_path)
+        self.__init_generations()
+
+    def get_generations(self):
+        return list(self._generations)
+
+    def plan(self, hourly, daily, weekly):
+        '''Returns a list of (target, sources) tuples. Sources are ordered
+        newest first and get merged into the next newer generation which is
+        kept by the policy. The newest generation is always kept.'''
+        periods = (
+            (hourly, lambda dt: (dt.date(), dt.hour)),
+            (daily, lambda dt: dt.date()),
+            (weekly, lambda dt: dt.isocalendar()[:2]),
+        )
+        keep = set(self._generations[-1:])
+        for count, get_bucket in periods:
+            buckets = set()
+            for generation in reversed(self._generations):
+                if len(buckets) >= count:
+                    break
+                bucket = get_bucket(datetime.fromtimestamp(float(generation)))
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    keep.add(generation)
+        merges, sources = [], []
+        for generation in reversed(self._generations):
+            if generation in keep:
+                if sources:
+                    merges.append((target, sources))
+                target, sources = generation, []
+            else:
+                sources.append(generation)
+        if sources:
+            merges.append((target, sources))
+        return merges
+
+    def _merge_tree(self, src_dir, dst_dir, rel_dir, moved):
+        for name in listdir(src_dir):
+            if not rel_dir and name == 'index.sqlite3.gz':
+                continue  # Every generation has its own.
+            src_path, dst_path = join(src_dir, name), join(dst_dir, name)
+            rel_path = join(rel_dir, name)
+            if not lexists(dst_path):
+                rename(src_path, dst_path)
+                moved.add(rel_path)
+            elif (isdir(src_path) and not islink(src_path) and
+                    isdir(dst_path) and not islink(dst_path)):
+                self._merge_tree(src_path, dst_path, rel_path, moved)
+            # Else the target has a newer version already.
+
+    def _materialize(self, source, source_path):
+        deltas = self._index.get_deltas()
+        for generation, path, name in self._index.get_deltas_on(source):
+            layers = get_layers(self._base_path, deltas, generation, path,
+                                name, {source: source_path})
+            try:
+                materialize(layers, getsize(layers[0][0]))
+            except (IOError, OSError) as reason:
+                self._logger.error('Could not materialize delta: %s' % reason)
+                continue
+            self._index.remove_delta(generation, path, name)
+            del deltas[(generation, path, name)]
+
+    def _merge(self, target, source):
+        self._logger.info('Merging generation %s into %s.' % (source, target))
+        merging_path = join(self._base_path, source + MERGING_SUFFIX)
+        if exists(join(self._base_path, source)):
+            self._materialize(source, join(self._base_path, source))
+            rename(join(self._base_path, source), merging_path)
+        else:
+            self._materialize(source, merging_path)
+        moved = set()
+        self._merge_tree(merging_path, join(self._base_path, target), '', moved)
+
+        def is_moved(path, name):
+            rel_path = join(path.lstrip('./'), name)
+            while rel_path:
+                if rel_path in moved:
+                    return True
+                rel_path = rel_path.rpartition('/')[0]
+            return False
+        self._index.move_generation(source, target, is_moved)
+        # The target has to be verified again from the start.
+        state = VerifyState(self._base_path)
+        state.forget((source, target))
+        state.close()
+        rmtree(merging_path)
+        self._generations.remove(source)
+        return len(moved)
+
+    def _finish_interrupted(self):
+        pattern = re.compile(r'^(\d+\.\d+)' + MERGING_SUFFIX + '$')
+        for name in listdir(self._base_path):
+            match = pattern.match(name)
+            if not match:
+                continue
+            source = match.group(1)
+            newer = [generation for generation in self._generations
+                     if float(generation) > float(source)]
+            if newer:
+                self._logger.info('Finishing interrupted merge of: %s' % source)
+                self._generations.append(source)  # Gets removed by _merge.
+                self._merge(newer[0], source)
+
+    def merge(self, target, sources):
+        '''Merges the sources (newest first) into target.'''
+        self._finish_interrupted()  # Before anything else gets moved.
+        num_moved = 0
+        for source in sources:
+            num_moved += self._merge(target, source)
+        return num_moved
+
+    def run(self, hourly, daily, weekly):
+        self._finish_interrupted()
+        merges = self.plan(hourly, daily, weekly)
+        for target, sources in merges:
+            self.merge(target, sources)
+        return sum(len(sources) for target, sources in merges)
@@ -1,17 +1,21 @@
-from os.path import exists, basename, dirname
-from os import (makedirs, readlink, symlink, stat as os_stat,
-                mknod, fstat as os_fstat)
+from os.path import basename, dirname
+from os import readlink, stat as os_stat, fstat as os_fstat, dup
 import stat
 import time
 import logging
-from threading import Thread
+import hashlib
+import errno
+from threading import Thread, Lock
 try:
     import Queue  # Python 2
 except ImportError:
     import queue as Queue  # Python 3
 
 from lib.human_size import human_size
-from lib.dtree import copystat
+from lib.dircache import DirCache
+from lib.delta import BLOCK_HASH, DeltaFile, reflink
+from lib.pagecache import (IO_MODE_NORMAL, IO_MODE_GENTLE, WriteBehind,
+                           advise_sequential, advise_ahead, drop, open_direct)
 
 
 # Define output chunk and queue size. E.g. 1 MB * 100 = 100 MB
@@ -19,53 +23,169 @@ CHUNK_SIZE = 1024 * 1024 * 5  # Bytes
 QUEUE_SIZE = 25  # Length
 
 CHUNK_TYPE_EMPTY = 0
+CHUNK_TYPE_UNCHANGED = 1  # Block equals the one of the previous version.
 
+# Default size of the parts chunks are read in. Others (see lib.tuning)
+# have to divide BLOCK_SIZE of lib.delta, and Reader and Writers have to
+# agree on it.
 CHUNK_PART_SIZE = 64 * 1024  # Bytes
 CHUNK_PART_SPARSE_DATA = b'\0' * CHUNK_PART_SIZE
 CHUNK_PART_TYPE_SPARSE = None
 
+# How the Writer stores a file with a delta base.
+DELTA_REFLINK = 'reflink'  # Clone of the base patched in place.
+DELTA_OBJECT = 'object'  # Only the changed blocks, the rest are holes.
+
+
+def _hash_chunk(chunk, sparse_data=CHUNK_PART_SPARSE_DATA):
+    hash_ = BLOCK_HASH()
+    for part in chunk:
+        hash_.update(sparse_data if part is CHUNK_PART_TYPE_SPARSE else part)
+    return hash_.digest()
+
+
+def _sparse_data(part_size):
+    if part_size == CHUNK_PART_SIZE:
+        return CHUNK_PART_SPARSE_DATA
+    return b'\0' * part_size
+
+
+class Progress(object):
+    '''Files and bytes done and in total of a destination. The totals are
+    set by whoever queues the files, what is done is counted by the Writers
+    of the destination.'''
+
+    def __init__(self):
+        super(Progress, self).__init__()
+        self._lock = Lock()
+        self._counts = dict(files_done=0, files_total=0, bytes_done=0,
+                            bytes_total=0)
+
+    def add(self, key, count):
+        with self._lock:
+            self._counts[key] += count
+
+    def get(self):
+        with self._lock:
+            return dict(self._counts)
+
 
 class Reader(Thread):
 
-    def __init__(self, input_queue, output_queue, sum_bytes):
+    def __init__(self, input_queue, output_queue, sum_bytes,
+                 io_mode=IO_MODE_NORMAL, direct_io_min_size=0,
+                 chunk_size=CHUNK_SIZE, part_size=CHUNK_PART_SIZE, gate=None,
+                 progress=None):
         super(Reader, self).__init__()
         self._input_queue = input_queue
         self._output_queue = output_queue
-        self._sum_bytes = sum_bytes
+        # Of the only target unless the items name their targets. Shared by
+        # the workers of a restore, so that their status reports the
+        # progress of all of them.
+        self._progress = progress or Progress()
+        self._progress.add('bytes_total', sum_bytes)
+        self._bytes_read = 0  # By this Reader only.
+        self._io_mode = io_mode
+        self._direct_io_min_size = direct_io_min_size  # 0 means never.
+        self._chunk_size = chunk_size
+        self._part_size = part_size
+        self._sparse_data = _sparse_data(part_size)
+        self._gate = gate  # threading.Event, cleared while paused.
         self._running = True
         self._is_idle = True
         self._logger = logging.getLogger('copy.reader')
+        self._dev_stats = {}  # dev -> [files, bytes, secs]
 
     def add_more_bytes(self, count):
-        self._sum_bytes += count
+        self._progress.add('bytes_total', count)
+
+    def add_more_files(self, count):
+        self._progress.add('files_total', count)
+
+    def get_progress(self):
+        '''Returns a dict of files_done, files_total, bytes_done and
+        bytes_total of the destination of the Reader.'''
+        return self._progress.get()
 
-    def _read_chunk(self, handle, detect_sparse=False):
+    def get_bytes_read(self):
+        return self._bytes_read
+
+    def _format_global(self, progress):
+        progress = progress.get()
+        sum_bytes = progress['bytes_total']  # Might grow meanwhile.
+        sum_percent = (100.0 / sum_bytes * progress['bytes_done']
+                       if sum_bytes else 0)
+        return 'global %.2f%% of %s' % (sum_percent, human_size(sum_bytes))
+
+    def get_dev_stats(self):
+        '''Returns a dict of dev -> (files, bytes, secs) of the source
+        devices of the items read so far. The time includes waiting for
+        the Writers, so it is the throughput of the whole pipeline.'''
+        return dict((dev, tuple(stats))
+                    for dev, stats in self._dev_stats.items())
+
+    def _wait_gate(self):
+        # Blocks while paused. Returns the secs waited, they do not count
+        # for the stats.
+        gate = self._gate
+        if gate is None or gate.is_set():
+            return 0.0
+        start = time.time()
+        while self._running and not gate.is_set():
+            gate.wait(0.1)
+        return time.time() - start
+
+    def _read_chunk(self, handle, detect_sparse=False, chunk_size=None):
+        chunk_size = chunk_size or self._chunk_size
+        part_size = self._part_size
         cur_size = 0
         chunk = []
         chunk_append = chunk.append
         handle_read = handle.read
-        while cur_size < CHUNK_SIZE:
-            part = handle_read(CHUNK_PART_SIZE)
+        while cur_size < chunk_size:
+            part = handle_read(part_size)
             part_len = len(part)
             if not part_len:
                 break
-            if detect_sparse and part_len == CHUNK_PART_SIZE and part == CHUNK_PART_SPARSE_DATA:
+            if detect_sparse and part_len == part_size and part == self._sparse_data:
                 part = CHUNK_PART_TYPE_SPARSE
             chunk_append(part)
             cur_size += part_len
         return chunk, cur_size
 
+    def _put(self, targets, message):
+        # Every target gets its own copy with its own destination.
+        for target in targets:
+            target['output_queue'].put(dict(message, dst_file=target['dst_file']))
+
+    def _put_meta(self, item, src_dir, src_file, targets, block_hashes=None):
+        # Size and mtime are as seen by the scan. The Writer journals them.
+        for target in targets:
+            target['output_queue'].put(dict(
+                type='meta',
+                src_dir=src_dir,
+                dst_file=target['dst_file'],
+                data=src_file,
+                status=None,
+                size=item['size'],
+                mtime=item.get('mtime'),
+                block_hashes=(block_hashes if target['delta'] is not None
+                              else None),
+                block_size=(target['delta']['block_size']
+                            if target['delta'] is not None else None),
+            ))
+
     def run(self):
         self._logger.debug('Started thread.')
-        sum_bytes = self._sum_bytes
-        sum_bytes_transferred = 0
         read_chunk = self._read_chunk
+        put = self._put
         while self._running:
             try:
                 item = self._input_queue.get(timeout=0.1)
+                self._is_idle = False  # Right away, stop() relies on it.
+                started = time.time()
                 src_dir = item['src_dir']  # Only for makedirs later on.
                 src_file = item['src_file']
-                dst_file = item['dst_file']
                 size = item['size']
                 is_link = item['is_link']
                 is_file = item['is_file']
@@ -75,30 +195,53 @@ class Reader(Thread):
                     src_file = item['src_resolver'](src_file)
                     src_dir = dirname(src_file)
 
+                # Each target is a Writer (see lib.backup.fan_out). Usually
+                # there is only ours.
+                targets = item.get('targets')
+                if targets is None:
+                    targets = [dict(
+                        output_queue=self._output_queue,
+                        dst_file=item['dst_file'],
+                        delta=item.get('delta'),
+                        link_to=item.get('link_to'),  # Extra name of a hard link.
+                        progress=self._progress,
+                    )]
+
                 type_ = 'file'
-                if is_link:
+                if all(target['link_to'] for target in targets):
+                    type_ = 'hardlink'
+                elif is_link:
                     type_ = 'symlink'
                 elif not is_file:
                     type_ = 'special'
                 self._logger.debug('%s|%s' % (type_, src_file))
-                self._is_idle = False
+                started += self._wait_gate()
 
                 try:
-                    if is_link:
-                        self._output_queue.put(dict(
-                            type='symlink',
+                    link_targets = [target for target in targets
+                                    if target['link_to']]
+                    for target in link_targets:
+                        target['output_queue'].put(dict(
+                            type='hardlink',
                             src_dir=src_dir,
-                            dst_file=dst_file,
-                            data=readlink(src_file),
+                            dst_file=target['dst_file'],
+                            data=target['link_to'],
                             status=None,
                         ))
-                        self._output_queue.put(dict(
-                            type='meta',
+                    if link_targets:
+                        self._put_meta(item, src_dir, src_file, link_targets)
+                        targets = [target for target in targets
+                                   if not target['link_to']]
+                    if not targets:
+                        pass  # Only links.
+                    elif is_link:
+                        put(targets, dict(
+                            type='symlink',
                             src_dir=src_dir,
-                            dst_file=dst_file,
-                            data=src_file,
+                            data=readlink(src_file),
                             status=None,
                         ))
+                        self._put_meta(item, src_dir, src_file, targets)
                     elif not is_file:
                         type_ = None
                         mode = os_stat(src_file).st_mode
@@ -110,79 +253,98 @@ class Reader(Thread):
                             type_ = 'fifo'
                         elif stat.S_ISSOCK(mode):
                             type_ = 'socket/pipe'
-                        self._output_queue.put(dict(
+                        put(targets, dict(
                             type='special',
                             src_dir=src_dir,
-                            dst_file=dst_file,
                             data=type_,
                             status=type_,
                         ))
-                        self._output_queue.put(dict(
-                            type='meta',
-                            src_dir=src_dir,
-                            dst_file=dst_file,
-                            data=src_file,
-                            status=None,
-                        ))
+                        self._put_meta(item, src_dir, src_file, targets)
                     elif size == 0:  # Empty file.
-                        percent = 100.0
-                        hsize = human_size(size)
-                        sum_percent = ((100.0 / sum_bytes *
-                                        sum_bytes_transferred)
-                                       if sum_bytes else 0)
-                        sum_hsize = human_size(sum_bytes)
-                        self._output_queue.put(dict(
-                            type='file',
-                            src_dir=src_dir,
-                            dst_file=dst_file,
-                            data=CHUNK_TYPE_EMPTY,
-                            status='file %.2f%% of %s; '
-                                   'global %.2f%% of %s' %
-                                   (percent, hsize, sum_percent,
-                                    sum_hsize),
-                        ))
-                        self._output_queue.put(dict(
-                            type='meta',
-                            src_dir=src_dir,
-                            dst_file=dst_file,
-                            data=src_file,
-                            status=None,
-                        ))
+                        for target in targets:
+                            target['output_queue'].put(dict(
+                                type='file',
+                                src_dir=src_dir,
+                                dst_file=target['dst_file'],
+                                data=CHUNK_TYPE_EMPTY,
+                                status='file 100.00%% of %s; %s' % (
+                                    human_size(size),
+                                    self._format_global(target['progress'])),
+                            ))
+                        self._put_meta(item, src_dir, src_file, targets)
                     else:  # Normal file.
-                        with open(src_file, 'rb') as handle:
+                        # Files with a delta get read block by block. Blocks
+                        # which did not change are not handed to the Writer.
+                        deltas = [target['delta'] for target in targets
+                                  if target['delta'] is not None]
+                        chunk_size = self._chunk_size
+                        block_hashes = None
+                        if deltas:
+                            chunk_size = deltas[0]['block_size']
+                            block_hashes = []
+                        layers = item.get('layers')  # Restoring a delta.
+                        # Only plain files get page cache hints.
+                        advise = False
+                        handle = None
+                        if layers:
+                            handle = DeltaFile(layers, size)
+                        elif (self._direct_io_min_size and
+                                size >= self._direct_io_min_size):
+                            handle = open_direct(src_file)
+                        if handle is None:
+                            handle = open(src_file, 'rb')
+                            advise = True
+                        with handle:
+                            fd = handle.fileno()
+                            readahead = advise and size >= self._chunk_size
+                            if readahead:
+                                advise_sequential(fd)
+                            gentle = advise and self._io_mode == IO_MODE_GENTLE
                             detect_sparse = False
-                            if size >= CHUNK_SIZE:
-                                if os_fstat(handle.fileno()).st_blocks * 512 < size:
+                            if size >= self._chunk_size:
+                                if os_fstat(fd).st_blocks * 512 < size:
                                     detect_sparse = True
-                            chunk, chunk_len = read_chunk(handle, detect_sparse=detect_sparse)  # read chunk
+                            chunk, chunk_len = read_chunk(handle, detect_sparse, chunk_size)  # read chunk
                             bytes_transferred = 0
                             while chunk_len and self._running:
+                                started += self._wait_gate()
+                                if readahead:
+                                    advise_ahead(fd, bytes_transferred + chunk_len)
+                                    if gentle:
+                                        drop(fd, bytes_transferred, chunk_len)
                                 bytes_transferred += chunk_len
                                 percent = 100.0 / size * bytes_transferred
                                 hsize = human_size(size)
-                                sum_bytes_transferred += chunk_len
-                                sum_percent = ((100.0 / sum_bytes *
-                                                sum_bytes_transferred)
-                                               if sum_bytes else 0)
-                                sum_hsize = human_size(sum_bytes)
-                                self._output_queue.put(dict(
-                                    type='file',
-                                    src_dir=src_dir,
-                                    dst_file=dst_file,
-                                    data=chunk,
-                                    status='file %.2f%% of %s; '
-                                           'global %.2f%% of %s' %
-                                           (percent, hsize, sum_percent,
-                                            sum_hsize),
-                                ))
-                                chunk, chunk_len = read_chunk(handle, detect_sparse=detect_sparse)  # read more
-                        self._output_queue.put(dict(
-                            type='meta',
-                            src_dir=src_dir,
-                            dst_file=dst_file,
-                            data=src_file,
-                            status=None,
-                        ))
+                                self._bytes_read += chunk_len
+                                if block_hashes is not None:
+                                    block = len(block_hashes)
+                                    block_hashes.append(_hash_chunk(chunk, self._sparse_data))
+                                for target in targets:
+                                    data = chunk
+                                    delta = target['delta']
+                                    if delta is not None:
+                                        old_hashes = delta['hashes']
+                                        if (block < len(old_hashes) and
+                                                old_hashes[block] == block_hashes[block]):
+                                            data = CHUNK_TYPE_UNCHANGED
+                                    target['output_queue'].put(dict(
+                                        type='file',
+                                        src_dir=src_dir,
+                                        dst_file=target['dst_file'],
+                                        data=data,
+                                        content=chunk,  # Hashed if unchanged.
+                                        length=chunk_len,
+                                        delta=delta,
+                                        status='file %.2f%% of %s; %s' % (
+                                            percent, hsize,
+                                            self._format_global(target['progress'])),
+                                    ))
+                                chunk, chunk_len = read_chunk(handle, detect_sparse, chunk_size)  # read more
+                            if gentle:
+                                drop(fd)
+                        if not chunk_len:  # Not if we got stopped halfway.
+                            self._put_meta(item, src_dir, src_file, targets,
+                                           block_hashes)
                 except Queue.Empty:
                     raise
                 except KeyboardInterrupt:
@@ -190,6 +352,11 @@ class Reader(Thread):
                 except Exception as reason:
                     self._logger.exception(reason)
 
+                stats = self._dev_stats.setdefault(item.get('dev'), [0, 0, 0.0])
+                stats[0] += 1
+                if type_ == 'file':
+                    stats[1] += size
+                stats[2] += time.time() - started
                 self._input_queue.task_done()
             except Queue.Empty:
                 time.sleep(0.1)
@@ -198,34 +365,135 @@ class Reader(Thread):
         self._is_idle = True
 
     def stop(self):
-        if self.is_alive():
-            while not self._input_queue.empty() and not self._is_idle:
-                time.sleep(0.1)
+        # Everything queued gets handled first.
+        while self.is_alive() and not (self._input_queue.empty() and
+                                       self._is_idle):
+            time.sleep(0.1)
         self._running = False
 
 
 class Writer(Thread):
 
-    def __init__(self, input_queue, dirs_need_stats):
+    def __init__(self, input_queue, dirs_need_stats, hash_name=None,
+                 journal=None, dir_cache=None, flusher=None,
+                 io_mode=IO_MODE_NORMAL, part_size=CHUNK_PART_SIZE,
+                 progress=None):
         super(Writer, self).__init__()
         self._input_queue = input_queue
         self._dirs_need_stats = dirs_need_stats
+        # All destination operations go relative to cached dir fds.
+        self._dir_cache = dir_cache or DirCache()
+        self._dst_file = None  # Currently open file.
+        self._failed_file = None  # Last file which could not be written.
+        self._hash_name = hash_name
+        self._journal = journal
+        self._flusher = flusher  # Syncs the completed files if given.
+        # What got written to the destination (see Progress).
+        self._progress = progress or Progress()
+        self._io_mode = io_mode
+        self._part_size = part_size  # Has to be the one of the Reader.
+        self._sparse_data = _sparse_data(part_size)
+        self._write_behind = None
+        self._hash = None
+        self._checksums = []
+        self._delta = None
+        self._delta_mode = None
+        self._block = 0
+        self._changed_blocks = []
+        self._deltas = []
+        self._block_hashes = []
         self._running = True
         self._is_idle = True
         self._num_files = 0
         self._num_symlinks = 0
+        self._num_hardlinks = 0
         self._logger = logging.getLogger('copy.writer')
 
     def _write_chunk(self, handle, chunk):
         # print('got %d parts in chunk' % len(chunk))
+        hash_update = self._hash.update if self._hash else None
+        # Holes would keep the data of a reflinked base.
+        fill_sparse = self._delta_mode == DELTA_REFLINK
         for part in chunk:
+            if fill_sparse and part is CHUNK_PART_TYPE_SPARSE:
+                part = self._sparse_data
             if part is not CHUNK_PART_TYPE_SPARSE:
                 # print('NORMAL')
                 handle.write(part)
+                if hash_update:
+                    hash_update(part)
             else:
                 # print('SPARSE')
-                handle.seek(CHUNK_PART_SIZE, 1)  # 1 means cur file pos.
+                handle.seek(self._part_size, 1)  # 1 means cur file pos.
                 # print(handle.tell())
+                if hash_update:
+                    hash_update(self._sparse_data)
+
+    def _update_hash(self, chunk):
+        hash_update = self._hash.update
+        for part in chunk:
+            hash_update(self._sparse_data if part is CHUNK_PART_TYPE_SPARSE
+                        else part)
+
+    def _open_file(self, dst_file, delta=None):
+        if self._hash_name:
+            self._hash = hashlib.new(self._hash_name)
+        handle = self._dir_cache.open(dst_file)
+        self._dst_file = dst_file
+        if self._io_mode == IO_MODE_GENTLE:
+            self._write_behind = WriteBehind(handle.fileno())
+        self._delta = delta
+        self._delta_mode = None
+        self._block = 0
+        self._changed_blocks = []
+        if delta and delta['hashes']:
+            if delta['base_file'] and reflink(handle, delta['base_file']):
+                self._delta_mode = DELTA_REFLINK
+            else:
+                self._delta_mode = DELTA_OBJECT
+            self._logger.debug('Writing %s delta: %s' %
+                               (self._delta_mode, dst_file))
+        return handle
+
+    def _close_file(self, handle, src_file=None):
+        handle.truncate()
+        hexdigest = None
+        if self._hash and src_file:
+            hexdigest = self._hash.hexdigest()
+            self._checksums.append((src_file, handle.tell(), hexdigest))
+        self._hash = None
+        self._dst_file = None
+        if self._write_behind:
+            handle.flush()
+            self._write_behind.finish()
+            self._write_behind = None
+        handle.close()
+        return hexdigest
+
+    def _replace(self, func, dst_file, *args):
+        # A resumed backup might already contain the entry.
+        try:
+            func(*(args + (dst_file,)))
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+            self._dir_cache.unlink(dst_file)
+            func(*(args + (dst_file,)))
+
+    def get_checksums(self):
+        '''Returns a list of (src_file, size, hexdigest) tuples of all
+        completely written files.'''
+        return self._checksums
+
+    def get_deltas(self):
+        '''Returns a list of (src_file, base_generation, block_size,
+        changed_blocks) tuples of all files written as delta objects.'''
+        return self._deltas
+
+    def get_block_hashes(self):
+        '''Returns a list of (src_file, block_size, hashes) tuples of all
+        completely written files which have been read block by block.'''
+        return self._block_hashes
 
     def run(self):
         self._logger.debug('Started thread.')
@@ -234,6 +502,7 @@ class Writer(Thread):
         while self._running:
             try:
                 item = self._input_queue.get(timeout=0.1)
+                self._is_idle = False  # Right away, stop() relies on it.
                 type_ = item['type']
                 src_dir = item['src_dir']  # Only for makedirs later on.
                 dst_file = item['dst_file']
@@ -247,15 +516,19 @@ class Writer(Thread):
                     self._logger.debug(msg)
                 else:
                     self._logger.info(msg)
-                self._is_idle = False
 
                 try:
-                    if not exists(dirname(dst_file)):
-                        makedirs(dirname(dst_file))
+                    dir_cache = self._dir_cache
+                    if dir_cache.makedirs(dirname(dst_file)):
                         self._dirs_need_stats.append(src_dir)
 
-                    if type_ == 'symlink':
-                        symlink(data, dst_file)
+                    if type_ == 'hardlink':
+                        self._replace(dir_cache.link, dst_file, data)
+                        self._num_hardlinks += 1
+                        self._logger.debug('Created hard link: %s -> %s' %
+                                          (dst_file, data))
+                    elif type_ == 'symlink':
+                        self._replace(dir_cache.symlink, dst_file, data)
                         self._num_symlinks += 1
                         self._logger.debug('Created symlink: %s -> %s' %
                                           (dst_file, data))
@@ -265,51 +538,98 @@ class Writer(Thread):
                         elif data == 'block file':
                             self._logger.warning('Block file is not supported.')
                         elif data == 'fifo':
-                            mknod(dst_file, stat.S_IFIFO)
+                            self._replace(lambda path: dir_cache.mknod(path, stat.S_IFIFO), dst_file)
                             self._num_files += 1
                             self._logger.debug('Created fifo: %s' % dst_file)
                         elif data == 'socket/pipe':
-                            mknod(dst_file, stat.S_IFSOCK)
+                            self._replace(lambda path: dir_cache.mknod(path, stat.S_IFSOCK), dst_file)
                             self._num_files += 1
                             self._logger.debug('Created socket: %s' % dst_file)
                     elif type_ == 'file':
                         if handle is None:
-                            handle = open(dst_file, 'wb')
+                            handle = self._open_file(dst_file, item.get('delta'))
                             self._num_files += 1
                             self._logger.debug('Created file: %s' % dst_file)
-                        elif dst_file != handle.name:
-                            handle.truncate()
-                            handle.close()
-                            handle = open(dst_file, 'wb')
+                        elif dst_file != self._dst_file:
+                            self._close_file(handle)  # Incomplete.
+                            handle = self._open_file(dst_file, item.get('delta'))
                             self._num_files += 1
                             self._logger.debug('Created file: %s' % dst_file)
                         if data is CHUNK_TYPE_EMPTY:
                             pass  # Nothing to write.
+                        elif data is CHUNK_TYPE_UNCHANGED:
+                            # Either in the clone already or a hole which
+                            # gets filled from the base on restore.
+                            handle.seek(item['length'], 1)
+                            if self._hash:  # Checksums cover the whole file.
+                                self._update_hash(item['content'])
+                            self._block += 1
                         else:
                             write_chunk(handle, data)
+                            if self._delta_mode:
+                                self._changed_blocks.append(self._block)
+                            self._block += 1
+                        if self._write_behind:
+                            handle.flush()
+                            self._write_behind.advance(handle.tell())
+                        if data is not CHUNK_TYPE_EMPTY:
+                            self._progress.add('bytes_done', item['length'])
+                    elif type_ == 'meta' and dst_file == self._failed_file:
+                        # Logged already. Must be neither journaled nor
+                        # counted as done.
+                        self._failed_file = None
                     elif type_ == 'meta':
-                        if handle and handle.name == dst_file:
-                            handle.truncate()
-                            handle.close()
+                        hexdigest = None
+                        sync_fd = None
+                        if handle and self._dst_file == dst_file:
+                            if self._delta_mode == DELTA_OBJECT:
+                                self._deltas.append((
+                                    data, self._delta['base_generation'],
+                                    self._delta['block_size'],
+                                    self._changed_blocks))
+                            if self._flusher:
+                                sync_fd = dup(handle.fileno())
+                            hexdigest = self._close_file(handle, data)
                             handle = None
-                        copystat(data, dst_file, follow_symlinks=False)
+                        dir_cache.copystat(data, dst_file)
+                        # Files with block hashes are not journaled as their
+                        # delta information would get lost on resume.
+                        block_hashes = item.get('block_hashes')
+                        entry = None
+                        if block_hashes:
+                            self._block_hashes.append((
+                                data, item['block_size'], block_hashes))
+                        elif self._journal:
+                            entry = (data, item['size'], item['mtime'], hexdigest)
+                        if sync_fd is not None:
+                            # Gets journaled once its data is on disk.
+                            self._flusher.add(sync_fd, entry)
+                        elif entry:
+                            self._journal.add(entry)
+                        # Every file, link and special file ends with one.
+                        self._progress.add('files_done', 1)
                 except KeyboardInterrupt:
                     raise
                 except Exception as reason:
                     self._logger.exception(reason)
+                    if type_ == 'file':
+                        self._failed_file = dst_file
 
                 self._input_queue.task_done()
             except Queue.Empty:
                 self._is_idle = True
                 time.sleep(0.1)
         if handle:
-            handle.truncate()
-            handle.close()
+            self._close_file(handle)  # Incomplete.
+        self._dir_cache.close()
+        if self._journal and not self._flusher:  # Else the Flusher adds.
+            self._journal.flush()
         self._logger.debug('Stopped thread.')
         self._is_idle = True
 
     def stop(self):
-        if self.is_alive():
-            while not self._input_queue.empty() and not self._is_idle:
-                time.sleep(0.1)
+        # Everything queued gets handled first.
+        while self.is_alive() and not (self._input_queue.empty() and
+                                       self._is_idle):
+            time.sleep(0.1)
         self._running = False
@@ -0,0 +1,158 @@
+from os.path import join, dirname, basename
+from os import rename
+from shutil import copystat
+import fcntl
+import struct
+import sqlite3
+import hashlib
+import logging
+import errno
+
+
+logger = logging.getLogger('delta')
+
+# Files are compared in blocks of this size. Has to be a multiple of
+# CHUNK_PART_SIZE of the copy engine.
+BLOCK_SIZE = 4 * 1024 * 1024  # Bytes
+BLOCK_HASH = hashlib.sha1
+BLOCK_HASH_SIZE = BLOCK_HASH().digest_size
+
+# See linux/fs.h.
+FICLONE = 0x40049409
+UNSUPPORTED_ERRNOS = (errno.ENOTTY, errno.EOPNOTSUPP, errno.EXDEV,
+                      errno.EINVAL, errno.EBADF)
+
+READ_SIZE = 1024 * 1024  # Bytes
+
+# Delta objects a file may be stacked of on top of its complete base
+# version. Once reached, the next version gets stored as a complete file, so
+# restoring and browsing never have to open more layers.
+MAX_DELTA_DEPTH = 8
+
+
+def pack_hashes(hashes):
+    return sqlite3.Binary(b''.join(hashes))
+
+
+def unpack_hashes(blob):
+    blob = bytes(blob)
+    return [blob[pos:pos + BLOCK_HASH_SIZE]
+            for pos in range(0, len(blob), BLOCK_HASH_SIZE)]
+
+
+def pack_blocks(blocks):
+    return sqlite3.Binary(struct.pack('<%dI' % len(blocks), *blocks))
+
+
+def unpack_blocks(blob):
+    blob = bytes(blob)
+    return frozenset(struct.unpack('<%dI' % (len(blob) // 4), blob))
+
+
+def reflink(handle, src_file):
+    '''Clones src_file into the open handle. Returns False if the filesystem
+    cannot do that.'''
+    try:
+        with open(src_file, 'rb') as src_handle:
+            fcntl.ioctl(handle.fileno(), FICLONE, src_handle.fileno())
+        return True
+    except (IOError, OSError) as reason:
+        if reason.errno in UNSUPPORTED_ERRNOS:
+            return False
+        raise
+
+
+def get_depth(deltas, generation, path, name):
+    '''Returns the number of delta objects the version of a file stored in
+    generation is made of (see get_layers).'''
+    depth = 0
+    while (generation, path, name) in deltas:
+        generation = deltas[(generation, path, name)][0]
+        depth += 1
+    return depth
+
+
+def get_layers(base_path, deltas, generation, path, name, gen_paths=None):
+    '''Returns the layers needed to read a file stored in generation as a
+    list of (filepath, block_size, changed_blocks) tuples, newest first.
+    The last layer is the complete base version with changed_blocks None.
+
+    deltas is the dict returned by Index.get_deltas. gen_paths maps
+    generations to dirs which are not at their usual place.
+    '''
+    gen_paths = gen_paths or {}
+    rel_file = join(path.lstrip('./'), name)
+    layers = []
+    while True:
+        gen_path = gen_paths.get(generation) or join(base_path, generation)
+        filepath = join(gen_path, rel_file)
+        try:
+            base, block_size, changed = deltas[(generation, path, name)]
+        except KeyError:
+            layers.append((filepath, None, None))
+            return layers
+        layers.append((filepath, block_size, changed))
+        generation = base
+
+
+class DeltaFile(object):
+    '''Read-only file object which reassembles a file from its layers.'''
+
+    def __init__(self, layers, size):
+        super(DeltaFile, self).__init__()
+        self._handles = [(open(filepath, 'rb'), changed)
+                         for filepath, block_size, changed in layers]
+        self._block_size = layers[0][1]
+        self._size = size
+        self._pos = 0
+        self.name = layers[0][0]
+
+    def fileno(self):
+        return self._handles[0][0].fileno()
+
+    def _get_handle(self, block):
+        for handle, changed in self._handles:
+            if changed is None or block in changed:
+                return handle
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._size - self._pos
+        results = []
+        while size > 0 and self._pos < self._size:
+            block = self._pos // self._block_size
+            block_end = min((block + 1) * self._block_size, self._size)
+            length = min(size, block_end - self._pos)
+            handle = self._get_handle(block)
+            handle.seek(self._pos)
+            data = handle.read(length)
+            if len(data) < length:  # Hole at the end of a layer.
+                data += b'\0' * (length - len(data))
+            results.append(data)
+            self._pos += length
+            size -= length
+        return b''.join(results)
+
+    def close(self):
+        for handle, changed in self._handles:
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def materialize(layers, size):
+    '''Replaces the delta object (the first layer) by the complete file.'''
+    filepath = layers[0][0]
+    tmp_filepath = join(dirname(filepath), '.%s.materialize' % basename(filepath))
+    with DeltaFile(layers, size) as src, open(tmp_filepath, 'wb') as dst:
+        data = src.read(READ_SIZE)
+        while data:
+            dst.write(data)
+            data = src.read(READ_SIZE)
+    copystat(filepath, tmp_filepath)
+    rename(tmp_filepath, filepath)
+    logger.info('Materialized delta: %s' % filepath)
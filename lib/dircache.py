@@ -0,0 +1,130 @@
+from os.path import dirname, basename
+from collections import OrderedDict
+from threading import Lock, local
+import os
+import stat
+import errno
+import logging
+
+from lib.dtree import copystat as path_copystat, get_xattrs
+
+
+logger = logging.getLogger('dircache')
+
+# Number of dir fds kept open.
+CACHE_SIZE = 256
+
+# Fall back to plain paths if the platform cannot work relative to a dir fd.
+_HAS_DIR_FD = (hasattr(os, 'supports_dir_fd') and
+               os.open in os.supports_dir_fd and
+               os.symlink in os.supports_dir_fd and
+               os.mknod in os.supports_dir_fd and
+               os.utime in os.supports_dir_fd and
+               os.utime in os.supports_follow_symlinks)
+
+OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+
+
+class DirCache(object):
+    '''Destination side file operations relative to cached dir fds.
+
+    Keeps an LRU cache of open dir fds so that the kernel does not have to
+    resolve the whole path for every file, and remembers the dirs which
+    exist already so that creating them again needs no syscall at all.
+    The set of dirs is shared between threads, the fds are kept per thread
+    so that one thread cannot close those another one is using.
+    '''
+
+    def __init__(self, size=CACHE_SIZE):
+        super(DirCache, self).__init__()
+        self._size = size
+        self._local = local()
+        self._dirs = set()
+        self._lock = Lock()
+
+    def makedirs(self, path):
+        '''Creates path with all parents if needed. Returns True if the dir
+        did not exist before.'''
+        if path in self._dirs:
+            return False
+        created = True
+        try:
+            os.makedirs(path)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+            created = False
+        with self._lock:
+            while path and path not in self._dirs:
+                self._dirs.add(path)
+                path = dirname(path)
+        return created
+
+    def _get_fd(self, path):
+        fds = getattr(self._local, 'fds', None)
+        if fds is None:
+            fds = self._local.fds = OrderedDict()
+        fd = fds.pop(path, None)
+        if fd is None:
+            fd = os.open(path, DIR_FLAGS)
+            while len(fds) >= self._size:
+                os.close(fds.popitem(last=False)[1])
+        fds[path] = fd  # Most recently used.
+        return fd
+
+    def _split(self, path):
+        # Returns the arguments for a call relative to the dir of path.
+        if not _HAS_DIR_FD:
+            return path, {}
+        return basename(path), dict(dir_fd=self._get_fd(dirname(path)))
+
+    def open(self, path):
+        '''Opens path for writing (like open(path, 'wb')).'''
+        name, kwargs = self._split(path)
+        return os.fdopen(os.open(name, OPEN_FLAGS, 0o666, **kwargs), 'wb')
+
+    def symlink(self, target, path):
+        name, kwargs = self._split(path)
+        os.symlink(target, name, **kwargs)
+
+    def link(self, src, path):
+        name, kwargs = self._split(path)
+        if kwargs:
+            kwargs = dict(dst_dir_fd=kwargs['dir_fd'])
+        os.link(src, name, **kwargs)
+
+    def mknod(self, path, mode):
+        name, kwargs = self._split(path)
+        os.mknod(name, mode, **kwargs)
+
+    def unlink(self, path):
+        name, kwargs = self._split(path)
+        os.unlink(name, **kwargs)
+
+    def copystat(self, src, path):
+        '''Like copystat(src, path, follow_symlinks=False).'''
+        if not _HAS_DIR_FD:
+            path_copystat(src, path, follow_symlinks=False)
+            return
+        st = os.lstat(src)
+        name, kwargs = self._split(path)
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(name, stat.S_IMODE(st.st_mode), **kwargs)
+            xattrs = get_xattrs(src)
+            if xattrs:  # Rare, no need for an fd.
+                for key, value in xattrs:
+                    try:
+                        os.setxattr(path, key, value)
+                    except (IOError, OSError) as reason:
+                        logger.debug('Could not set xattr %s: %s' % (key, reason))
+        os.utime(name, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False, **kwargs)
+
+    def close(self):
+        '''Closes the fds of the calling thread.'''
+        fds = getattr(self._local, 'fds', None)
+        if fds:
+            for fd in fds.values():
+                os.close(fd)
+            fds.clear()
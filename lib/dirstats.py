@@ -0,0 +1,141 @@
+from os.path import join, dirname, basename
+import os
+import stat
+import logging
+from threading import Thread
+try:
+    import Queue  # Python 2
+except ImportError:
+    import queue as Queue  # Python 3
+
+from lib.dtree import get_xattrs
+
+
+logger = logging.getLogger('dirstats')
+
+NUM_WORKERS = 4
+
+# Fall back to plain paths if the platform cannot work relative to a dir fd.
+_HAS_DIR_FD = (hasattr(os, 'supports_dir_fd') and
+               os.utime in os.supports_dir_fd and
+               os.chmod in os.supports_dir_fd)
+_IS_ROOT = hasattr(os, 'geteuid') and os.geteuid() == 0
+
+
+def read_dir_stats(path):
+    '''Returns the stats tuple of a dir as stored in the index:
+    (mode, uid, gid, atime, mtime, xattrs)
+    '''
+    st = os.lstat(path)
+    return (st.st_mode, st.st_uid, st.st_gid, st.st_atime, st.st_mtime,
+            get_xattrs(path))
+
+
+def get_ancestors(path):
+    '''Returns path and all of its parents excluding the root dir.'''
+    parts = path.lstrip('./').split('/')
+    results = []
+    while parts and parts[0]:
+        results.append('/' + '/'.join(parts))
+        del parts[-1]
+    return results
+
+
+def _set_xattrs(target, xattrs):
+    for key, value in xattrs:
+        try:
+            os.setxattr(target, key, value)
+        except (IOError, OSError) as reason:
+            # E.g. security.* attributes are reserved to root.
+            logger.debug('Could not set xattr %s: %s' % (key, reason))
+
+
+def _apply(parent_fd, parent, name, stats):
+    mode, uid, gid, atime, mtime, xattrs = stats
+    if parent_fd is None:
+        path = join(parent, name)
+        if _IS_ROOT:
+            os.lchown(path, uid, gid)
+        os.chmod(path, stat.S_IMODE(mode))
+        if xattrs:
+            _set_xattrs(path, xattrs)
+        os.utime(path, (atime, mtime))
+        return
+    if _IS_ROOT:
+        os.chown(name, uid, gid, dir_fd=parent_fd, follow_symlinks=False)
+    os.chmod(name, stat.S_IMODE(mode), dir_fd=parent_fd)
+    if xattrs:
+        fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=parent_fd)
+        try:
+            _set_xattrs(fd, xattrs)
+        finally:
+            os.close(fd)
+    os.utime(name, (atime, mtime), dir_fd=parent_fd, follow_symlinks=False)
+
+
+class Worker(Thread):
+    '''Applies the stats of all given children of a parent dir.'''
+
+    def __init__(self, input_queue):
+        super(Worker, self).__init__()
+        self._input_queue = input_queue
+        self.daemon = True
+
+    def run(self):
+        while True:
+            item = self._input_queue.get()
+            if item is None:
+                self._input_queue.task_done()
+                break
+            parent, children = item
+            parent_fd = None
+            try:
+                if _HAS_DIR_FD:
+                    parent_fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+                for name, stats in children:
+                    try:
+                        _apply(parent_fd, parent, name, stats)
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception as reason:
+                        logger.error('Could not set stats of %s: %s' %
+                                     (join(parent, name), reason))
+            except (IOError, OSError) as reason:
+                logger.error(reason)
+            finally:
+                if parent_fd is not None:
+                    os.close(parent_fd)
+            self._input_queue.task_done()
+
+
+def apply_dir_stats(stats, num_workers=NUM_WORKERS):
+    '''Applies dir stats in one bottom-up pass.
+
+    stats maps destination dirs to stats tuples as returned by
+    read_dir_stats. The dirs are processed level by level starting with the
+    deepest one. Within a level the children of each parent dir are handled
+    as one job relative to the parent's fd and the jobs are spread over the
+    workers. Parents always come after their children, so setting the
+    children's stats cannot touch the parents' mtimes afterwards.
+    '''
+    levels = {}
+    for path, dir_stats in stats.items():
+        path = path.rstrip('/')
+        parent, name = dirname(path), basename(path)
+        depth = path.count('/')
+        levels.setdefault(depth, {}).setdefault(parent, []).append((name, dir_stats))
+    input_queue = Queue.Queue()
+    workers = [Worker(input_queue) for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for depth in sorted(levels, reverse=True):
+            for item in levels[depth].items():
+                input_queue.put(item)
+            input_queue.join()  # Barrier between the levels.
+    finally:
+        for worker in workers:
+            input_queue.put(None)
+        for worker in workers:
+            worker.join()
+    return len(stats)
@@ -2,23 +2,38 @@ from sys import exit, version_info
 from os.path import join, split, islink
 from shutil import copystat as shutil_copystat
 from os import access, R_OK, X_OK
+from operator import attrgetter
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+import os
 import logging
 import re
+import sqlite3
+import struct
 
 
 try:
+    # The fork hands out the lstat results together with the entries.
     from scandir import scandir  # , DirEntry
+    SCANDIR_BACKEND = 'scandir'
 except ImportError:
-    print('ERROR: Please install the scandir package from: '
-          'https://github.com/theblacklion/scandir')
-    print('       You can do so by e.g. invoking the following command:')
-    print('       pip install '
-          'https://github.com/theblacklion/scandir/archive/master.zip')
-    exit(1)
+    try:
+        from os import scandir  # Python 3.5+
+        SCANDIR_BACKEND = 'os'
+    except ImportError:
+        print('ERROR: Please install the scandir package from: '
+              'https://github.com/theblacklion/scandir')
+        print('       You can do so by e.g. invoking the following command:')
+        print('       pip install '
+              'https://github.com/theblacklion/scandir/archive/master.zip')
+        exit(1)
 
 
 logger = logging.getLogger('dtree')
 
+# Files of dirs with more entries get handed out in batches of this size, so
+# that huge flat dirs do not have to fit into memory at once.
+BATCH_SIZE = 10000  # Entries
+
 
 if version_info < (3, 3):
     logger.warn('WARNING: Python version older than 3.3 does not support '
@@ -31,7 +46,134 @@ else:
     copystat = shutil_copystat
 
 
-def _walk(top, excludes, recursive):
+if hasattr(os, 'listxattr'):
+    def get_xattrs(path):
+        '''Returns the extended attributes of path as a list of (name, value)
+        tuples or None if there are none (or they are not supported).
+        '''
+        try:
+            names = os.listxattr(path, follow_symlinks=False)
+            if not names:
+                return None
+            return [(name, os.getxattr(path, name, follow_symlinks=False))
+                    for name in names]
+        except (IOError, OSError):
+            return None
+else:
+    def get_xattrs(path):
+        return None
+
+
+# Packed xattrs start with this, followed by the length of name and value
+# and the bytes of both for each attribute. Older versions pickled them, which
+# is not loaded any more as unpickling may run arbitrary code.
+XATTRS_FORMAT = b'X1'
+XATTR_HEADER = struct.Struct('<HI')
+_warned_format = []  # Warn once only, old backups have plenty of them.
+
+
+if hasattr(os, 'fsencode'):
+    _encode_name, _decode_name = os.fsencode, os.fsdecode
+else:  # Python 2 names are bytes already.
+    _encode_name = _decode_name = lambda name: name
+
+
+def pack_xattrs(xattrs):
+    if not xattrs:
+        return None
+    parts = [XATTRS_FORMAT]
+    for name, value in xattrs:
+        name = _encode_name(name)
+        parts.append(XATTR_HEADER.pack(len(name), len(value)))
+        parts.append(name)
+        parts.append(value)
+    return sqlite3.Binary(b''.join(parts))
+
+
+def unpack_xattrs(blob):
+    if not blob:
+        return None
+    blob = bytes(blob)
+    if not blob.startswith(XATTRS_FORMAT):
+        if not _warned_format:
+            logger.warning('Ignoring xattrs stored in an unsupported format.')
+            _warned_format.append(True)
+        return None
+    xattrs = []
+    offset = len(XATTRS_FORMAT)
+    while offset < len(blob):
+        name_size, value_size = XATTR_HEADER.unpack_from(blob, offset)
+        offset += XATTR_HEADER.size
+        name = blob[offset:offset + name_size]
+        offset += name_size
+        value = blob[offset:offset + value_size]
+        offset += value_size
+        if len(value) != value_size:
+            raise Exception('Packed xattrs are truncated.')
+        xattrs.append((_decode_name(name), value))
+    return xattrs
+
+
+class Entry(object):
+    '''What the scan knows about a dir entry, taken from a single lstat.
+
+    Entries of the same dir share the dir_path string, so the DirEntry
+    objects and stat results can be dropped right after scanning a dir.
+    '''
+
+    __slots__ = ('dir_path', 'name', 'mode', 'inode', 'dev', 'nlink', 'size',
+                 'mtime', 'isfile')
+
+    def __init__(self, dir_path, name, st, isfile):
+        self.dir_path = dir_path
+        self.name = name
+        self.mode = st.st_mode
+        self.inode = st.st_ino
+        self.dev = st.st_dev
+        self.nlink = st.st_nlink
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.isfile = isfile  # Follows symlinks like DirEntry.is_file().
+
+    @property
+    def path(self):
+        return join(self.dir_path, self.name)
+
+    def is_symlink(self):
+        return S_ISLNK(self.mode)
+
+    def is_file(self):
+        return self.isfile
+
+
+class DirRecord(Entry):
+    '''Entry of a dir which also keeps the stats stored per dir.'''
+
+    __slots__ = ('uid', 'gid', 'atime')
+
+    def __init__(self, dir_path, name, st):
+        super(DirRecord, self).__init__(dir_path, name, st, False)
+        self.uid = st.st_uid
+        self.gid = st.st_gid
+        self.atime = st.st_atime
+
+
+def _make_entry(dir_path, entry):
+    st = getattr(entry, '_lstat', None)  # Set by the forked scandir.
+    if st is None:
+        st = entry.stat(follow_symlinks=False)
+    mode = st.st_mode
+    if S_ISLNK(mode):
+        # Symlinks to dirs are listed as dirs (but never entered).
+        if entry.is_dir():
+            return DirRecord(dir_path, entry.name, st)
+        return Entry(dir_path, entry.name, st, entry.is_file())
+    if S_ISDIR(mode):
+        return DirRecord(dir_path, entry.name, st)
+    return Entry(dir_path, entry.name, st, S_ISREG(mode))
+
+
+def _walk(top, excludes, recursive, batch_size):
     dirs = []
     files = []
     if excludes:
@@ -42,43 +184,61 @@ def _walk(top, excludes, recursive):
             return False
     else:
         is_excluded = lambda path: False  # Faster if no excludes given.
+    top_path = top.path
     try:
-        for entry in scandir(top.path):
+        for entry in scandir(top_path):
             if is_excluded(entry.path):
                 logger.info('Excluded path: %s' % entry.path)
                 continue
-            if entry.is_dir():
-                dirs.append(entry)
+            try:
+                record = _make_entry(top_path, entry)
+            except (OSError, IOError) as reason:
+                logger.error(reason)
+                continue
+            if isinstance(record, DirRecord):
+                dirs.append(record)
             else:
-                files.append(entry)
+                files.append(record)
+                if len(files) == batch_size:
+                    yield top, None, files  # The dir itself follows.
+                    files = []
     except Exception as excp:
-        logger.error('Could not completely scan path: %s' % top.path)
+        logger.error('Could not completely scan path: %s' % top_path)
         logger.exception(excp)
     yield top, dirs, files
     if recursive:
         for entry in dirs:
             if not entry.is_symlink():
-                if access(entry.path, R_OK | X_OK):
-                    for x in _walk(entry, excludes, recursive):
+                path = entry.path
+                if access(path, R_OK | X_OK):
+                    for x in _walk(entry, excludes, recursive, batch_size):
                         yield x
                 else:
-                    logger.warning('Could not access dir: %s' % entry.path)
+                    logger.warning('Could not access dir: %s' % path)
 
 
-def walk(path, excludes, recursive=True):
+def walk(path, excludes, recursive=True, batch_size=0):
     dir_path, dir_name = split(path)
     for entry in scandir(dir_path):
         if entry.name == dir_name:
-            return _walk(entry, excludes, recursive)
+            return _walk(_make_entry(dir_path, entry), excludes, recursive,
+                         batch_size)
     raise Exception('Directory "%s" not found in "%s".' % (dir_name, dir_path))
 
 
-def scan(path, excludes=[], recursive=True):
+def scan(path, excludes=[], recursive=True, batch_size=BATCH_SIZE):
+    '''Yields (root, mtime, inode, dirs, files, meta) per dir. root, dirs
+    and files are Entry records.
+
+    Dirs with more than batch_size files (0 means no limit) come in several
+    parts. All but the last one have dirs and meta set to None.'''
     excludes = tuple(map(re.compile, excludes))
-    for root, dirs, files in walk(path, excludes, recursive):
-        stat = root.stat(follow_symlinks=False)
-        mtime = stat.st_mtime
-        inode = stat.st_ino
+    for root, dirs, files in walk(path, excludes, recursive, batch_size):
+        if dirs is None:
+            yield root, root.mtime, root.inode, None, files, None
+            continue
+        meta = (root.mode, root.uid, root.gid, root.atime,
+                pack_xattrs(get_xattrs(root.path)))
         if len(dirs) > 1:
-            dirs.sort(key=lambda item: item.stat(follow_symlinks=False).st_ino)
-        yield root, mtime, inode, dirs, files
+            dirs.sort(key=attrgetter('inode'))
+        yield root, root.mtime, root.inode, dirs, files, meta
@@ -0,0 +1,143 @@
+from ctypes.util import find_library
+from threading import Thread
+import ctypes
+import os
+import time
+import logging
+try:
+    import Queue  # Python 2
+except ImportError:
+    import queue as Queue  # Python 3
+
+from lib.pagecache import drop
+
+
+logger = logging.getLogger('durability')
+
+# Nothing gets synced. A power loss may leave truncated files behind in a
+# generation which has been committed already.
+DURABILITY_NONE = 'none'
+# The data of every written file gets synced in the background. Only synced
+# files are journaled and the filesystem is synced once more before commit.
+DURABILITY_BATCHED = 'batched'
+# The whole filesystem gets synced right before the commit and before files
+# get journaled, see lib.journal.SYNC_INTERVAL.
+DURABILITY_SYNCFS = 'syncfs'
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_BATCHED, DURABILITY_SYNCFS)
+
+# Files are synced in batches of this size. Syncing waits until a file has
+# been closed for FLUSH_LAG seconds, so that the kernel already started to
+# write it back on its own.
+BATCH_SIZE = 64
+FLUSH_LAG = 1.0  # Seconds
+# Number of files the Flusher may fall behind before the Writer has to wait.
+MAX_PENDING = 1024
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(find_library('c'), use_errno=True)
+    return _libc
+
+
+def syncfs(path):
+    '''Flushes everything of the filesystem holding path to disk. Falls back
+    to a global sync if syncfs(2) is not available.'''
+    start = time.time()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        libc = _get_libc()
+        if hasattr(libc, 'syncfs'):
+            if libc.syncfs(fd) != 0:
+                errno_ = ctypes.get_errno()
+                raise OSError(errno_, os.strerror(errno_))
+        elif hasattr(os, 'sync'):
+            os.sync()
+        else:
+            libc.sync()
+    finally:
+        os.close(fd)
+    logger.info('Synced filesystem in %.2f secs.' % (time.time() - start))
+
+
+def fsync_dir(path):
+    '''Makes renames and new entries within the dir persistent.'''
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Flusher(Thread):
+    '''Syncs the data of written files in the background.
+
+    The Writer hands over a duplicate of the fd of every completed file
+    together with a token. Once the data of a file is on disk, on_synced
+    gets called with its token (from within this thread). With drop_cache
+    the synced data gets dropped from the page cache as well.
+    '''
+
+    def __init__(self, on_synced=None, drop_cache=False):
+        super(Flusher, self).__init__()
+        self._queue = Queue.Queue(maxsize=MAX_PENDING)
+        self._on_synced = on_synced
+        self._drop_cache = drop_cache
+        self._logger = logging.getLogger('durability.flusher')
+        self._fdatasync = getattr(os, 'fdatasync', os.fsync)
+        self.num_synced = 0
+        self._stopping = False
+        self.daemon = True
+
+    def add(self, fd, token=None):
+        '''Takes over fd and closes it after syncing.'''
+        self._queue.put((time.time(), fd, token))
+
+    def _sync(self, batch):
+        for added, fd, token in batch:
+            try:
+                self._fdatasync(fd)
+                if self._drop_cache:
+                    drop(fd)
+            except OSError as reason:
+                self._logger.error('Could not sync file: %s' % reason)
+                continue
+            finally:
+                os.close(fd)
+            self.num_synced += 1
+            if token is not None and self._on_synced:
+                self._on_synced(token)
+
+    def run(self):
+        self._logger.debug('Started thread.')
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is None:
+                break
+            delay = item[0] + FLUSH_LAG - time.time()
+            if delay > 0 and not self._stopping:
+                time.sleep(delay)
+            batch = [item]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+            self._sync(batch)
+        self._logger.debug('Stopped thread.')
+
+    def stop(self):
+        '''Syncs all files still pending and stops the thread.'''
+        if self.is_alive():
+            self._stopping = True
+            self._queue.put(None)
+            self.join()
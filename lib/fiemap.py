@@ -0,0 +1,115 @@
+from os import open as os_open, close, O_RDONLY, O_NONBLOCK
+import fcntl
+import struct
+import errno
+import logging
+
+
+logger = logging.getLogger('fiemap')
+
+
+# See linux/fiemap.h and linux/fs.h.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQLLLL')  # start, length, flags, mapped, count, reserved
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')  # logical, physical, length, 2x reserved, flags, 3x reserved
+FIEMAP_MAX_OFFSET = 2 ** 64 - 1
+FIEMAP_EXTENT_UNKNOWN = 0x00000002
+
+# Errors which tell us that the filesystem has no idea of FIEMAP at all.
+UNSUPPORTED_ERRNOS = (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL)
+
+# Batch size used while mapping the pending files of a run.
+BATCH_SIZE = 10000
+
+
+def _query(path):
+    '''Returns the physical byte offset of the first extent of a file.
+
+    Files without any extent (empty, inline or delayed allocation) return
+    None. Raises IOError/OSError if the ioctl fails.
+    '''
+    buf = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(buf, 0, 0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0)
+    fd = os_open(path, O_RDONLY | O_NONBLOCK)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+    finally:
+        close(fd)
+    mapped = FIEMAP_HEADER.unpack_from(buf, 0)[3]
+    if not mapped:
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return extent[1]
+
+
+class ExtentMap(object):
+    '''Caches physical file locations for the duration of a run.
+
+    As soon as the filesystem turns out not to support FIEMAP the map gets
+    disabled and all further lookups return None which makes the callers
+    fall back to inode order.
+    '''
+
+    def __init__(self):
+        super(ExtentMap, self).__init__()
+        self._cache = {}
+        self._supported = True
+        self._logger = logger
+
+    def is_supported(self):
+        return self._supported
+
+    def get_offset(self, path):
+        if not self._supported or path is None:
+            return None
+        try:
+            return self._cache[path]
+        except KeyError:
+            pass
+        try:
+            offset = _query(path)
+        except (IOError, OSError) as reason:
+            if reason.errno in UNSUPPORTED_ERRNOS:
+                self._logger.info('FIEMAP is not supported. '
+                                  'Falling back to inode order.')
+                self._supported = False
+                self._cache.clear()
+            else:
+                self._logger.debug('FIEMAP failed: %s' % reason)
+            offset = None
+        self._cache[path] = offset
+        return offset
+
+    def sort(self, items, key):
+        '''Sorts items in place by physical location.
+
+        The key function has to return a tuple of path (or None if the item
+        must not be mapped) and inode for each item. Items without a known location are put at the end of the list
+        in inode order.
+        '''
+        if not self._supported:
+            return
+        get_offset = self.get_offset
+        unknown = FIEMAP_MAX_OFFSET
+        def sort_key(item):
+            path, inode = key(item)
+            offset = get_offset(path)
+            return (unknown if offset is None else offset, inode)
+        items.sort(key=sort_key)
+        if not self._supported:  # Found out while sorting.
+            items.sort(key=lambda item: key(item)[1])
+
+
+def batched(iterable, size=BATCH_SIZE):
+    batch = []
+    append = batch.append
+    for item in iterable:
+        append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+            append = batch.append
+    if batch:
+        yield batch
@@ -1,29 +1,205 @@
-from os.path import join, exists
-from os import access, R_OK, X_OK
+from os.path import join, exists, split, splitext
+from os import access, remove, R_OK, X_OK
 import sqlite3
 import logging
-from threading import Thread
+from threading import Thread, Semaphore
+from operator import attrgetter
 import time
+import uuid
 try:
     import Queue  # Python 2
 except ImportError:
     import queue as Queue  # Python 3
 
+from lib.dtree import unpack_xattrs
+from lib.delta import pack_hashes, pack_blocks, unpack_blocks
+from lib.snapshot import (Snapshot, write_snapshot, DIFF_ENGINES,
+                          DIFF_ENGINE_SQLITE, DIFF_ENGINE_SNAPSHOT,
+                          STATE_UNCHANGED, STATE_ADDED, STATE_MODIFIED)
+
+
+# Columns added after the initial schema. They get appended in this order to
+# both the base and the cur_ table so that "SELECT *" copies keep working.
+MIGRATIONS = (
+    (('dirs', 'cur_dirs'), 'mode', 'integer'),
+    (('dirs', 'cur_dirs'), 'uid', 'integer'),
+    (('dirs', 'cur_dirs'), 'gid', 'integer'),
+    (('dirs', 'cur_dirs'), 'atime', 'integer'),
+    (('dirs', 'cur_dirs'), 'xattrs', 'blob'),
+    (('files', 'cur_files'), 'dev', 'integer'),
+    (('files', 'cur_files'), 'nlink', 'integer'),
+    (('files', 'cur_files'), 'state', 'integer'),
+)
+
+# Columns of the file rows handed out to Backup and Restore.
+FILE_FIELDS = ('path', 'name', 'mtime', 'size', 'islink', 'isfile', 'inode',
+               'dev', 'nlink')
+CUR_FILE_FIELDS = ', '.join('cur_files.' + field for field in FILE_FIELDS)
+
+# Rules for the order changed files get copied in. Files left pending by
+# the previous run always come first and ties are broken by inode order.
+PRIORITY_INODE = 'inode'  # Nothing but inode order.
+PRIORITY_SMALL = 'small'  # Small files first.
+PRIORITY_RECENT = 'recent'  # Most recently modified first.
+PRIORITY_PATHS = 'paths'  # Files below the given paths first, in their order.
+PRIORITY_RULES = (PRIORITY_INODE, PRIORITY_SMALL, PRIORITY_RECENT, PRIORITY_PATHS)
+
+# Columns of the runs table. The scan of a streaming run includes copying,
+# so it has no scan_secs.
+RUN_FIELDS = ('generation', 'started', 'dirs', 'files', 'changed_files',
+              'changed_bytes', 'scan_secs', 'copy_secs', 'finish_secs',
+              'total_secs')
+
+# Conditions selecting the files of the current scan by how they differ from
+# the previous one. The snapshot engine stores the outcome of its diff in the
+# state column, the SQLite one has to join against the files table.
+DIFF_CONDITIONS = {
+    DIFF_ENGINE_SQLITE: dict(
+        added='''files.mtime IS NULL''',
+        modified='''files.mtime IS NOT NULL
+                    AND files.mtime != cur_files.mtime''',
+        changed='''(files.mtime IS NULL) OR (files.mtime IS NOT NULL
+                   AND files.mtime != cur_files.mtime)''',
+        unmodified='''files.mtime IS NOT NULL
+                      AND files.mtime == cur_files.mtime''',
+    ),
+    DIFF_ENGINE_SNAPSHOT: dict(
+        added='''cur_files.state = %d''' % STATE_ADDED,
+        modified='''cur_files.state = %d''' % STATE_MODIFIED,
+        changed='''cur_files.state IN (%d, %d)''' % (STATE_ADDED, STATE_MODIFIED),
+        unmodified='''cur_files.state = %d''' % STATE_UNCHANGED,
+    ),
+}
+
+# Tables added after the initial schema.
+TABLES = (
+    # Content hashes of the files written into each generation.
+    '''CREATE TABLE IF NOT EXISTS checksums
+       (generation text, path text, name text, size integer, hash text)''',
+    # Block hashes of the large files written into each generation.
+    '''CREATE TABLE IF NOT EXISTS blocks
+       (generation text, path text, name text, block_size integer,
+        hashes blob)''',
+    # Files stored as delta objects. Blocks not listed in changed come from
+    # the version in the base generation.
+    '''CREATE TABLE IF NOT EXISTS deltas
+       (generation text, path text, name text, base text, block_size integer,
+        changed blob)''',
+    # Every version of every file: the generation it got stored in or, if
+    # deleted is set, the generation which noticed that it was gone.
+    '''CREATE TABLE IF NOT EXISTS versions
+       (generation text, path text, name text, size integer, mtime integer,
+        deleted integer)''',
+    # Settings and state of the index itself.
+    '''CREATE TABLE IF NOT EXISTS meta
+       (key text PRIMARY KEY, value text)''',
+    # Statistics of every backup run (see RUN_FIELDS). Durations are in
+    # seconds.
+    '''CREATE TABLE IF NOT EXISTS runs
+       (generation text PRIMARY KEY, started real, dirs integer,
+        files integer, changed_files integer, changed_bytes integer,
+        scan_secs real, copy_secs real, finish_secs real, total_secs real)''',
+    # Files and bytes read per source device within each run and the
+    # seconds the Reader took for them.
+    '''CREATE TABLE IF NOT EXISTS run_devices
+       (generation text, dev integer, files integer, bytes integer,
+        secs real)''',
+    # Changed files a partial generation ran out of time for (as found by
+    # its scan). They are still changed for the next run.
+    '''CREATE TABLE IF NOT EXISTS pending
+       (generation text, path text, name text, size integer, mtime integer)''',
+)
+
+# Tables with per-generation rows of (generation, path, name, ...). Their
+# rows follow the files when generations get merged.
+GENERATION_TABLES = ('checksums', 'blocks', 'deltas', 'versions')
+
+# Tables a backup replaces as a whole and the ones it only adds the rows of
+# its generation to, besides GENERATION_TABLES (see merge_backup).
+REPLACED_TABLES = ('dirs', 'files', 'pending', 'meta')
+RUN_TABLES = ('runs', 'run_devices')
+
+INDEXES = (
+    '''CREATE INDEX IF NOT EXISTS 'checksums_INDEX_generation' ON 'checksums' ('generation' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'blocks_INDEX_path_name' ON 'blocks' ('path' ASC, 'name' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'deltas_INDEX_base' ON 'deltas' ('base' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'versions_INDEX_path_name' ON 'versions' ('path' ASC, 'name' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'versions_INDEX_name' ON 'versions' ('name' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'dirs_INDEX_path' ON 'dirs' ('path' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'cur_dirs_INDEX_path' ON 'cur_dirs' ('path' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'files_INDEX_path_name' ON 'files' ('path' ASC, 'name' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'run_devices_INDEX_dev' ON 'run_devices' ('dev' ASC)''',
+    '''CREATE INDEX IF NOT EXISTS 'pending_INDEX_path_name' ON 'pending' ('path' ASC, 'name' ASC)''',
+)
+
+# Ways of opening an index. Only a backup may clear the tables of the scan,
+# all other tools must leave a running backup alone.
+OPEN_SCAN = 'scan'  # For a backup: migrates and drops any earlier scan.
+OPEN_SHARED = 'shared'  # Writable, but keeps the tables of the scan.
+OPEN_READ_ONLY = 'read_only'  # Neither migrates nor writes anything.
+OPEN_MODES = (OPEN_SCAN, OPEN_SHARED, OPEN_READ_ONLY)
+
+# Number of scanned dirs which may wait for the Feeder by default.
+FEEDER_QUEUE_SIZE = 100000
+
+# Number of file batches of huge dirs (see lib.dtree.BATCH_SIZE) which may
+# wait for the Feeder before the scan has to wait.
+MAX_PENDING_BATCHES = 4
+
 
 class Feeder(Thread):
 
-    def __init__(self, input_queue, db_path):
+    def __init__(self, input_queue, db_path, on_ingest=None, snapshot=None):
         super(Feeder, self).__init__()
         self._input_queue = input_queue
         self._running = True
         self._is_idle = True
         self._logger = logging.getLogger('index.feeder')
         self._db_path = db_path
+        self._on_ingest = on_ingest
+        self._snapshot = snapshot  # Diffs right away if given.
+        self._last_rowid = 0
+        self._batch_slots = Semaphore(MAX_PENDING_BATCHES)
+
+    def put(self, item):
+        '''Queues item. Waits while too many batches of huge dirs are
+        pending, so the thread has to be started before.'''
+        if item['partial']:
+            self._batch_slots.acquire()
+        self._input_queue.put(item)
+
+    def _diff(self, cur, dir_data, partial=False, file_data=None):
+        '''Diffs the just ingested dir (or batch of its files) against the
+        previous backup and hands the result over to the on_ingest
+        callback.'''
+        if partial:
+            dir_changed = False  # Decided once the dir itself comes.
+        else:
+            row = cur.execute('''SELECT mtime FROM dirs WHERE path = ? LIMIT 1''',
+                              (dir_data[0],)).fetchone()
+            dir_changed = row is None or row[0] != dir_data[1]
+        if self._snapshot:  # Already diffed.
+            changed_files = sorted((row[:-1] for row in file_data
+                                    if row[-1] != STATE_UNCHANGED),
+                                   key=lambda row: (row[6], row[7]))
+            self._on_ingest(dir_data, dir_changed, changed_files)
+            return
+        sql = '''SELECT %s FROM cur_files
+                 LEFT JOIN files USING (path, name)
+                 WHERE cur_files.rowid > ?
+                 AND ((files.mtime IS NULL) OR (files.mtime IS NOT NULL
+                 AND files.mtime != cur_files.mtime))
+                 ORDER BY cur_files.inode asc, cur_files.dev asc''' % CUR_FILE_FIELDS
+        changed_files = cur.execute(sql, (self._last_rowid,)).fetchall()
+        self._last_rowid = cur.execute('''SELECT max(rowid) FROM cur_files''').fetchone()[0] or 0
+        self._on_ingest(dir_data, dir_changed, changed_files)
 
     def run(self):
         self._logger.debug('Started thread.')
         self._db_conn = sqlite3.connect(self._db_path)
         cur = self._db_conn.cursor()
+        if self._on_ingest and not self._snapshot:
+            self._last_rowid = cur.execute('''SELECT max(rowid) FROM cur_files''').fetchone()[0] or 0
         while self._running:
             try:
                 item = self._input_queue.get(timeout=0.1)
@@ -32,17 +208,34 @@ class Feeder(Thread):
                 try:
                     dir_data = item['dir_data']
                     file_data = item['file_data']
+                    partial = item['partial']
+
+                    if not partial:
+                        cur.execute('''INSERT INTO cur_dirs
+                                       (path, mtime, inode, mode, uid, gid, atime, xattrs)
+                                       values (?, ?, ?, ?, ?, ?, ?, ?)''', dir_data)
 
-                    cur.execute('''INSERT INTO cur_dirs(path, mtime, inode)
-                                   values (?, ?, ?)''', dir_data)
+                    if self._snapshot:
+                        file_data = self._snapshot.diff(dir_data[0], file_data)
+                        cur.executemany('''INSERT INTO cur_files
+                                           (path, name, mtime, size, islink, isfile, inode,
+                                            dev, nlink, state)
+                                           values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', file_data)
+                    else:
+                        cur.executemany('''INSERT INTO cur_files
+                                           (path, name, mtime, size, islink, isfile, inode,
+                                            dev, nlink)
+                                           values (?, ?, ?, ?, ?, ?, ?, ?, ?)''', file_data)
 
-                    cur.executemany('''INSERT INTO cur_files
-                                       (path, name, mtime, size, islink, isfile, inode)
-                                       values (?, ?, ?, ?, ?, ?, ?)''', file_data)
+                    if self._on_ingest:
+                        self._diff(cur, dir_data, partial, file_data)
                 except KeyboardInterrupt:
                     raise
                 except Exception as reason:
                     self._logger.error(reason)
+                finally:
+                    if item['partial']:
+                        self._batch_slots.release()
 
                 self._input_queue.task_done()
             except Queue.Empty:
@@ -53,12 +246,60 @@ class Feeder(Thread):
         self._is_idle = True
 
     def stop(self):
+        # The idle flag can be stale while the thread sleeps, so the queue
+        # has to be empty as well.
         if self.is_alive():
-            while not self._input_queue.empty() and not self._is_idle:
+            while not (self._input_queue.empty() and self._is_idle):
                 time.sleep(0.1)
         self._running = False
 
 
+class Scanner(Thread):
+    '''Feeds the nodes of one scan into a shared Feeder.'''
+
+    def __init__(self, nodes, feeder, make_item):
+        super(Scanner, self).__init__()
+        self._nodes = nodes
+        self._feeder = feeder
+        self._make_item = make_item
+        self._logger = logging.getLogger('index.scanner')
+
+    def run(self):
+        self._logger.debug('Started thread.')
+        make_item = self._make_item
+        put = self._feeder.put
+        try:
+            for node in self._nodes:
+                put(make_item(node))
+        except Exception as reason:
+            self._logger.exception(reason)
+        self._logger.debug('Stopped thread.')
+
+
+def merge_backup(db_path, src_path, generation):
+    '''Stores what the backup of generation wrote into the index at
+    src_path in the index at db_path, which another tool changed while the
+    backup ran. The latter keeps its other rows, e.g. the ones moved by
+    consolidate.py.'''
+    db_conn = sqlite3.connect(db_path)
+    try:
+        db_conn.execute('''ATTACH DATABASE ? AS src''', (src_path,))
+        with db_conn as cur:
+            for table in REPLACED_TABLES:
+                cur.execute('''DELETE FROM main.%s''' % table)
+                cur.execute('''INSERT INTO main.%s SELECT * FROM src.%s''' %
+                            (table, table))
+            for table in GENERATION_TABLES + RUN_TABLES:
+                cur.execute('''DELETE FROM main.%s WHERE generation = ?''' %
+                            table, (generation,))
+                cur.execute('''INSERT INTO main.%s SELECT * FROM src.%s
+                               WHERE generation = ?''' % (table, table),
+                            (generation,))
+        db_conn.execute('''DETACH DATABASE src''')
+    finally:
+        db_conn.close()
+
+
 class Index(object):
 
     def __init_db(self):
@@ -84,70 +325,140 @@ class Index(object):
             cur.execute('''CREATE INDEX 'files_INDEX_mtime' ON 'files' ('mtime' ASC)''')
             cur.execute('''CREATE INDEX 'cur_files_INDEX_mtime' ON 'cur_files' ('mtime' ASC)''')
 
+    def __migrate_db(self):
+        with self._db_conn as cur:
+            for sql in TABLES:
+                cur.execute(sql)
+            for tables, column, type_ in MIGRATIONS:
+                for table in tables:
+                    columns = [row[1] for row in
+                               cur.execute('''PRAGMA table_info(%s)''' % table)]
+                    if column not in columns:
+                        cur.execute('''ALTER TABLE %s ADD COLUMN %s %s''' %
+                                    (table, column, type_))
+            for sql in INDEXES:
+                cur.execute(sql)
+            if not cur.execute('''SELECT 1 FROM versions LIMIT 1''').fetchone():
+                # Backups made before the catalog existed at least have
+                # their checksums.
+                cur.execute('''INSERT INTO versions
+                               SELECT generation, path, name, size, NULL, 0
+                               FROM checksums''')
+
     def __truncate_tmp_tables(self):
         with self._db_conn as cur:
-            cur.execute('''DELETE FROM cur_dirs''')
-            cur.execute('''DELETE FROM cur_files''')
-            cur.execute('''VACUUM''')
+            num_rows = cur.execute('''DELETE FROM cur_dirs''').rowcount
+            num_rows += cur.execute('''DELETE FROM cur_files''').rowcount
+        # VACUUM must not run within a transaction. Opening an index which
+        # has nothing to clean up stays cheap this way.
+        if num_rows:
+            self._db_conn.execute('''VACUUM''')
+
+    def __open_snapshot(self):
+        # The snapshot only matches the files table if it carries the token
+        # stored along with the latter, else it gets rebuilt.
+        token = self.get_meta('snapshot')
+        snapshot = Snapshot.load(self._snapshot_path, token) if token else None
+        if snapshot is None:
+            self._logger.info('Building snapshot of index.')
+            token = str(uuid.uuid4())
+            write_snapshot(self._snapshot_path, self._db_conn, token)
+            self.set_meta('snapshot', token)
+            snapshot = Snapshot(self._snapshot_path)
+        self._snapshot = snapshot
 
-    def __init__(self, db_path):
+    def __connect_read_only(self):
+        if not exists(self._db_path):
+            raise Exception('Index not found: %s' % self._db_path)
+        uri = 'file:%s?mode=ro' % (self._db_path.replace('%', '%25')
+                                   .replace('?', '%3f').replace('#', '%23'))
+        try:
+            return sqlite3.connect(uri, uri=True)
+        except TypeError:  # Python 2 knows no URIs.
+            conn = sqlite3.connect(self._db_path)
+            conn.execute('''PRAGMA query_only = ON''')
+            return conn
+
+    def __init__(self, db_path, diff_engine=DIFF_ENGINE_SQLITE,
+                 queue_size=FEEDER_QUEUE_SIZE, open_mode=OPEN_SCAN):
         super(Index, self).__init__()
         self._logger = logging.getLogger('index')
         self._db_path = db_path
+        self._queue_size = queue_size
+        if diff_engine not in DIFF_ENGINES:
+            raise Exception('Unknown diff engine: %s' % diff_engine)
+        self._diff_engine = diff_engine
+        if open_mode not in OPEN_MODES:
+            raise Exception('Unknown open mode: %s' % open_mode)
+        self._snapshot = None
+        self._snapshot_path = splitext(db_path)[0] + '.snapshot'
+        self._feeder_queue = None  # Of the running update.
+        if open_mode == OPEN_READ_ONLY:
+            self._db_conn = self.__connect_read_only()
+            self._db_conn.text_factory = str
+            return
         if exists(db_path):
             self._db_conn = sqlite3.connect(db_path)
         else:
             self._db_conn = sqlite3.connect(db_path)
             self.__init_db()
         self._db_conn.text_factory = str
-        self.__truncate_tmp_tables()
+        self.__migrate_db()
+        if open_mode == OPEN_SCAN:
+            self.__truncate_tmp_tables()
+        if diff_engine == DIFF_ENGINE_SNAPSHOT:
+            self.__open_snapshot()
+
+    def _entry_list(self, files):
+        return [(entry.dir_path, entry.name, entry.mtime, entry.size,
+                 entry.is_symlink(), entry.isfile, entry.inode, entry.dev,
+                 entry.nlink) for entry in files]
+
+    def _make_item(self, node):
+        root, root_mtime, root_inode, subdirs, files, root_meta = node
+        if len(files) > 1:
+            files.sort(key=attrgetter('inode'))
+        if subdirs is None:  # Batch of a huge dir, gets sorted on its own.
+            return dict(
+                dir_data=(root.path, root_mtime, root_inode),
+                file_data=self._entry_list(files),
+                partial=True,
+            )
+        return dict(
+            dir_data=(root.path, root_mtime, root_inode) + root_meta,
+            file_data=self._entry_list(files),
+            partial=False,
+        )
 
     def update(self, nodes):
-        # TODO we should save rights, timestamp and owners in the db. Restore should use these.
-        def entry_list(files):
-            results = []
-            for entry in files:
-                try:
-                    try:
-                        stat = entry._lstat
-                        stat.st_mtime
-                    except AttributeError:
-                        stat = entry.stat(follow_symlinks=False)
-                    results.append((entry._scandir_path, entry.name, stat.st_mtime,
-                                    stat.st_size, entry.is_symlink(), entry.is_file(),
-                                    stat.st_ino))
-                except (OSError, IOError) as reason:
-                    self._logger.error(reason)
-            return results
-        queue = Queue.Queue(maxsize=100000)
-        feeder = Feeder(queue, self._db_path)
+        # TODO we should save rights, timestamp and owners of files in the db
+        #      too. Restore should use these.
+        make_item = self._make_item
+        queue = Queue.Queue(maxsize=self._queue_size)
+        self._feeder_queue = queue
+        feeder = Feeder(queue, self._db_path, snapshot=self._snapshot)
         feeder_started = False
         # print('scanning')
         # start = time.time()
-        def sort_key(item):
-            try:
-                return item._lstat.st_ino
-            except AttributeError:
-                return item.stat(follow_symlinks=False).st_ino
-        for root, root_mtime, root_inode, subdirs, files in nodes:
+        for node in nodes:
             # print root, root_mtime, subdirs, files
-            if len(files) > 1:
-                files.sort(key=sort_key)
+            item = make_item(node)
+            if item['partial']:
+                # Batches of huge dirs must not pile up in the queue.
+                if not feeder_started:
+                    feeder.start()
+                    feeder_started = True
+                feeder.put(item)
+                continue
             try:
-                queue.put_nowait(dict(
-                    dir_data=(root.path, root_mtime, root_inode),
-                    file_data=entry_list(files),
-                ))
+                queue.put_nowait(item)
             except Queue.Full:
                 # print('Queue is full.')
                 if not feeder_started:
                     feeder.start()
                     feeder_started = True
                     # print('Waiting for feeder to come up.')
-                queue.put(dict(
-                    dir_data=(root.path, root_mtime, root_inode),
-                    file_data=entry_list(files),
-                ))
+                queue.put(item)
                 time.sleep(1)
                 # print('Continuing scan.')
         # print(time.time() - start)
@@ -159,8 +470,57 @@ class Index(object):
             time.sleep(1)
         feeder.stop()
         feeder.join()
+        self._feeder_queue = None
         # print(time.time() - start)
 
+    @staticmethod
+    def update_many(indexes, nodes):
+        '''Ingests one scan into several indexes (one per destination). Each
+        index has a Feeder of its own.'''
+        make_item = indexes[0]._make_item
+        feeders = []
+        for index in indexes:
+            queue = Queue.Queue(maxsize=index._queue_size)
+            feeder = Feeder(queue, index._db_path, snapshot=index._snapshot)
+            feeder.start()
+            feeders.append((queue, feeder))
+            index._feeder_queue = queue
+        for node in nodes:
+            item = make_item(node)
+            for queue, feeder in feeders:
+                feeder.put(item)
+        for queue, feeder in feeders:
+            feeder.stop()
+            feeder.join()
+        for index in indexes:
+            index._feeder_queue = None
+
+    def update_concurrently(self, scans, on_ingest=None):
+        '''Scans all given trees at the same time into one Feeder.
+
+        If on_ingest is given, every dir gets diffed against the previous
+        backup right after the Feeder ingested it and the callback receives
+        (dir_data, dir_changed, changed_files) while the scan goes on.
+        '''
+        queue = Queue.Queue(maxsize=self._queue_size)
+        self._feeder_queue = queue
+        feeder = Feeder(queue, self._db_path, on_ingest=on_ingest,
+                        snapshot=self._snapshot)
+        feeder.start()
+        scanners = [Scanner(nodes, feeder, self._make_item) for nodes in scans]
+        for scanner in scanners:
+            scanner.start()
+        for scanner in scanners:
+            scanner.join()
+        feeder.stop()
+        feeder.join()
+        self._feeder_queue = None
+
+    def get_feeder_queue_size(self):
+        '''Returns the number of scanned dirs waiting to be ingested.'''
+        queue = self._feeder_queue
+        return queue.qsize() if queue else 0
+
     def get_cur_stats(self):
         cur = self._db_conn.cursor()
         cur.execute('''SELECT count(inode) FROM cur_dirs limit 1''')
@@ -171,19 +531,22 @@ class Index(object):
 
     def get_all_dirs(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_dirs.* FROM cur_dirs'''
+            sql = '''SELECT cur_dirs.path, cur_dirs.mtime, cur_dirs.inode
+                     FROM cur_dirs'''
             return cur.execute(sql)
 
     def get_added_dirs(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_dirs.* FROM cur_dirs
+            sql = '''SELECT cur_dirs.path, cur_dirs.mtime, cur_dirs.inode
+                     FROM cur_dirs
                      LEFT JOIN dirs USING (path)
                      WHERE dirs.mtime IS NULL'''
             return cur.execute(sql)
 
     def get_modified_dirs(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_dirs.* FROM cur_dirs
+            sql = '''SELECT cur_dirs.path, cur_dirs.mtime, cur_dirs.inode
+                     FROM cur_dirs
                      LEFT JOIN dirs USING (path)
                      WHERE dirs.mtime IS NOT NULL
                      AND dirs.mtime != cur_dirs.mtime'''
@@ -191,7 +554,8 @@ class Index(object):
 
     def get_added_or_modified_dirs(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_dirs.* FROM cur_dirs
+            sql = '''SELECT cur_dirs.path, cur_dirs.mtime, cur_dirs.inode
+                     FROM cur_dirs
                      LEFT JOIN dirs USING (path)
                      WHERE (dirs.mtime IS NULL) OR (dirs.mtime IS NOT NULL
                      AND dirs.mtime != cur_dirs.mtime)'''
@@ -199,61 +563,129 @@ class Index(object):
 
     get_selected_dirs = get_all_dirs
 
+    def get_dir_stats(self, paths):
+        '''Returns a dict of path -> (mode, uid, gid, atime, mtime, xattrs) for
+        all given paths which have been scanned with their stats.
+        '''
+        results = {}
+        cur = self._db_conn.cursor()
+        sql = '''SELECT mode, uid, gid, atime, mtime, xattrs FROM cur_dirs
+                 WHERE path = ? AND mode IS NOT NULL LIMIT 1'''
+        for path in paths:
+            row = cur.execute(sql, (path,)).fetchone()
+            if row:
+                results[path] = row[:5] + (unpack_xattrs(row[5]),)
+        return results
+
+    def _diff_sql(self, columns, condition, order=False, priority_terms=()):
+        # Returns the query for the files of the current scan which match
+        # one of DIFF_CONDITIONS.
+        where = DIFF_CONDITIONS[self._diff_engine][condition]
+        if self._diff_engine == DIFF_ENGINE_SNAPSHOT:
+            sql = '''SELECT %s FROM cur_files
+                     WHERE %s''' % (columns, where)
+        else:
+            sql = '''SELECT %s FROM cur_files
+                     LEFT JOIN files USING (path, name)
+                     WHERE %s''' % (columns, where)
+        if order:
+            # Path and name make the order total, see priority_key.
+            sql += ''' ORDER BY %s''' % ', '.join(
+                list(priority_terms) +
+                ['''cur_files.inode asc''', '''cur_files.dev asc''',
+                 '''cur_files.path asc''', '''cur_files.name asc'''])
+        return sql
+
+    @staticmethod
+    def _priority_sql(rules, paths, pending_first=True):
+        # Returns the ORDER BY terms and their arguments for the rules.
+        terms = []
+        if pending_first:
+            terms.append('''EXISTS (SELECT 1 FROM pending
+                              WHERE pending.path = cur_files.path
+                              AND pending.name = cur_files.name) DESC''')
+        args = []
+        for rule in rules:
+            if rule not in PRIORITY_RULES:
+                raise Exception('Unknown priority rule: %s' % rule)
+            if rule == PRIORITY_SMALL:
+                terms.append('''cur_files.size ASC''')
+            elif rule == PRIORITY_RECENT:
+                terms.append('''cur_files.mtime DESC''')
+            elif rule == PRIORITY_PATHS and paths:
+                # Position of the first path the file is below.
+                cases = []
+                for i, path in enumerate(paths):
+                    path = path.rstrip('/')
+                    cases.append('''WHEN cur_files.path = ? OR (cur_files.path >= ?
+                                    AND cur_files.path < ?) THEN %d''' % i)
+                    args += [path, path + '/', path + '0']  # '0' follows '/'.
+                terms.append('''CASE %s ELSE %d END''' % (' '.join(cases),
+                                                         len(paths)))
+        return terms, args
+
     def get_added_files(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_files.* FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE files.mtime IS NULL
-                     ORDER BY cur_files.inode asc'''
-            return cur.execute(sql)
+            return cur.execute(self._diff_sql(CUR_FILE_FIELDS, 'added', True))
 
     def get_modified_files(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_files.* FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE files.mtime IS NOT NULL
-                     AND files.mtime != cur_files.mtime
-                     ORDER BY cur_files.inode asc'''
-            return cur.execute(sql)
+            return cur.execute(self._diff_sql(CUR_FILE_FIELDS, 'modified', True))
+
+    @staticmethod
+    def priority_key(rules, paths):
+        '''Returns a key function which sorts file rows the way
+        get_added_or_modified_files does without pending_first.'''
+        for rule in rules:
+            if rule not in PRIORITY_RULES:
+                raise Exception('Unknown priority rule: %s' % rule)
+        paths = [path.rstrip('/') for path in paths]
+
+        def path_position(dir_path):
+            for i, path in enumerate(paths):
+                if dir_path == path or path + '/' <= dir_path < path + '0':
+                    return i
+            return len(paths)
+
+        def key(row):
+            terms = []
+            for rule in rules:
+                if rule == PRIORITY_SMALL:
+                    terms.append(row[3])
+                elif rule == PRIORITY_RECENT:
+                    terms.append(-row[2])
+                elif rule == PRIORITY_PATHS and paths:
+                    terms.append(path_position(row[0]))
+            return tuple(terms) + (row[6], row[7], row[0], row[1])
+        return key
 
-    def get_added_or_modified_files(self):
+    def get_added_or_modified_files(self, priority=(), priority_paths=(),
+                                    pending_first=True):
+        '''Returns the changed files in the order they should be copied in
+        (see PRIORITY_RULES). Without pending_first the order matches the one
+        of priority_key.'''
+        terms, args = self._priority_sql(priority, priority_paths, pending_first)
         with self._db_conn as cur:
-            sql = '''SELECT cur_files.* FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE (files.mtime IS NULL) OR (files.mtime IS NOT NULL
-                     AND files.mtime != cur_files.mtime)
-                     ORDER BY cur_files.inode asc'''
-            return cur.execute(sql)
+            return cur.execute(self._diff_sql(CUR_FILE_FIELDS, 'changed', True,
+                                              terms), args)
 
     def get_unmodified_files(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_files.* FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE files.mtime IS NOT NULL
-                     AND files.mtime == cur_files.mtime
-                     ORDER BY cur_files.inode asc'''
-            return cur.execute(sql)
+            return cur.execute(self._diff_sql(CUR_FILE_FIELDS, 'unmodified', True))
 
     def get_selected_files(self):
         with self._db_conn as cur:
-            sql = '''SELECT cur_files.* FROM cur_files'''
+            sql = '''SELECT %s FROM cur_files''' % CUR_FILE_FIELDS
             return cur.execute(sql)
 
     def get_added_bytes(self):
         with self._db_conn as cur:
-            sql = '''SELECT sum(cur_files.size) FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE files.mtime IS NULL
-                     LIMIT 1'''
+            sql = self._diff_sql('sum(cur_files.size)', 'added')
             return cur.execute(sql).fetchone()[0] or 0
 
     def get_modified_bytes(self):
         with self._db_conn as cur:
-            sql = '''SELECT sum(cur_files.size) FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE files.mtime IS NOT NULL
-                     AND files.mtime != cur_files.mtime
-                     LIMIT 1'''
+            sql = self._diff_sql('sum(cur_files.size)', 'modified')
             return cur.execute(sql).fetchone()[0] or 0
 
     def get_selected_bytes(self):
@@ -264,20 +696,12 @@ class Index(object):
 
     def get_added_or_modified_bytes(self):
         with self._db_conn as cur:
-            sql = '''SELECT sum(cur_files.size) FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE (files.mtime IS NULL) OR (files.mtime IS NOT NULL
-                     AND files.mtime != cur_files.mtime)
-                     LIMIT 1'''
+            sql = self._diff_sql('sum(cur_files.size)', 'changed')
             return cur.execute(sql).fetchone()[0] or 0
 
     def get_num_added_or_modified_dirs_or_files(self):
         with self._db_conn as cur:
-            sql = '''SELECT count(cur_files.inode) FROM cur_files
-                     LEFT JOIN files USING (path, name)
-                     WHERE (files.mtime IS NULL) OR (files.mtime IS NOT NULL
-                     AND files.mtime != cur_files.mtime)
-                     LIMIT 1'''
+            sql = self._diff_sql('count(cur_files.inode)', 'changed')
             num_files = cur.execute(sql).fetchone()[0]
         with self._db_conn as cur:
             sql = '''SELECT count(cur_dirs.inode) FROM cur_dirs
@@ -288,6 +712,324 @@ class Index(object):
             num_dirs = cur.execute(sql).fetchone()[0]
         return num_files + num_dirs
 
+    def get_changed_by_device(self):
+        '''Returns (dev, files, bytes) rows of the added and modified files
+        of the current scan.'''
+        with self._db_conn as cur:
+            sql = self._diff_sql('''cur_files.dev, count(cur_files.inode),
+                                    sum(cur_files.size)''', 'changed')
+            sql += ''' GROUP BY cur_files.dev ORDER BY cur_files.dev'''
+            return [(dev, files, bytes_ or 0)
+                    for dev, files, bytes_ in cur.execute(sql)]
+
+    def keep_pending(self, generation, pending):
+        '''Records the (path, name) pairs of changed files which have not
+        been copied and makes them look unchanged for this generation: they
+        get their previous size and mtime back or, if they are new, are left
+        out. So they are found as changed again by the next run. Replaces
+        what the previous run left pending and has to be called before
+        add_versions.'''
+        with self._db_conn as cur:
+            cur.execute('''DELETE FROM pending''')
+            sql = '''INSERT INTO pending (generation, path, name) VALUES (?, ?, ?)'''
+            cur.executemany(sql, ((generation, path, name) for path, name in pending))
+            if not pending:
+                return
+            sql = '''UPDATE pending SET
+                     size = (SELECT size FROM cur_files
+                             WHERE cur_files.path = pending.path
+                             AND cur_files.name = pending.name),
+                     mtime = (SELECT mtime FROM cur_files
+                              WHERE cur_files.path = pending.path
+                              AND cur_files.name = pending.name)'''
+            cur.execute(sql)
+            is_pending = '''EXISTS (SELECT 1 FROM pending
+                                    WHERE pending.path = cur_files.path
+                                    AND pending.name = cur_files.name)'''
+            sql = '''UPDATE cur_files SET
+                     size = (SELECT size FROM files
+                             WHERE files.path = cur_files.path
+                             AND files.name = cur_files.name),
+                     mtime = (SELECT mtime FROM files
+                              WHERE files.path = cur_files.path
+                              AND files.name = cur_files.name),
+                     state = %d
+                     WHERE %s AND EXISTS (SELECT 1 FROM files
+                                          WHERE files.path = cur_files.path
+                                          AND files.name = cur_files.name)''' % (
+                STATE_UNCHANGED, is_pending)
+            cur.execute(sql)
+            sql = '''DELETE FROM cur_files
+                     WHERE %s AND NOT EXISTS (SELECT 1 FROM files
+                                              WHERE files.path = cur_files.path
+                                              AND files.name = cur_files.name)''' % is_pending
+            cur.execute(sql)
+
+    def get_pending(self):
+        '''Returns (generation, path, name, size, mtime) rows of the files
+        the last run left pending.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT generation, path, name, size, mtime FROM pending
+                 ORDER BY path, name'''
+        return cur.execute(sql).fetchall()
+
+    def add_checksums(self, generation, checksums):
+        '''Stores (src_file, size, hexdigest) tuples as written by the Writer.'''
+        with self._db_conn as cur:
+            sql = '''INSERT INTO checksums (generation, path, name, size, hash)
+                     VALUES (?, ?, ?, ?, ?)'''
+            cur.executemany(sql, ((generation,) + split(src_file) + (size, hash_)
+                                  for src_file, size, hash_ in checksums))
+
+    def add_versions(self, generation):
+        '''Records the added, modified and deleted files of the current scan
+        in the version catalog. Has to be called before commit.'''
+        with self._db_conn as cur:
+            sql = 'INSERT INTO versions ' + self._diff_sql(
+                '''?, cur_files.path, cur_files.name, cur_files.size,
+                   cur_files.mtime, 0''', 'changed')
+            cur.execute(sql, (generation,))
+            if self._snapshot:
+                sql = '''INSERT INTO versions VALUES (?, ?, ?, NULL, NULL, 1)'''
+                cur.executemany(sql, ((generation, path, name) for path, name
+                                      in self._snapshot.get_deleted()))
+            else:
+                sql = '''INSERT INTO versions
+                         SELECT ?, files.path, files.name, NULL, NULL, 1 FROM files
+                         LEFT JOIN cur_files USING (path, name)
+                         WHERE cur_files.mtime IS NULL'''
+                cur.execute(sql, (generation,))
+
+    def get_history(self, path, name):
+        '''Returns (generation, size, mtime, deleted) rows of all versions of
+        a file, oldest first.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT generation, size, mtime, deleted FROM versions
+                 WHERE path = ? AND name = ?
+                 ORDER BY CAST(generation AS REAL) ASC, deleted ASC'''
+        return cur.execute(sql, (path, name)).fetchall()
+
+    def find_versions(self, pattern, path=None, limit=-1):
+        '''Returns (path, name, generation, size, mtime, deleted) rows of all
+        versions of the files whose name matches the glob pattern, optionally
+        only below path.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT path, name, generation, size, mtime, deleted
+                 FROM versions WHERE name GLOB ?'''
+        args = [pattern]
+        if path:
+            # Range instead of LIKE so that the index gets used.
+            path = path.rstrip('/')
+            sql += ''' AND (path = ? OR (path >= ? AND path < ?))'''
+            args += [path, path + '/', path + '0']  # '0' follows '/'.
+        sql += ''' ORDER BY path, name, CAST(generation AS REAL) ASC, deleted ASC
+                   LIMIT ?'''
+        args.append(limit)
+        return cur.execute(sql, args).fetchall()
+
+    def get_version(self, path, name, generation):
+        '''Returns (generation, size, mtime) of the version of a file which
+        is current as of generation or None if there is none by then.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT generation, size, mtime, deleted FROM versions
+                 WHERE path = ? AND name = ? AND CAST(generation AS REAL) <= ?
+                 ORDER BY CAST(generation AS REAL) DESC, deleted DESC LIMIT 1'''
+        row = cur.execute(sql, (path, name, float(generation))).fetchone()
+        if row is None or row[3]:
+            return None
+        return row[:3]
+
+    def list_versions(self, path, generation):
+        '''Returns (name, generation, size, mtime) rows of the files within
+        path as of generation, sorted by name.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT name, generation, size, mtime, deleted FROM versions
+                 WHERE path = ? AND CAST(generation AS REAL) <= ?
+                 ORDER BY name, CAST(generation AS REAL) DESC, deleted DESC'''
+        rows = []
+        last_name = None
+        for name, generation_, size, mtime, deleted in \
+                cur.execute(sql, (path, float(generation))):
+            if name == last_name:
+                continue  # Older version.
+            last_name = name
+            if not deleted:
+                rows.append((name, generation_, size, mtime))
+        return rows
+
+    def list_version_dirs(self, path, generation):
+        '''Returns the sorted names of the dirs within path which hold at
+        least one file as of generation. Dirs without any files below them
+        are not part of the catalog.'''
+        cur = self._db_conn.cursor()
+        prefix = path.rstrip('/') + '/'
+        end = path.rstrip('/') + '0'  # '0' follows '/'.
+        next_sql = '''SELECT path FROM versions WHERE path > ? AND path < ?
+                      ORDER BY path LIMIT 1'''
+        # Some file below has to be there and not deleted by generation.
+        live_sql = '''SELECT 1 FROM versions AS v
+                      WHERE (v.path = ? OR (v.path >= ? AND v.path < ?))
+                      AND v.deleted = 0 AND CAST(v.generation AS REAL) <= ?
+                      AND NOT EXISTS (SELECT 1 FROM versions AS newer
+                          WHERE newer.path = v.path AND newer.name = v.name
+                          AND newer.deleted = 1
+                          AND CAST(newer.generation AS REAL) > CAST(v.generation AS REAL)
+                          AND CAST(newer.generation AS REAL) <= ?)
+                      LIMIT 1'''
+        names = []
+        seen = set()
+        position = prefix
+        while True:
+            # Skips from dir to dir instead of reading every row below path.
+            row = cur.execute(next_sql, (position, end)).fetchone()
+            if row is None:
+                break
+            name = row[0][len(prefix):].split('/', 1)[0]
+            dir_path = prefix + name
+            # Siblings like "a-b" sort between "a" and "a/...".
+            position = row[0] if row[0] == dir_path else dir_path + '0'
+            if name in seen:
+                continue
+            seen.add(name)
+            if cur.execute(live_sql, (dir_path, dir_path + '/', dir_path + '0',
+                                      float(generation), float(generation))).fetchone():
+                names.append(name)
+        return sorted(names)
+
+    def get_checksums(self, generation, position=0, limit=-1):
+        '''Returns (rowid, path, name, size, hash) rows of a generation which
+        come after position.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT rowid, path, name, size, hash FROM checksums
+                 WHERE generation = ? AND rowid > ?
+                 ORDER BY rowid ASC LIMIT ?'''
+        return cur.execute(sql, (generation, position, limit)).fetchall()
+
+    def add_block_hashes(self, generation, block_hashes):
+        '''Stores (src_file, block_size, hashes) tuples as written by the
+        Writer.'''
+        with self._db_conn as cur:
+            sql = '''INSERT INTO blocks (generation, path, name, block_size, hashes)
+                     VALUES (?, ?, ?, ?, ?)'''
+            cur.executemany(sql, ((generation,) + split(src_file) +
+                                  (block_size, pack_hashes(hashes))
+                                  for src_file, block_size, hashes in block_hashes))
+
+    def get_block_hashes(self):
+        '''Returns a dict of (path, name) -> (generation, block_size, hashes)
+        holding the newest stored version of each file.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT path, name, generation, block_size, hashes FROM blocks
+                 ORDER BY CAST(generation AS REAL) ASC'''
+        return dict((row[:2], row[2:]) for row in cur.execute(sql))
+
+    def add_deltas(self, generation, deltas):
+        '''Stores (src_file, base, block_size, changed_blocks) tuples as
+        written by the Writer.'''
+        with self._db_conn as cur:
+            sql = '''INSERT INTO deltas (generation, path, name, base, block_size, changed)
+                     VALUES (?, ?, ?, ?, ?, ?)'''
+            cur.executemany(sql, ((generation,) + split(src_file) +
+                                  (base, block_size, pack_blocks(changed))
+                                  for src_file, base, block_size, changed in deltas))
+
+    def get_deltas(self):
+        '''Returns a dict of (generation, path, name) ->
+        (base, block_size, changed_blocks).'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT generation, path, name, base, block_size, changed
+                 FROM deltas'''
+        return dict((row[:3], (row[3], row[4], unpack_blocks(row[5])))
+                    for row in cur.execute(sql))
+
+    def get_deltas_on(self, base):
+        '''Returns (generation, path, name) rows of all deltas which need
+        the given generation.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT generation, path, name FROM deltas WHERE base = ?'''
+        return cur.execute(sql, (base,)).fetchall()
+
+    def remove_delta(self, generation, path, name):
+        with self._db_conn as cur:
+            sql = '''DELETE FROM deltas
+                     WHERE generation = ? AND path = ? AND name = ?'''
+            cur.execute(sql, (generation, path, name))
+
+    def get_meta(self, key, default=None):
+        cur = self._db_conn.cursor()
+        row = cur.execute('''SELECT value FROM meta WHERE key = ?''',
+                          (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._db_conn as cur:
+            cur.execute('''INSERT OR REPLACE INTO meta (key, value)
+                           VALUES (?, ?)''', (key, value))
+
+    def renew_id(self):
+        '''Gives the index a new id so that local copies of it (see
+        IndexCache) know that they are outdated. Has to be called after
+        every change.'''
+        index_id = uuid.uuid4().hex
+        self.set_meta('id', index_id)
+        return index_id
+
+    def add_run(self, run, devices):
+        '''Stores the statistics of a run, a dict with the keys of
+        RUN_FIELDS, and a dict of dev -> (files, bytes, secs) read from each
+        source device.'''
+        with self._db_conn as cur:
+            sql = '''INSERT OR REPLACE INTO runs (%s) VALUES (%s)''' % (
+                ', '.join(RUN_FIELDS), ', '.join('?' * len(RUN_FIELDS)))
+            cur.execute(sql, [run.get(field) for field in RUN_FIELDS])
+            sql = '''INSERT INTO run_devices (generation, dev, files, bytes, secs)
+                     VALUES (?, ?, ?, ?, ?)'''
+            cur.executemany(sql, ((run['generation'], dev) + tuple(stats)
+                                  for dev, stats in devices.items()))
+
+    def get_runs(self, limit=-1):
+        '''Returns rows of RUN_FIELDS of the last runs, newest first.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT %s FROM runs ORDER BY started DESC LIMIT ?''' % \
+            ', '.join(RUN_FIELDS)
+        return cur.execute(sql, (limit,)).fetchall()
+
+    def get_device_runs(self, dev=None, limit=-1):
+        '''Returns (files, bytes, secs) rows of what the last runs read from
+        a source device or, if dev is None, from any.'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT run_devices.files, run_devices.bytes, run_devices.secs
+                 FROM run_devices JOIN runs USING (generation)'''
+        args = []
+        if dev is not None:
+            sql += ''' WHERE run_devices.dev = ?'''
+            args.append(dev)
+        sql += ''' ORDER BY runs.started DESC LIMIT ?'''
+        args.append(limit)
+        return cur.execute(sql, args).fetchall()
+
+    def move_generation(self, source, target, is_moved):
+        '''Reassigns the rows of a merged generation. Rows of files which got
+        moved into target (is_moved(path, name) returns True) now belong to
+        target, the others have been superseded and are dropped.'''
+        with self._db_conn as cur:
+            # Deletions are kept as long as the target knows nothing newer.
+            sql = '''UPDATE versions SET generation = ?
+                     WHERE generation = ? AND deleted = 1 AND NOT EXISTS
+                     (SELECT 1 FROM versions AS newer
+                      WHERE newer.generation = ? AND newer.path = versions.path
+                      AND newer.name = versions.name)'''
+            cur.execute(sql, (target, source, target))
+            # Lets SQLite ask for each row instead of loading them all.
+            self._db_conn.create_function('is_moved', 2,
+                                          lambda path, name: int(is_moved(path, name)))
+            for table in GENERATION_TABLES:
+                sql = '''UPDATE %s SET generation = ?
+                         WHERE generation = ? AND is_moved(path, name)''' % table
+                cur.execute(sql, (target, source))
+                sql = '''DELETE FROM %s WHERE generation = ?''' % table
+                cur.execute(sql, (source,))
+
     def __truncate_base_tables(self):
         with self._db_conn as cur:
             cur.execute('''DELETE FROM dirs''')
@@ -304,6 +1046,20 @@ class Index(object):
         self.__truncate_base_tables()
         self.__migrate_table_data()
         self.__truncate_tmp_tables()
+        if self._snapshot:
+            # The next run diffs against what just became the files table.
+            self._snapshot.close()
+            token = str(uuid.uuid4())
+            write_snapshot(self._snapshot_path, self._db_conn, token)
+            self.set_meta('snapshot', token)
+            self._snapshot = Snapshot(self._snapshot_path)
+        else:
+            # The snapshot no longer matches the files table. Dropping its
+            # token makes the next run with the snapshot engine rebuild it.
+            with self._db_conn as cur:
+                cur.execute('''DELETE FROM meta WHERE key = ?''', ('snapshot',))
+            if exists(self._snapshot_path):
+                remove(self._snapshot_path)
 
     def select(self, path):
         with self._db_conn as cur:
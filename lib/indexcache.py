@@ -0,0 +1,139 @@
+from os.path import exists, join, realpath
+from os import makedirs, remove, rename, stat
+from shutil import copyfile
+import sqlite3
+import hashlib
+import logging
+import time
+
+from lib.index import merge_backup
+
+
+# Number of pages copied per step by the online backup API.
+BACKUP_PAGES = 4096
+
+# Times the write back starts over if the index on the destination changes
+# while it runs.
+WRITE_BACK_ATTEMPTS = 5
+
+
+def _read_id(db_path):
+    db_conn = sqlite3.connect(db_path)
+    try:
+        row = db_conn.execute('''SELECT value FROM meta WHERE key = ?''',
+                              ('id',)).fetchone()
+    except sqlite3.OperationalError:  # Older index without meta table.
+        row = None
+    finally:
+        db_conn.close()
+    return row[0] if row else None
+
+
+def _get_state(db_path):
+    # Changes with every write, also of indexes without an id.
+    if not exists(db_path):
+        return None
+    st = stat(db_path)
+    return _read_id(db_path), st.st_mtime, st.st_size
+
+
+def _get_tmp_path(dst_path):
+    tmp_path = dst_path + '.tmp'
+    if exists(tmp_path):
+        remove(tmp_path)
+    return tmp_path
+
+
+def _copy_to(src_path, tmp_path):
+    src_conn = sqlite3.connect(src_path)
+    try:
+        if hasattr(src_conn, 'backup'):  # Python 3.7+
+            dst_conn = sqlite3.connect(tmp_path)
+            try:
+                src_conn.backup(dst_conn, pages=BACKUP_PAGES)
+            finally:
+                dst_conn.close()
+        else:
+            copyfile(src_path, tmp_path)
+    finally:
+        src_conn.close()
+
+
+def _copy(src_path, dst_path):
+    # Copies into a temporary file first so that dst_path is never half
+    # written.
+    tmp_path = _get_tmp_path(dst_path)
+    _copy_to(src_path, tmp_path)
+    rename(tmp_path, dst_path)
+
+
+class IndexCache(object):
+    '''Keeps the working copy of the index on fast local storage.
+
+    The copy is only used while its id (see Index.renew_id) matches the one
+    of the index on the destination, else it gets fetched again. After the
+    backup the copy is written back in one go. If the index on the
+    destination has been changed meanwhile (e.g. by consolidate.py), what the
+    backup stored gets merged into it instead.
+    '''
+
+    def __init__(self, db_path, cache_path):
+        super(IndexCache, self).__init__()
+        self._db_path = db_path
+        self._cache_path = cache_path
+        # One copy per destination.
+        name = hashlib.sha1(realpath(db_path).encode('utf-8')).hexdigest()[:16]
+        self._local_path = join(cache_path, 'index-%s.sqlite3' % name)
+        self._logger = logging.getLogger('indexcache')
+        self._db_state = None  # Of the index on the destination when opened.
+
+    def open(self):
+        '''Returns the path of the local copy to work with.'''
+        if not exists(self._cache_path):
+            makedirs(self._cache_path)
+        self._db_state = _get_state(self._db_path)
+        if not exists(self._db_path):
+            if exists(self._local_path):
+                remove(self._local_path)  # Belongs to a vanished index.
+            return self._local_path
+        if exists(self._local_path):
+            local_id = _read_id(self._local_path)
+            if local_id and local_id == _read_id(self._db_path):
+                self._logger.info('Using cached index: %s' % self._local_path)
+                return self._local_path
+            self._logger.info('Cached index is outdated.')
+        start = time.time()
+        _copy(self._db_path, self._local_path)
+        self._logger.info('Fetched index into cache in %.2f secs.' %
+                          (time.time() - start))
+        return self._local_path
+
+    def write_back(self, generation):
+        '''Replaces the index on the destination by the local copy, or
+        merges the rows of the generation into it if it changed since
+        open. Either way the local copy matches it afterwards.'''
+        start = time.time()
+        for attempt in range(WRITE_BACK_ATTEMPTS):
+            db_state = _get_state(self._db_path)
+            tmp_path = _get_tmp_path(self._db_path)
+            merged = db_state != self._db_state
+            if merged:
+                self._logger.info('Index on destination changed during the '
+                                  'backup, merging into it.')
+                _copy_to(self._db_path, tmp_path)
+                merge_backup(tmp_path, self._local_path, generation)
+            else:
+                _copy_to(self._local_path, tmp_path)
+            # Anything changed while copying would get lost by the rename.
+            if _get_state(self._db_path) == db_state:
+                rename(tmp_path, self._db_path)
+                break
+            remove(tmp_path)
+        else:
+            raise Exception('Index on destination keeps changing, could not '
+                            'write it back: %s' % self._db_path)
+        if merged:
+            _copy(self._db_path, self._local_path)
+        self._db_state = _get_state(self._db_path)
+        self._logger.info('Wrote index back in %.2f secs.' %
+                          (time.time() - start))
@@ -0,0 +1,772 @@
+from os.path import join, exists
+from threading import Thread, Event, RLock
+from time import time
+import gzip
+import logging
+
+from lib.config import get_config, get_destinations
+from lib.dtree import scan
+from lib.index import Index, FEEDER_QUEUE_SIZE, OPEN_READ_ONLY
+from lib.indexcache import IndexCache
+from lib.backup import Backup, fan_out
+from lib.restore import Restore
+from lib.human_size import human_size
+from lib.runstats import HISTORY_RUNS, predict, format_dev, format_rate
+from lib.status import Status, StatusServer, get_socket_path
+from lib.tuning import Calibration
+from lib.util import expandvars
+from lib import volume, power
+
+
+STATE_NEW = 'new'
+STATE_RUNNING = 'running'
+STATE_PAUSED = 'paused'
+STATE_CANCELLING = 'cancelling'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STATE_CANCELLED = 'cancelled'
+FINAL_STATES = (STATE_DONE, STATE_FAILED, STATE_CANCELLED)
+
+COMMAND_RUN = 'run'
+COMMAND_PLAN = 'plan'
+COMMANDS = (COMMAND_RUN, COMMAND_PLAN)
+
+# Restore workers used if restore_workers is "auto" and tuning is disabled.
+RESTORE_WORKERS = 4
+
+
+class Cancelled(Exception):
+    '''Raised within a job at the first checkpoint after it got cancelled.'''
+
+
+def call_directly(func, *args):
+    '''Dispatcher for jobs run without an event loop.'''
+    func(*args)
+
+
+def asyncio_dispatcher(loop):
+    '''Returns a dispatcher which calls back within the thread of an asyncio
+    loop.'''
+    return lambda func, *args: loop.call_soon_threadsafe(func, *args)
+
+
+def glib_dispatcher():
+    '''Returns a dispatcher which calls back within the GLib main loop, e.g.
+    the one of a Gtk.Application.'''
+    # Loaded only here as importing gi takes its time.
+    from gi.repository import GLib
+
+    def dispatch(func, *args):
+        def call():
+            func(*args)
+            return False  # Only once.
+        GLib.idle_add(call)
+    return dispatch
+
+
+def asyncio_future(job, loop):
+    '''Returns an asyncio future which gets the job once it is finished.
+    The job has to dispatch to the same loop.'''
+    future = loop.create_future()
+
+    def on_event(job_, event, value):
+        if event == 'state' and value in FINAL_STATES and not future.done():
+            future.set_result(job_)
+    job.connect(on_event)
+    if job.get_state() in FINAL_STATES and not future.done():
+        future.set_result(job)
+    return future
+
+
+class Job(object):
+    '''A backup or restore which can run in a thread of its own, so that an
+    event loop can drive it.
+
+    Listeners added with connect get called as listener(job, event, value)
+    through the dispatcher: "stage" with every new stage and "state" with
+    every new state. With asyncio_dispatcher or glib_dispatcher they run
+    within the loop and the job does not wait for them. get_status returns
+    the progress at any time.
+
+    pause holds the scan before its next dir and copying before its next
+    chunk. cancel stops at the next checkpoint without committing anything:
+    an interrupted backup gets resumed by the next run. Finishing a backup
+    is not interrupted once it began.
+    '''
+
+    def __init__(self, kind, dispatch=call_directly):
+        super(Job, self).__init__()
+        self._kind = kind
+        self._dispatch = dispatch
+        self._listeners = []
+        self._status = Status(kind)
+        self._state = STATE_NEW
+        self._stage = None
+        self._error = None
+        self._thread = None
+        self._started = False
+        self._resumed = Event()  # Cleared while paused.
+        self._resumed.set()
+        self._cancelled = False
+        self._workers = []  # Backups and Restores which copy.
+        self._lock = RLock()  # Listeners may call back right away.
+        self._logger = logging.getLogger('jobs.%s' % kind)
+
+    def connect(self, listener):
+        self._listeners.append(listener)
+
+    def _emit(self, event, value):
+        for listener in list(self._listeners):
+            self._dispatch(listener, self, event, value)
+
+    def _set_state(self, state):
+        self._state = state
+        self._emit('state', state)
+
+    def _set_stage(self, stage):
+        self.checkpoint()
+        self._stage = stage
+        self._status.set_stage(stage)
+        self._emit('stage', stage)
+
+    def _add_worker(self, worker):
+        with self._lock:
+            self._workers.append(worker)
+            if not self._resumed.is_set():
+                worker.pause()
+            if self._cancelled:
+                worker.cancel()
+
+    def checkpoint(self):
+        '''Waits while the job is paused. Raises Cancelled once it got
+        cancelled.'''
+        while not self._resumed.is_set() and not self._cancelled:
+            self._resumed.wait(0.1)
+        if self._cancelled:
+            raise Cancelled()
+
+    def _gate(self, nodes):
+        # Pauses and stops a scan between dirs.
+        complete = True
+        for node in nodes:
+            if complete:
+                while not self._resumed.is_set() and not self._cancelled:
+                    self._resumed.wait(0.1)
+                if self._cancelled:
+                    return
+            complete = node[3] is not None  # Not a part of a huge dir.
+            yield node
+
+    def start(self):
+        '''Runs the job in a thread of its own and returns right away.'''
+        if self._started:
+            raise Exception('Job has been started already.')
+        self._started = True
+        self._thread = Thread(target=self._run_job, name='%s-job' % self._kind)
+        self._thread.start()
+
+    def run(self):
+        '''Runs the job within the calling thread.'''
+        if self._started:
+            raise Exception('Job has been started already.')
+        self._started = True
+        self._run_job()
+
+    def _run_job(self):
+        with self._lock:
+            if self._state == STATE_NEW:  # Not cancelled beforehand.
+                self._set_state(STATE_RUNNING)
+        try:
+            self._run()
+        except Cancelled:
+            self._logger.warning('Cancelled.')
+            state = STATE_CANCELLED
+        except Exception as reason:
+            self._logger.exception(reason)
+            self._error = reason
+            state = STATE_FAILED
+        else:
+            state = STATE_DONE
+        with self._lock:  # No more pausing or cancelling.
+            self._workers = []
+            self._set_state(state)
+
+    def wait(self, timeout=None):
+        '''Waits for a started job. Returns True once it is finished.'''
+        if self._thread:
+            self._thread.join(timeout)
+        return self._state in FINAL_STATES
+
+    def pause(self):
+        with self._lock:
+            if self._state != STATE_RUNNING:
+                return
+            self._resumed.clear()
+            for worker in self._workers:
+                worker.pause()
+            self._set_state(STATE_PAUSED)
+
+    def resume(self):
+        with self._lock:
+            if self._state != STATE_PAUSED:
+                return
+            self._resumed.set()
+            for worker in self._workers:
+                worker.resume()
+            self._set_state(STATE_RUNNING)
+
+    def cancel(self):
+        with self._lock:
+            if self._state in FINAL_STATES or self._cancelled:
+                return
+            self._cancelled = True
+            self._resumed.set()
+            for worker in self._workers:
+                worker.cancel()
+            self._set_state(STATE_CANCELLING)
+
+    def get_state(self):
+        return self._state
+
+    def get_stage(self):
+        return self._stage
+
+    def get_error(self):
+        return self._error
+
+    def get_status(self):
+        '''Returns the dict of Status.get.'''
+        return self._status.get()
+
+    def _start_status_server(self, status_path, profile):
+        if not status_path:
+            return None
+        try:
+            status_server = StatusServer(self._status, get_socket_path(
+                status_path, profile, self._kind))
+            status_server.start()
+            return status_server
+        except Exception as reason:
+            self._logger.warning('Could not start status endpoint: %s' % reason)
+            return None
+
+    def _inhibit_sleep(self, backend):
+        self._logger.info('Disabling system sleep mode timeouts.')
+        try:
+            power.inhibit(backend)
+            return True
+        except Exception as reason:
+            self._logger.warning('Could not disable sleep mode timeouts: %s' % reason)
+            return False
+
+    def _run(self):
+        raise NotImplementedError()
+
+
+class BackupJob(Job):
+    '''Backs up the sources of a profile. The plan command only scans and
+    predicts how long a backup would take, see get_plans.'''
+
+    def __init__(self, profile, command=COMMAND_RUN, dispatch=call_directly):
+        super(BackupJob, self).__init__('backup', dispatch)
+        if command not in COMMANDS:
+            raise Exception('Unknown command: %s' % command)
+        self._profile = profile
+        self._command = command
+        self._plans = []
+
+        # Load and extract our config.
+        config = get_config('%s.ini' % profile)
+        self._source_paths = config.getlist('source', 'paths')
+        self._source_excludes = config.getlist('source', 'excludes')
+        self._destinations = get_destinations(config)
+        self._disable_timeouts = int(config.get('power-management', 'disable_sleep_timeouts'))
+        self._power_backend = config.get('power-management', 'backend')
+        self._read_order = config.get('performance', 'read_order')
+        self._hash_name = config.get('verify', 'algorithm') or None
+        self._streaming = int(config.get('performance', 'streaming'))
+        self._delta_min_size = int(config.get('performance', 'delta_min_size'))
+        self._io_mode = config.get('performance', 'io_mode')
+        self._direct_io_min_size = int(config.get('performance', 'direct_io_min_size'))
+        self._diff_engine = config.get('performance', 'diff_engine')
+        self._status_path = config.get('status', 'path')
+        self._tuning = int(config.get('tuning', 'auto'))
+        self._tuning_max_age = int(config.get('tuning', 'max_age'))
+        self._adapt_queue = int(config.get('tuning', 'adapt_queue'))
+        self._max_minutes = float(config.get('window', 'max_minutes'))
+        self._priority = config.getlist('window', 'priority')
+        self._priority_paths = config.getlist('window', 'priority_paths')
+        self._user_config_path = config.get('user-config', 'path')
+
+        # Support ~, ~user and other constructions.
+        self._source_paths = list(map(expandvars, self._source_paths))
+        self._source_excludes = list(map(expandvars, self._source_excludes))
+        self._priority_paths = list(map(expandvars, self._priority_paths))
+        for destination in self._destinations:
+            destination['path'] = expandvars(destination['path'])
+            destination['index_cache'] = expandvars(destination['index_cache'])
+        self._status_path = expandvars(self._status_path)
+        self._user_config_path = expandvars(self._user_config_path)
+
+    def get_plans(self):
+        '''Returns one dict per destination once the plan command is done:
+        name, path, dirs, files, scan_secs, changed ((dev, files, bytes)
+        rows), pending_files, pending_bytes, prediction (see
+        lib.runstats.predict) and runs (rows of Index.get_runs).'''
+        return self._plans
+
+    def _prepare(self, start, mounted_volumes):
+        # Every destination has its own backup and index. Files get read
+        # once for all of them.
+        targets = []
+        # Planning must stay quick, measuring devices is left to backups.
+        calibration = (Calibration(self._user_config_path, self._tuning_max_age)
+                       if self._tuning and self._command == COMMAND_RUN else None)
+        # The window starts with the run, scanning is part of it.
+        deadline = start + self._max_minutes * 60 if self._max_minutes else None
+        for destination in self._destinations:
+            backup_path_real = destination['path']
+            if backup_path_real.startswith('volume://'):
+                mounted_volume, backup_path_real = volume.mount(destination['path'])
+                mounted_volumes.append(mounted_volume)
+            # Chunk and part size only depend on the sources, so they are
+            # the same for all destinations.
+            settings = {}
+            if calibration:
+                try:
+                    settings = calibration.get_settings(self._source_paths,
+                                                        backup_path_real)
+                    self._logger.info('Tuned for %s: %s' % (destination['name'], ', '.join(
+                        '%s=%s' % item for item in sorted(settings.items()))))
+                except (IOError, OSError) as reason:
+                    self._logger.warning('Could not measure devices: %s' % reason)
+            tuned = dict((key, settings[key]) for key in
+                         ('chunk_size', 'part_size', 'queue_size')
+                         if key in settings)
+            backup = Backup(backup_path_real, read_order=self._read_order,
+                            hash_name=self._hash_name,
+                            resume=int(destination['resume']),
+                            delta_min_size=self._delta_min_size,
+                            durability=destination['durability'],
+                            io_mode=self._io_mode,
+                            direct_io_min_size=self._direct_io_min_size,
+                            adapt_queue=self._adapt_queue, deadline=deadline,
+                            **tuned)
+            self._add_worker(backup)
+            targets.append(dict(name=destination['name'],
+                                path=backup_path_real,
+                                index_cache_path=destination['index_cache'],
+                                feeder_queue_size=settings.get(
+                                    'feeder_queue_size', FEEDER_QUEUE_SIZE),
+                                backup=backup, created=False))
+        if calibration:
+            calibration.save()
+        if not targets:
+            raise Exception('No destination configured.')
+        return targets
+
+    def _run(self):
+        start = time()
+        logger = self._logger
+        self._set_stage('prepare')
+        status_server = self._start_status_server(self._status_path, self._profile)
+        mounted_volumes = []
+        sleep_inhibited = False
+        targets = []
+        try:
+            targets = self._prepare(start, mounted_volumes)
+
+            logger.info('Preparing backup.')
+
+            # Backup and disable sleep timeout settings.
+            if self._disable_timeouts and self._command == COMMAND_RUN:
+                sleep_inhibited = self._inhibit_sleep(self._power_backend)
+
+            self._backup(start, targets)
+        finally:
+            # An interrupted backup is left for the next run to resume.
+            for target in targets:
+                if target['created']:
+                    target['backup'].abort()
+
+            # Restore sleep timeout settings.
+            if sleep_inhibited:
+                logger.info('Restoring system sleep mode timeouts.')
+                power.release()
+
+            for mounted_volume in mounted_volumes:
+                volume.umount(mounted_volume)
+
+            if status_server:
+                status_server.stop()
+
+        secs = time() - start
+        logger.info('Backup finished after %.2f secs.' % secs)
+
+    def _backup(self, start, targets):
+        logger = self._logger
+        status = self._status
+        source_paths, source_excludes = self._source_paths, self._source_excludes
+        for target in targets:
+            db_path = join(target['path'], 'index.sqlite3')
+            index_cache = None
+            if target['index_cache_path']:
+                index_cache = IndexCache(db_path, target['index_cache_path'])
+                db_path = index_cache.open()
+            target.update(db_path=db_path, index_cache=index_cache,
+                          index=Index(db_path, diff_engine=self._diff_engine,
+                                      queue_size=target['feeder_queue_size']))
+            target['backup'].load_deltas(target['index'])
+            status.add_queue('feeder:%s' % target['name'],
+                             target['index'].get_feeder_queue_size)
+            status.add_queue('writer:%s' % target['name'],
+                             target['backup'].get_writer_queue_size)
+
+        streaming = (self._streaming and len(targets) == 1 and
+                     self._command == COMMAND_RUN)
+        if self._streaming and len(targets) > 1:
+            logger.warning('Streaming works with one destination only.')
+        scan_start = time()
+        self._set_stage('scan')
+        if streaming:
+            # Copy changed files while the scan is still going on.
+            index, backup = targets[0]['index'], targets[0]['backup']
+            backup.create(0)
+            targets[0]['created'] = True
+            status.add_queue('reader', backup.get_reader_queue_size)
+            status.add_progress(backup.get_progress)
+            logger.info('Scanning and backing up directory trees: %s' %
+                        ', '.join(source_paths))
+            # Copied as found, so the priority rules do not apply.
+            index.update_concurrently([self._gate(scan(path, excludes=source_excludes))
+                                       for path in source_paths],
+                                      on_ingest=backup.stream)
+            backup.wait()
+            targets[0]['read_by'] = backup
+        else:
+            indexes = [target['index'] for target in targets]
+            for path in source_paths:
+                logger.info('Scanning directory tree: %s' % path)
+                nodes = self._gate(scan(path, excludes=source_excludes))
+                if len(indexes) == 1:
+                    indexes[0].update(nodes)
+                else:
+                    Index.update_many(indexes, nodes)
+        scan_secs = time() - scan_start
+
+        if self._command == COMMAND_PLAN:
+            self._set_stage('plan')
+            self._plans = [self._plan(target, scan_secs) for target in targets]
+            return
+
+        self.checkpoint()
+        copying = []
+        for target in targets:
+            index, backup = target['index'], target['backup']
+            logger.info('Destination %s: %s' % (target['name'], target['path']))
+
+            dirs_found, files_found = index.get_cur_stats()
+            logger.info('Found %d dirs and %d files.' % (dirs_found, files_found))
+
+            bytes = index.get_added_bytes() + index.get_modified_bytes()
+            logger.info('%s to copy.' % human_size(bytes))
+
+            # A streaming scan already did the copying.
+            target['run'] = dict(
+                started=start, dirs=dirs_found, files=files_found,
+                changed_files=sum(row[1] for row in index.get_changed_by_device()),
+                changed_bytes=bytes,
+                scan_secs=None if streaming else scan_secs,
+                copy_secs=scan_secs if streaming else 0.0)
+
+            # Only create new backup if files or dirs have changed or been added.
+            target['changed'] = index.get_num_added_or_modified_dirs_or_files()
+            if streaming and not target['changed']:
+                backup.discard()
+                target['created'] = False
+            elif not streaming and target['changed']:
+                backup.create(bytes, target['run']['changed_files'])
+                target['created'] = True
+
+                logger.info('Backing up tree structure.')
+                # backup.create_tree(index.get_all_dirs())
+                backup.create_tree(index.get_added_or_modified_dirs())
+                copying.append(target)
+
+        # TODO Collect errors also in extra log file.
+        # TODO Try to add some nice sleeps not to hug the cpu and io too much.
+        # TODO Try to collect 1MB chunks even with small files etc.
+        copy_start = time()
+        self._set_stage('copy')
+        if copying:
+            # The first destination reads for all.
+            status.add_queue('reader', copying[0]['backup'].get_reader_queue_size)
+        for target in copying:
+            status.add_progress(target['backup'].get_progress)
+        if len(copying) == 1:
+            logger.info('Backing up files.')
+            copying[0]['backup'].copy_files(
+                copying[0]['index'].get_added_or_modified_files(
+                    self._priority, self._priority_paths))
+        elif copying:
+            logger.info('Backing up files to %d destinations.' % len(copying))
+            # All lists have to be in the same order to be merged, which
+            # leaves out putting the files pending of one destination first.
+            fan_out([target['backup'] for target in copying],
+                    lambda: [target['index'].get_added_or_modified_files(
+                                 self._priority, self._priority_paths,
+                                 pending_first=False) for target in copying],
+                    Index.priority_key(self._priority, self._priority_paths))
+        for target in copying:
+            # The Reader of the first destination read the files for all.
+            target['run']['copy_secs'] = time() - copy_start
+            target['read_by'] = copying[0]['backup']
+
+        # logger.info('Linking unmodified files.')
+        # backup.link_old_files(index.get_unmodified_files())
+
+        self._set_stage('finish')
+        for target in targets:
+            if target['changed']:
+                logger.info('Finishing destination: %s' % target['name'])
+                self._finish(target)
+                target['created'] = False
+
+    def _finish(self, target):
+        '''Stores everything but the files of a destination and commits it.'''
+        logger = self._logger
+        hash_name, delta_min_size = self._hash_name, self._delta_min_size
+        backup, index, db_path = target['backup'], target['index'], target['db_path']
+        start = time()
+
+        missing_bytes = backup.get_sum_missing_bytes()
+        if missing_bytes:
+            logger.info('Backing up missing files.')
+            logger.info('%s to copy.' % human_size(missing_bytes))
+            backup.copy_missing_files()
+
+        logger.info('Backing up dir stats.')
+        backup.copy_dir_stats(index)
+
+        if hash_name:
+            logger.info('Storing checksums.')
+            index.add_checksums(backup.get_generation(),
+                                backup.get_checksums())
+
+        if delta_min_size:
+            logger.info('Storing block hashes and deltas.')
+            index.add_block_hashes(backup.get_generation(),
+                                   backup.get_block_hashes())
+            index.add_deltas(backup.get_generation(), backup.get_deltas())
+
+        # Files which did not get copied in time stay changed for the next run.
+        pending = backup.get_pending()
+        index.keep_pending(backup.get_generation(), pending)
+        run = target['run']
+        if pending:
+            pending_bytes = sum(row[3] or 0 for row in index.get_pending())
+            logger.info('Leaving %d files (%s) for the next run.' %
+                        (len(pending), human_size(pending_bytes)))
+            run.update(changed_files=run['changed_files'] - len(pending),
+                       changed_bytes=run['changed_bytes'] - pending_bytes)
+
+        logger.info('Updating database.')
+        index.add_versions(backup.get_generation())
+
+        # Stored along with the commit, so the commit itself is not part of it.
+        run.update(generation=backup.get_generation(), finish_secs=time() - start,
+                   total_secs=time() - run['started'])
+        devices = target['read_by'].get_device_stats()
+        for dev, (files, bytes_, secs) in sorted(devices.items()):
+            logger.info('Read %d files (%s) from device %s in %.2f secs: %s.' %
+                        (files, human_size(bytes_), format_dev(dev), secs,
+                         format_rate(files, bytes_, secs)))
+        index.add_run(run, devices)
+        index.commit()
+        index.renew_id()
+
+        # Disconnect from index database.
+        del index
+        del target['index']
+
+        logger.info('Backing up database.')
+        db_backup_path = join(backup.get_path(), 'index.sqlite3.gz')
+        f_in = open(db_path, 'rb')
+        f_out = gzip.open(db_backup_path, 'wb')
+        f_out.writelines(f_in)
+        f_out.close()
+        f_in.close()
+
+        if target['index_cache']:
+            logger.info('Writing database back to destination.')
+            target['index_cache'].write_back(backup.get_generation())
+
+        # Rename backup directory and finalize backup.
+        backup.commit()
+
+    def _plan(self, target, scan_secs):
+        # What a backup to the destination would copy and how long it would
+        # take judging by the previous runs.
+        index = target['index']
+        dirs_found, files_found = index.get_cur_stats()
+        changed = index.get_changed_by_device()
+        pending = index.get_pending()
+        return dict(name=target['name'], path=target['path'],
+                    dirs=dirs_found, files=files_found, scan_secs=scan_secs,
+                    changed=changed, pending_files=len(pending),
+                    pending_bytes=sum(row[3] or 0 for row in pending),
+                    prediction=predict(index, changed, files_found),
+                    runs=index.get_runs(HISTORY_RUNS))
+
+
+class RestoreJob(Job):
+    '''Restores the given source paths of a generation of a profile into
+    restore_path.'''
+
+    def __init__(self, profile, timestamp, restore_path, source_paths=(),
+                 dispatch=call_directly):
+        super(RestoreJob, self).__init__('restore', dispatch)
+        self._profile = profile
+        self._timestamp = timestamp
+
+        # Load and extract our config.
+        config = get_config('%s.ini' % profile)
+        self._backup_path = config.get('destination', 'path')
+        self._disable_timeouts = int(config.get('power-management', 'disable_sleep_timeouts'))
+        self._power_backend = config.get('power-management', 'backend')
+        restore_workers = config.get('performance', 'restore_workers')
+        self._restore_workers = (None if restore_workers in ('', 'auto')
+                                 else int(restore_workers))
+        self._io_mode = config.get('performance', 'io_mode')
+        self._status_path = config.get('status', 'path')
+        self._tuning = int(config.get('tuning', 'auto'))
+        self._tuning_max_age = int(config.get('tuning', 'max_age'))
+        self._adapt_queue = int(config.get('tuning', 'adapt_queue'))
+        self._user_config_path = config.get('user-config', 'path')
+
+        # Support ~, ~user and other constructions.
+        self._backup_path = expandvars(self._backup_path)
+        self._restore_path = expandvars(restore_path)
+        self._source_paths = list(map(expandvars, source_paths))
+        self._status_path = expandvars(self._status_path)
+        self._user_config_path = expandvars(self._user_config_path)
+
+    def _create_restore(self, backup_path_real):
+        # Here the backup is the source.
+        restore_path = self._restore_path
+        restore_workers = self._restore_workers
+        settings = {}
+        if self._tuning:
+            calibration = Calibration(self._user_config_path, self._tuning_max_age)
+            try:
+                settings = calibration.get_settings([backup_path_real],
+                                                    restore_path)
+                calibration.save()
+                self._logger.info('Tuned: %s' % ', '.join(
+                    '%s=%s' % item for item in sorted(settings.items())))
+            except (IOError, OSError) as reason:
+                self._logger.warning('Could not measure devices: %s' % reason)
+        if restore_workers is None:  # Only if not configured.
+            restore_workers = settings.get('restore_workers') or RESTORE_WORKERS
+        tuned = dict((key, settings[key]) for key in
+                     ('chunk_size', 'part_size', 'queue_size')
+                     if key in settings)
+        return Restore(backup_path_real, restore_path, workers=restore_workers,
+                       io_mode=self._io_mode, adapt_queue=self._adapt_queue,
+                       **tuned)
+
+    def _run(self):
+        start = time()
+        logger = self._logger
+        status = self._status
+        restore_path = self._restore_path
+        self._set_stage('prepare')
+
+        if not exists(restore_path):
+            raise Exception('Path to restore to does not exist: %s' % restore_path)
+
+        backup_path_real = self._backup_path
+        mounted_volume = None
+        status_server = None
+        sleep_inhibited = False
+        restore = None
+        try:
+            if self._backup_path.startswith('volume://'):
+                mounted_volume, backup_path_real = volume.mount(self._backup_path)
+            restore = self._create_restore(backup_path_real)
+            self._add_worker(restore)
+
+            logger.info('Preparing restoration.')
+
+            status.add_queue('reader', restore.get_reader_queue_size)
+            status.add_queue('writer', restore.get_writer_queue_size)
+            status.add_progress(restore.get_progress)
+            status_server = self._start_status_server(self._status_path,
+                                                      self._profile)
+
+            # Backup and disable sleep timeout settings.
+            if self._disable_timeouts:
+                sleep_inhibited = self._inhibit_sleep(self._power_backend)
+
+            restore.select(self._timestamp)
+
+            db_path = join(restore_path, 'index.sqlite3')
+
+            logger.info('Restoring database.')
+            db_backup_path = join(restore.get_path(), 'index.sqlite3.gz')
+            f_in = gzip.open(db_backup_path, 'rb')
+            f_out = open(db_path, 'wb')
+            f_out.writelines(f_in)
+            f_out.close()
+            f_in.close()
+
+            self._set_stage('select')
+            index = Index(db_path)
+            for path in self._source_paths:
+                logger.info('Selecting backup directory tree: %s' % path)
+                index.select(path)
+
+            dirs_found, files_found = index.get_cur_stats()
+            logger.info('Selected %d dirs and %d files.' % (dirs_found, files_found))
+
+            bytes = index.get_selected_bytes()
+            logger.info('%s to copy.' % human_size(bytes))
+
+            restore.set_bytes(bytes)
+
+            logger.info('Restoring tree structure.')
+            restore.create_tree(index.get_selected_dirs())
+
+            # TODO Collect errors also in extra log file.
+            # TODO Try to add some nice sleeps not to hug the cpu and io too much.
+            # TODO Try to collect 1MB chunks even with small files etc.
+            logger.info('Restoring files.')
+            self._set_stage('copy')
+            # Deltas are looked up in the main index as consolidate.py keeps it
+            # up to date. The one of the backup is a fallback.
+            main_db_path = join(backup_path_real, 'index.sqlite3')
+            deltas_index = index
+            if exists(main_db_path):
+                deltas_index = Index(main_db_path, open_mode=OPEN_READ_ONLY)
+            restore.copy_files(index.get_selected_files(), deltas_index.get_deltas())
+
+            logger.info('Restoring dir stats.')
+            self._set_stage('finish')
+            restore.copy_dir_stats(index)
+        finally:
+            if restore:
+                restore.close()
+
+            # Restore sleep timeout settings.
+            if sleep_inhibited:
+                logger.info('Restoring system sleep mode timeouts.')
+                power.release()
+
+            if mounted_volume:
+                volume.umount(mounted_volume)
+
+            if status_server:
+                status_server.stop()
+
+        secs = time() - start
+        logger.info('Restoration finished after %.2f secs.' % secs)
@@ -0,0 +1,89 @@
+from os.path import exists
+from os import remove
+import sqlite3
+from threading import Lock
+import logging
+import time
+
+
+# Completed files are written in batches of this size or at least every
+# FLUSH_INTERVAL seconds.
+BATCH_SIZE = 1000
+FLUSH_INTERVAL = 5.0  # Seconds
+# Journals which have to sync the destination before writing only do so at
+# most this often.
+SYNC_INTERVAL = 300.0  # Seconds
+
+
+class Journal(object):
+    '''Checkpoint journal of the files completed within an in-progress backup.
+
+    Entries are (src_file, size, mtime, hash) tuples. The journal lives next
+    to the in-progress dir so that an interrupted run can be resumed. With
+    sync given, entries are kept back until sync has been called, so that
+    only files whose data is on disk get journaled.
+    Entries get added from the Writer and the Flusher threads, loading and
+    closing happen from the main thread while neither is running.
+    '''
+
+    def __init__(self, path, sync=None):
+        super(Journal, self).__init__()
+        self._path = path
+        self._sync = sync
+        self._logger = logging.getLogger('journal')
+        self._buffer = []
+        self._lock = Lock()  # Guards the buffer.
+        self._commit_lock = Lock()  # Keeps commits in order of their entries.
+        self._last_flush = time.time()
+        is_new = not exists(path)
+        self._db_conn = sqlite3.connect(path, check_same_thread=False)
+        self._db_conn.text_factory = str
+        if is_new:
+            with self._db_conn as cur:
+                cur.execute('''CREATE TABLE done
+                               (src_file text PRIMARY KEY, size integer,
+                                mtime integer, hash text)''')
+
+    def load(self):
+        '''Returns a dict of src_file -> (size, mtime, hash).'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT src_file, size, mtime, hash FROM done'''
+        return dict((row[0], row[1:]) for row in cur.execute(sql))
+
+    def add(self, entry):
+        with self._lock:
+            self._buffer.append(entry)
+            secs = time.time() - self._last_flush
+            if self._sync:
+                is_due = secs >= SYNC_INTERVAL
+            else:
+                is_due = len(self._buffer) >= BATCH_SIZE or secs >= FLUSH_INTERVAL
+        if is_due:
+            self.flush()
+
+    def flush(self):
+        with self._commit_lock:
+            with self._lock:
+                entries, self._buffer = self._buffer, []
+                self._last_flush = time.time()
+            if entries:
+                if self._sync:
+                    self._sync()
+                with self._db_conn as cur:
+                    cur.executemany('''INSERT OR REPLACE INTO done
+                                       (src_file, size, mtime, hash)
+                                       VALUES (?, ?, ?, ?)''', entries)
+                self._logger.debug('Flushed %d entries.' % len(entries))
+
+    def close(self):
+        if self._db_conn:
+            self.flush()
+            self._db_conn.close()
+            self._db_conn = None
+
+    def remove(self):
+        with self._lock:
+            self._buffer = []
+        self.close()
+        if exists(self._path):
+            remove(self._path)
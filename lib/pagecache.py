@@ -0,0 +1,181 @@
+from ctypes.util import find_library
+import ctypes
+import mmap
+import os
+import errno
+import logging
+
+
+logger = logging.getLogger('pagecache')
+
+# Data goes through the page cache as usual.
+IO_MODE_NORMAL = 'normal'
+# Copied data gets dropped from the page cache once it has been read or
+# written, so that the working set of the desktop survives a backup.
+IO_MODE_GENTLE = 'gentle'
+IO_MODES = (IO_MODE_NORMAL, IO_MODE_GENTLE)
+
+# Bytes requested ahead of the reading position.
+READAHEAD_SIZE = 8 * 1024 * 1024
+# Size of the aligned buffer for O_DIRECT reads. Has to be a multiple of the
+# logical block size of every device and of CHUNK_PART_SIZE.
+DIRECT_BUFFER_SIZE = 1024 * 1024
+
+_HAS_FADVISE = hasattr(os, 'posix_fadvise')
+_HAS_DIRECT = hasattr(os, 'O_DIRECT') and hasattr(os, 'readv')
+
+# See linux/fs.h.
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_sync_file_range = None
+
+
+def _get_sync_file_range():
+    global _sync_file_range
+    if _sync_file_range is None:
+        _sync_file_range = False
+        try:
+            libc = ctypes.CDLL(find_library('c'), use_errno=True)
+            func = libc.sync_file_range
+        except (OSError, AttributeError):
+            return None
+        func.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                         ctypes.c_uint)
+        _sync_file_range = func
+    return _sync_file_range or None
+
+
+def _fadvise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as reason:  # Hints only, e.g. pipes do not support them.
+        logger.debug('Could not advise fd %d: %s' % (fd, reason))
+
+
+def advise_sequential(fd):
+    '''Tells the kernel that fd gets read from start to end, which doubles
+    its readahead window, and starts reading the first bytes.'''
+    if _HAS_FADVISE:
+        _fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        _fadvise(fd, 0, READAHEAD_SIZE, os.POSIX_FADV_WILLNEED)
+
+
+def advise_ahead(fd, offset):
+    '''Starts reading the bytes following offset in the background.'''
+    if _HAS_FADVISE:
+        _fadvise(fd, offset, READAHEAD_SIZE, os.POSIX_FADV_WILLNEED)
+
+
+def drop(fd, offset=0, length=0):
+    '''Drops the clean pages of the range (0 means up to the end) from the
+    page cache. Writeback of dirty ones gets started.'''
+    if _HAS_FADVISE:
+        _fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+class WriteBehind(object):
+    '''Pushes the written data of a file to disk while writing and drops it
+    from the page cache.
+
+    Writeback of every new range is started right away. The previous range
+    has had the time it took to write the new one, so waiting for it hardly
+    ever blocks. Without sync_file_range(2) the kernel gets only asked to
+    drop the pages, which it does for those already written back.
+    '''
+
+    def __init__(self, fd):
+        super(WriteBehind, self).__init__()
+        self._fd = fd
+        self._sync_file_range = _get_sync_file_range()
+        self._start = 0  # Range in flight.
+        self._end = 0
+
+    def _sync(self, offset, length, flags):
+        if self._sync_file_range(self._fd, offset, length, flags) != 0:
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_))
+
+    def advance(self, pos):
+        '''Has to be called with the position written up to.'''
+        if pos <= self._end:
+            return
+        if self._sync_file_range:
+            self._sync(self._end, pos - self._end, SYNC_FILE_RANGE_WRITE)
+            if self._end > self._start:
+                self._sync(self._start, self._end - self._start,
+                           SYNC_FILE_RANGE_WAIT_BEFORE |
+                           SYNC_FILE_RANGE_WRITE |
+                           SYNC_FILE_RANGE_WAIT_AFTER)
+        if self._end > self._start:
+            drop(self._fd, self._start, self._end - self._start)
+        self._start, self._end = self._end, pos
+
+    def finish(self):
+        '''Starts writeback of the rest without waiting for it.'''
+        drop(self._fd, self._start)
+
+
+class DirectFile(object):
+    '''Read-only file object which bypasses the page cache (O_DIRECT).
+
+    O_DIRECT needs aligned buffers, so data gets read into an anonymous
+    mmap (page aligned) and copied from there.
+    '''
+
+    def __init__(self, path, buffer_size=DIRECT_BUFFER_SIZE):
+        super(DirectFile, self).__init__()
+        self._fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        self._buffer = mmap.mmap(-1, buffer_size)
+        self._view = memoryview(self._buffer)
+        self._len = 0
+        self._pos = 0
+        self.name = path
+
+    def fileno(self):
+        return self._fd
+
+    def _fill(self):
+        self._len = os.readv(self._fd, [self._buffer])
+        self._pos = 0
+        return self._len
+
+    def read(self, size=-1):
+        results = []
+        while size:
+            if self._pos >= self._len and not self._fill():
+                break
+            end = self._len if size < 0 else min(self._len, self._pos + size)
+            results.append(self._view[self._pos:end].tobytes())
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return b''.join(results)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._view.release()
+            self._buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_direct(path):
+    '''Returns a DirectFile for path or None if the filesystem does not
+    support O_DIRECT.'''
+    if not _HAS_DIRECT:
+        return None
+    try:
+        return DirectFile(path)
+    except OSError as reason:
+        if reason.errno != errno.EINVAL:
+            raise
+        logger.debug('No O_DIRECT support for: %s' % path)
+        return None
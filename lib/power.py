@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from threading import Lock
+import subprocess
+import os
+import logging
+
+from lib.util import which
+
+
+logger = logging.getLogger('power')
+
+
+class GnomePower(object):
+    '''Sets the sleep timeouts of GNOME based desktops to 0 and back.'''
+
+    name = 'gnome'
+    SCHEMA = 'org.gnome.settings-daemon.plugins.power'
+    KEYS = ('sleep-inactive-ac-timeout', 'sleep-inactive-battery-timeout')
+
+    def __init__(self):
+        super(GnomePower, self).__init__()
+        # Headless, e.g. from cron, the settings cannot be reached.
+        if not os.environ.get('DBUS_SESSION_BUS_ADDRESS'):
+            raise ImportError('No desktop session')
+        # Loaded only here as importing gi takes its time.
+        from gi.repository import Gio
+        if self.SCHEMA not in Gio.Settings.list_schemas():
+            raise ImportError('Schema not installed: %s' % self.SCHEMA)
+        self._settings = Gio.Settings(self.SCHEMA)
+        self._timeouts = None
+
+    def inhibit(self):
+        self._timeouts = [self._settings.get_int(key) for key in self.KEYS]
+        for key in self.KEYS:
+            self._settings.set_int(key, 0)
+
+    def release(self):
+        if self._timeouts is not None:
+            for key, timeout in zip(self.KEYS, self._timeouts):
+                self._settings.set_int(key, timeout)
+            self._timeouts = None
+
+
+class LogindPower(object):
+    '''Holds a systemd-logind inhibitor lock as long as the backup runs.'''
+
+    name = 'logind'
+
+    def __init__(self):
+        super(LogindPower, self).__init__()
+        if not which('systemd-inhibit'):
+            raise ImportError('systemd-inhibit not found')
+        self._process = None
+
+    def inhibit(self):
+        self._process = subprocess.Popen([
+            'systemd-inhibit', '--what=sleep:idle', '--who=cronotrigger',
+            '--why=Backup in progress', '--mode=block', 'sleep', 'infinity'])
+
+    def release(self):
+        if self._process is not None:
+            if self._process.poll() is not None:
+                logger.warning('Inhibitor lock got lost early (exit code %d).' %
+                               self._process.returncode)
+            else:
+                self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+
+class NoPower(object):
+    '''Does nothing, for machines which do not go to sleep on their own.'''
+
+    name = 'none'
+
+    def inhibit(self):
+        pass
+
+    def release(self):
+        pass
+
+
+# Tried in this order unless one is asked for by name.
+BACKENDS = OrderedDict((backend.name, backend)
+                       for backend in (GnomePower, LogindPower, NoPower))
+
+
+def get_backend(name='auto'):
+    '''Returns an instance of the power backend of the given name or of the
+    first one which is available.'''
+    if name == 'auto':
+        names = list(BACKENDS)
+    elif name in BACKENDS:
+        names = [name]
+    else:
+        raise Exception('Unknown power backend: %s' % name)
+    for name_ in names:
+        try:
+            backend = BACKENDS[name_]()
+        except ImportError as reason:
+            logger.debug('Power backend %s not available: %s' % (name_, reason))
+            continue
+        logger.debug('Using power backend: %s' % name_)
+        return backend
+    raise Exception('Power backend not available: %s' % name)
+
+
+# Sleep stays inhibited as long as any job of the process needs it.
+_lock = Lock()
+_inhibition = dict(backend=None, count=0)
+
+
+def inhibit(name='auto'):
+    '''Inhibits sleep until release got called as often as this. Only the
+    first caller asks the backend of the given name for it.'''
+    with _lock:
+        if not _inhibition['count']:
+            backend = get_backend(name)
+            backend.inhibit()
+            _inhibition['backend'] = backend
+        _inhibition['count'] += 1
+
+
+def release():
+    '''Lets the system sleep again once the last caller of inhibit is done.'''
+    with _lock:
+        if not _inhibition['count']:
+            return
+        _inhibition['count'] -= 1
+        if not _inhibition['count']:
+            backend, _inhibition['backend'] = _inhibition['backend'], None
+            backend.release()
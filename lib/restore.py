@@ -1,12 +1,19 @@
-from os.path import exists, lexists, join, dirname, sep
-from os import makedirs, listdir
+from os.path import exists, lexists, join, dirname
+from os import listdir, lstat
 import time
 import logging
 import re
 from collections import OrderedDict
+from threading import Event
 
-from lib.dtree import copystat
-from lib.copy import Reader, Writer, Queue, QUEUE_SIZE
+from lib.copy import (Reader, Writer, Progress, Queue, QUEUE_SIZE,
+                      CHUNK_SIZE, CHUNK_PART_SIZE)
+from lib.fiemap import ExtentMap
+from lib.dirstats import get_ancestors, read_dir_stats, apply_dir_stats
+from lib.delta import get_layers
+from lib.dircache import DirCache
+from lib.pagecache import IO_MODES, IO_MODE_NORMAL
+from lib.tuning import DepthTuner, MAX_QUEUE_BYTES
 
 
 class Restore(object):
@@ -25,25 +32,79 @@ class Restore(object):
         timestamps.sort(key=lambda v: float(v))
         self._backup_paths = OrderedDict(map(lambda timestamp: (timestamp, join(self._base_path, timestamp)), timestamps))
 
-    def __init__(self, base_path, restore_path):
+    def __init__(self, base_path, restore_path, workers=1,
+                 io_mode=IO_MODE_NORMAL, chunk_size=CHUNK_SIZE,
+                 part_size=CHUNK_PART_SIZE, queue_size=QUEUE_SIZE,
+                 adapt_queue=False):
         super(Restore, self).__init__()
         self._base_path = base_path
         self._restore_path = restore_path
         self._logger = logging.getLogger('restore')
-        self._reader, self._writer = None, None
+        if io_mode not in IO_MODES:
+            raise Exception('Unknown I/O mode: %s' % io_mode)
+        self._io_mode = io_mode
+        self._workers = max(1, workers)
+        self._chunk_size = chunk_size
+        self._part_size = part_size
+        self._queue_size = queue_size
+        self._adapt_queue = adapt_queue
+        self._depth_tuners = []
+        self._threads = []
+        self._dir_cache = DirCache()  # Shared by all writers.
+        self._progress = Progress()  # Shared by all readers and writers.
+        self._sum_bytes = 0
         self._dirs_need_stats = []
         self._backup_path = None
         self._backup_paths = None
+        self._gate = Event()  # Cleared while paused.
+        self._gate.set()
+        self._cancelled = False
         self.__init_base_path(base_path)
         self.__init_backup_paths()
 
-    def __init_threads(self, sum_bytes):
-        self._input_queue = Queue.Queue(maxsize=QUEUE_SIZE * 4)
-        self._output_queue = Queue.Queue(maxsize=QUEUE_SIZE)
-        self._reader = Reader(self._input_queue, self._output_queue, sum_bytes)
-        self._reader.start()
-        self._writer = Writer(self._output_queue, self._dirs_need_stats)
-        self._writer.start()
+    def __init_threads(self, sum_bytes, sum_files):
+        # The input queue is unbounded because all items are resolved in
+        # memory anyway. The output queue is the prefetch buffer.
+        input_queue = Queue.Queue()
+        output_queue = Queue.Queue(maxsize=self._queue_size)
+        reader = Reader(input_queue, output_queue, sum_bytes,
+                        io_mode=self._io_mode, chunk_size=self._chunk_size,
+                        part_size=self._part_size, gate=self._gate,
+                        progress=self._progress)
+        reader.add_more_files(sum_files)
+        reader.start()
+        writer = Writer(output_queue, self._dirs_need_stats,
+                        dir_cache=self._dir_cache, io_mode=self._io_mode,
+                        part_size=self._part_size, progress=self._progress)
+        writer.start()
+        if self._adapt_queue:
+            self._depth_tuners.append((reader, DepthTuner(
+                output_queue,
+                max(self._queue_size, MAX_QUEUE_BYTES // self._chunk_size))))
+        self._threads.append((input_queue, output_queue, reader, writer))
+
+    def pause(self):
+        '''Holds all Readers before their next chunk until resume.'''
+        self._gate.clear()
+
+    def resume(self):
+        self._gate.set()
+
+    def cancel(self):
+        '''Drops the queued files. Files being copied still get finished.
+        Thread safe.'''
+        self._cancelled = True
+        self._gate.set()
+        for input_queue, output_queue, reader, writer in list(self._threads):
+            try:
+                while True:
+                    input_queue.get_nowait()
+                    input_queue.task_done()
+            except Queue.Empty:
+                pass
+
+    def is_cancelled(self):
+        return self._cancelled
 
     def select(self, timestamp):
         backup_path = join(self._base_path, timestamp)
@@ -53,124 +114,207 @@ class Restore(object):
         self._backup_path = backup_path
 
     def __join_threads(self):
-        if self._reader:
-            self._reader.stop()
-            self._reader.join()
-        if self._writer:
-            self._writer.stop()
-            self._writer.join()
+        for input_queue, output_queue, reader, writer in self._threads:
+            reader.stop()
+            reader.join()
+            writer.stop()
+            writer.join()
 
     def __del__(self):
         self.__join_threads()
 
+    def close(self):
+        '''Stops the worker threads.'''
+        self.__join_threads()
+        self._threads = []
+
     def get_path(self):
         return self._backup_path
 
     def set_bytes(self, sum_bytes):
-        # Not optimal. Perhaps we could find a better call style?!
-        self.__init_threads(sum_bytes)
+        self._sum_bytes = sum_bytes
+
+    def get_progress(self):
+        '''Returns the progress of all workers (see Reader.get_progress).'''
+        return self._progress.get()
+
+    def get_reader_queue_size(self):
+        return sum(input_queue.qsize() for input_queue, _, _, _ in self._threads)
+
+    def get_writer_queue_size(self):
+        return sum(output_queue.qsize() for _, output_queue, _, _ in self._threads)
 
     def create_tree(self, dirs):
         num_dirs = 0
         for src_dir, mtime, inode in dirs:
             dst_dir = src_dir.lstrip('./')
             dst_dir = join(self._restore_path, dst_dir)
-            try:
-                makedirs(dst_dir)
-            except OSError as error:
-                if error.errno != 17:
-                    raise
+            self._dir_cache.makedirs(dst_dir)
             self._dirs_need_stats.append(src_dir)
             num_dirs += 1
         self._logger.info('Created %d dirs.' % num_dirs)
 
-    def copy_files(self, files):
-        base_path = self._base_path
+    def resolve_files(self, files, deltas=None):
+        '''Finds the generation holding each of the selected files.
+
+        Returns an OrderedDict of timestamp -> list of items, newest first.
+        Directories which are missing in a backup are remembered so that
+        their files do not have to be looked up there again. Files stored as
+        delta objects (see Index.get_deltas) get the layers to read from.
+        '''
         backup_paths = self._backup_paths
         keys = list(backup_paths.keys())
-        _logger = self._logger
-
-        def _find_older_file(cur_timestamp, filepath):
-            index = keys.index(cur_timestamp)
-            for timestamp in reversed(keys[:index]):
-                test_filepath = join(backup_paths[timestamp], filepath)
-                if lexists(test_filepath):
-                    _logger.debug('Grabbed from older backup: %s' % timestamp)
-                    return test_filepath
-            raise Exception('No copy found: %s' % filepath)
-
-        def src_resolver(filepath):
-            # print('test for:' + filepath)
-            if not lexists(filepath):
-                filepath = filepath[len(base_path):].lstrip('/')
-                cur_timestamp, filepath = filepath.split(sep, 1)
-                return _find_older_file(cur_timestamp, filepath)
-            return filepath
-
-        # src_resolver = self._src_resolver
-        num_files, num_symlinks = 0, 0
-        for dst_path, name, mtime, size, is_link, is_file, inode in files:
-            dst_file = join(dst_path, name)
-            src_file = dst_file.lstrip('./')
-            src_file = join(self._backup_path, src_file)
-            dst_file = join(self._restore_path, dst_file.lstrip('/'))
-            # print(src_file, exists(src_file))
-            # print(dst_file, exists(dst_file))
-            self._input_queue.put(dict(
-                src_dir=dirname(src_file),
-                src_file=src_file,
-                src_resolver=src_resolver,
-                dst_file=dst_file,
-                size=size,
-                is_link=is_link,
-                is_file=is_file,
-            ))
+        cur_timestamp = self._backup_path[len(self._base_path):].lstrip('./')
+        timestamps = list(reversed(keys[:keys.index(cur_timestamp) + 1]))
+        missing_dirs, present_dirs = set(), set()
+        groups = OrderedDict((timestamp, []) for timestamp in timestamps)
+        hardlinks = {}
+        num_missing = 0
+        for dst_path, name, mtime, size, is_link, is_file, inode, dev, nlink in files:
+            rel_dir = dst_path.lstrip('./')
+            dst_file = join(self._restore_path, dst_path.lstrip('/'), name)
+            if nlink and nlink > 1 and is_file and not is_link:
+                # Further names of a hard link get linked to the first one
+                # right after it has been restored.
+                primary = hardlinks.get((dev, inode))
+                if primary is not None:
+                    primary['links'].append(dict(
+                        primary,
+                        src_dir=dirname(dst_file),
+                        dst_file=dst_file,
+                        link_to=primary['dst_file'],
+                        links=None,
+                    ))
+                    continue
+            for timestamp in timestamps:
+                if (timestamp, rel_dir) in missing_dirs:
+                    continue
+                src_file = join(backup_paths[timestamp], rel_dir, name)
+                try:
+                    src_inode = lstat(src_file).st_ino
+                except OSError:
+                    if (timestamp, rel_dir) not in present_dirs:
+                        if lexists(dirname(src_file)):
+                            present_dirs.add((timestamp, rel_dir))
+                        else:
+                            missing_dirs.add((timestamp, rel_dir))
+                    continue
+                if timestamp != cur_timestamp:
+                    self._logger.debug('Grabbed from older backup: %s' % timestamp)
+                item = dict(
+                    src_dir=dirname(src_file),
+                    src_file=src_file,
+                    src_resolver=None,
+                    src_inode=src_inode,
+                    dst_file=dst_file,
+                    size=size,
+                    is_link=is_link,
+                    is_file=is_file,
+                    link_to=None,
+                    links=[],
+                )
+                if deltas and (timestamp, dst_path, name) in deltas:
+                    item['layers'] = get_layers(self._base_path, deltas,
+                                                timestamp, dst_path, name)
+                groups[timestamp].append(item)
+                if nlink and nlink > 1 and is_file and not is_link:
+                    hardlinks[(dev, inode)] = item
+                break
+            else:
+                self._logger.error('No copy found: %s' % join(rel_dir, name))
+                num_missing += 1
+        if num_missing:
+            self._logger.warning('Could not find %d files in any backup.' % num_missing)
+        for timestamp in timestamps:
+            if not groups[timestamp]:
+                del groups[timestamp]
+        return groups
+
+    def _distribute(self, groups):
+        '''Sorts every group by disk location and hands the groups out to the
+        workers, biggest group first to the least loaded worker.
+        '''
+        extent_map = ExtentMap()
+        key = lambda item: (item['src_file']
+                            if item['is_file'] and not item['is_link'] else None,
+                            item['src_inode'])
+        workers = [[0, []] for i in range(min(self._workers, len(groups)))]
+        for timestamp, items in sorted(groups.items(), key=lambda group:
+                                       -sum(item['size'] for item in group[1])):
+            items.sort(key=lambda item: item['src_inode'])
+            extent_map.sort(items, key)
+            worker = min(workers, key=lambda worker: worker[0])
+            worker[0] += sum(item['size'] for item in items)
+            worker[1].append((timestamp, items))
+        return workers
+
+    def copy_files(self, files, deltas=None):
+        groups = self.resolve_files(files, deltas)
+        workers = self._distribute(groups)
+        self._logger.info('Restoring from %d backups using %d workers.' %
+                          (len(groups), len(workers)))
+        for sum_bytes, worker_groups in workers:
+            self.__init_threads(sum_bytes, sum(
+                1 + len(item['links'])
+                for timestamp, items in worker_groups for item in items))
+            input_queue = self._threads[-1][0]
+            for timestamp, items in worker_groups:
+                self._logger.debug('Queued %d files from backup: %s' %
+                                   (len(items), timestamp))
+                for item in items:
+                    if self._cancelled:
+                        break
+                    input_queue.put(item)
+                    for link_item in item['links']:
+                        input_queue.put(link_item)
         try:
-            while not (self._reader._is_idle and self._writer._is_idle and
-                       self._input_queue.empty() and
-                       self._output_queue.empty() and
-                       self._reader.is_alive() and self._writer.is_alive()):
+            while not all(reader._is_idle and writer._is_idle and
+                          input_queue.empty() and output_queue.empty() and
+                          reader.is_alive() and writer.is_alive()
+                          for input_queue, output_queue, reader, writer
+                          in self._threads):
+                for reader, depth_tuner in self._depth_tuners:
+                    depth_tuner.update(reader.get_bytes_read())
                 time.sleep(0.5)
         except KeyboardInterrupt:
             pass
-        self._logger.info('Copied %d files and %d symlinks.' %
-                          (self._writer._num_files,
-                           self._writer._num_symlinks))
-
-    def _copy_dir_stats(self, path):
-        # TODO remember already seen dirs and skip them below.
-        base_path = self._base_path
-        cur_timestamp = self._backup_path[len(base_path):].lstrip('./')
+        writers = [writer for _, _, _, writer in self._threads]
+        self._logger.info('Copied %d files, %d symlinks and %d hard links.' %
+                          (sum(writer._num_files for writer in writers),
+                           sum(writer._num_symlinks for writer in writers),
+                           sum(writer._num_hardlinks for writer in writers)))
+
+    def _find_dir(self, path):
+        '''Returns the newest copy of a dir within the selected backup and the
+        ones before it.'''
         backup_paths = self._backup_paths
         keys = list(backup_paths.keys())
-        _logger = self._logger
-
-        def _find_older_dir(path):
-            index = keys.index(cur_timestamp)
-            for timestamp in reversed(keys[:index]):
-                test_filepath = join(backup_paths[timestamp], path)
-                if lexists(test_filepath):
-                    _logger.debug('Grabbed from older backup: %s' % timestamp)
-                    return test_filepath
-            raise Exception('No copy found: %s' % path)
-
-        parts = path.lstrip('./').split('/')
-        while parts:
-            src_dir = join(self._backup_path, '/'.join(parts))
-            if not lexists(src_dir):
-                src_dir = _find_older_dir('/'.join(parts))
-            # print(src_dir)
-            dst_dir = join(self._restore_path, '/'.join(parts))
-            # print(dst_dir)
-            try:
-                copystat(src_dir, dst_dir, follow_symlinks=False)
-            except KeyboardInterrupt:
-                raise
-            except Exception as reason:
-                self._logger.exception(reason)
-            del parts[-1]
-
-    def copy_dir_stats(self):
-        # TODO should be gathered from the database.
+        cur_timestamp = self._backup_path[len(self._base_path):].lstrip('./')
+        for timestamp in reversed(keys[:keys.index(cur_timestamp) + 1]):
+            test_filepath = join(backup_paths[timestamp], path)
+            if lexists(test_filepath):
+                return test_filepath
+        raise Exception('No copy found: %s' % path)
+
+    def copy_dir_stats(self, index):
+        # Every dir gets handled once. Stats come from the index if the backup
+        # has recorded them, else from the newest copy of the dir.
+        paths = set()
         for path in self._dirs_need_stats:
-            self._copy_dir_stats(path)
+            paths.update(get_ancestors(path))
+        stats = index.get_dir_stats(paths)
+        dst_stats = {}
+        for src_dir in paths:
+            rel_dir = src_dir.lstrip('./')
+            try:
+                dir_stats = stats[src_dir]
+            except KeyError:
+                try:
+                    dir_stats = read_dir_stats(self._find_dir(rel_dir))
+                except Exception as reason:
+                    self._logger.error(reason)
+                    continue
+            dst_stats[join(self._restore_path, rel_dir)] = dir_stats
+        num_dirs = apply_dir_stats(dst_stats)
+        self._logger.info('Applied stats of %d dirs (%d from the index).' %
+                          (num_dirs, len(stats)))
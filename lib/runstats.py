@@ -0,0 +1,78 @@
+import os
+
+from lib.index import RUN_FIELDS
+from lib.human_size import human_size
+
+
+# Number of previous runs the predictions are based on.
+HISTORY_RUNS = 10
+
+
+def format_dev(dev):
+    if dev is None:
+        return '?'
+    return '%d:%d' % (os.major(dev), os.minor(dev))
+
+
+def format_rate(files, bytes_, secs):
+    if not secs:
+        return '? files/s, ?/s'
+    return '%.1f files/s, %s/s' % (files / secs, human_size(int(bytes_ / secs)))
+
+
+def fit(samples):
+    '''Returns (secs_per_file, secs_per_byte) which explain the given
+    (files, bytes, secs) samples best (least squares). Falls back to a
+    single rate if the samples cannot tell both apart and returns None
+    without samples.'''
+    sff = sbb = sfb = sfs = sbs = 0.0
+    sum_files = sum_bytes = sum_secs = 0
+    for files, bytes_, secs in samples:
+        sff += files * files
+        sbb += float(bytes_) * bytes_
+        sfb += float(files) * bytes_
+        sfs += files * secs
+        sbs += bytes_ * secs
+        sum_files += files
+        sum_bytes += bytes_
+        sum_secs += secs
+    det = sff * sbb - sfb * sfb
+    if det > 1e-6 * sff * sbb:
+        per_file = (sfs * sbb - sbs * sfb) / det
+        per_byte = (sbs * sff - sfs * sfb) / det
+        if per_file >= 0 and per_byte >= 0:
+            return per_file, per_byte
+    if sum_bytes:
+        return 0.0, float(sum_secs) / sum_bytes
+    if sum_files:
+        return float(sum_secs) / sum_files, 0.0
+    return None
+
+
+def predict(index, changed, files_found):
+    '''Predicts the duration of a run from the throughput of the previous
+    ones. changed holds (dev, files, bytes) rows (see
+    Index.get_changed_by_device).
+
+    Returns a dict of devices (dev -> secs), copy and finish secs. Devices
+    which have not been read before are predicted from all devices. Values
+    are None without any history.
+    '''
+    devices = {}
+    overall = fit(index.get_device_runs(limit=HISTORY_RUNS))
+    for dev, files, bytes_ in changed:
+        rates = fit(index.get_device_runs(dev, HISTORY_RUNS)) or overall
+        devices[dev] = (rates[0] * files + rates[1] * bytes_) if rates else None
+    copy = None
+    if changed and None not in devices.values():
+        copy = sum(devices.values())
+    elif not changed:
+        copy = 0.0
+    # Finishing mostly moves the rows of the scan from table to table.
+    finish = None
+    runs = [dict(zip(RUN_FIELDS, row)) for row in index.get_runs(HISTORY_RUNS)]
+    ratios = [run['finish_secs'] / run['files'] for run in runs
+              if run['finish_secs'] is not None and run['files']]
+    if ratios:
+        finish = sum(ratios) / len(ratios) * files_found
+    return dict(devices=devices, copy=copy, finish=finish)
@@ -0,0 +1,289 @@
+from os.path import exists
+from os import rename, remove
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+import mmap
+import struct
+import time
+import logging
+
+
+logger = logging.getLogger('snapshot')
+
+# Files get diffed by SQL joins between cur_files and files.
+DIFF_ENGINE_SQLITE = 'sqlite'
+# Files get diffed by a merge join against a memory mapped snapshot of the
+# previous scan while they are fed into the index (see Snapshot).
+DIFF_ENGINE_SNAPSHOT = 'snapshot'
+DIFF_ENGINES = (DIFF_ENGINE_SQLITE, DIFF_ENGINE_SNAPSHOT)
+
+# Values of the state column of cur_files set by the snapshot engine.
+STATE_UNCHANGED = 0
+STATE_ADDED = 1
+STATE_MODIFIED = 2
+
+MAGIC = b'CTSNAP01'
+# Magic, token, number of files, number of dirs, length of the dir blob,
+# length of the name blob. Padded to a multiple of 8.
+HEADER = struct.Struct('<8s36s4Q')
+HEADER_SIZE = (HEADER.size + 7) // 8 * 8
+
+# Rows buffered per section while writing.
+WRITE_BUFFER = 65536
+
+
+def _encode(value):
+    if isinstance(value, bytes):  # Python 2
+        return value
+    return value.encode('utf-8', 'surrogateescape')
+
+
+def _decode(value):
+    if str is bytes:  # Python 2
+        return value
+    return value.decode('utf-8', 'surrogateescape')
+
+
+def _column(mm, offset, typecode, count):
+    size = count * 8
+    try:
+        return memoryview(mm)[offset:offset + size].cast(typecode)
+    except (AttributeError, TypeError):  # Python 2 has to copy.
+        column = array(typecode)
+        column.fromstring(mm[offset:offset + size])
+        return column
+
+
+def _layout(num_files, num_dirs):
+    '''Returns the offsets of the sections: dir offsets, dir starts, name
+    offsets, mtimes, sizes, inodes and the blobs of dirs and names.'''
+    offsets = []
+    offset = HEADER_SIZE
+    for count in (num_dirs + 1, num_dirs + 1, num_files + 1,
+                  num_files, num_files, num_files):
+        offsets.append(offset)
+        offset += count * 8
+    offsets.append(offset)  # Dir blob.
+    return offsets
+
+
+class _Strings(object):
+    '''Sequence of the strings (as bytes) stored in a blob.'''
+
+    def __init__(self, mm, offsets, blob_offset):
+        super(_Strings, self).__init__()
+        self._mm = mm
+        self._offsets = offsets
+        self._blob_offset = blob_offset
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        offset = self._blob_offset
+        return self._mm[offset + self._offsets[i]:offset + self._offsets[i + 1]]
+
+
+def _gallop(names, key, lo, hi):
+    '''Like bisect_left but fast if the result is close to lo, which it is
+    when names of a dir get looked up in order.'''
+    if lo >= hi or not names[lo] < key:
+        return lo
+    prev, step = lo, 1
+    while True:
+        probe = prev + step
+        if probe >= hi:
+            return bisect_left(names, key, prev + 1, hi)
+        if not names[probe] < key:
+            return bisect_left(names, key, prev + 1, probe)
+        prev = probe
+        step *= 2
+
+
+class _SectionWriter(object):
+
+    def __init__(self, handle, offset, typecode=None):
+        super(_SectionWriter, self).__init__()
+        self._handle = handle
+        self._offset = offset
+        self._typecode = typecode
+        self._buffer = array(typecode) if typecode else []
+
+    def append(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) >= WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self._typecode:
+            data = self._buffer.tostring() if str is bytes else self._buffer.tobytes()
+            self._buffer = array(self._typecode)
+        else:
+            data = b''.join(self._buffer)
+            self._buffer = []
+        self._handle.seek(self._offset)
+        self._handle.write(data)
+        self._offset += len(data)
+
+
+def write_snapshot(path, db_conn, token):
+    '''Writes the files table of the index into a snapshot file.'''
+    start = time.time()
+    cur = db_conn.cursor()
+    num_files, = cur.execute('''SELECT count(*) FROM files''').fetchone()
+    num_dirs, = cur.execute('''SELECT count(DISTINCT path) FROM files''').fetchone()
+    offsets = _layout(num_files, num_dirs)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as handle:
+        dir_offsets = _SectionWriter(handle, offsets[0], 'Q')
+        dir_starts = _SectionWriter(handle, offsets[1], 'Q')
+        name_offsets = _SectionWriter(handle, offsets[2], 'Q')
+        mtimes = _SectionWriter(handle, offsets[3], 'd')
+        sizes = _SectionWriter(handle, offsets[4], 'q')
+        inodes = _SectionWriter(handle, offsets[5], 'Q')
+        # The length of the dir blob is not known yet, so the names go into
+        # a file of their own first.
+        names_path = path + '.names'
+        with open(names_path, 'w+b') as names_handle:
+            names = _SectionWriter(names_handle, 0)
+            dirs = _SectionWriter(handle, offsets[6])
+            dir_pos = name_pos = 0
+            last_path = None
+            i = 0
+            sql = '''SELECT path, name, mtime, size, inode FROM files
+                     ORDER BY path, name'''
+            for dir_path, name, mtime, size, inode in cur.execute(sql):
+                if dir_path != last_path:
+                    dir_path_ = _encode(dir_path)
+                    dir_offsets.append(dir_pos)
+                    dir_starts.append(i)
+                    dirs.append(dir_path_)
+                    dir_pos += len(dir_path_)
+                    last_path = dir_path
+                name = _encode(name)
+                name_offsets.append(name_pos)
+                names.append(name)
+                name_pos += len(name)
+                mtimes.append(mtime or 0)
+                sizes.append(size or 0)
+                inodes.append(inode or 0)
+                i += 1
+            dir_offsets.append(dir_pos)
+            dir_starts.append(i)
+            name_offsets.append(name_pos)
+            for section in (dir_offsets, dir_starts, name_offsets, mtimes,
+                            sizes, inodes, dirs, names):
+                section.flush()
+            names_handle.seek(0)
+            handle.seek(offsets[6] + dir_pos)
+            data = names_handle.read(1024 * 1024)
+            while data:
+                handle.write(data)
+                data = names_handle.read(1024 * 1024)
+        remove(names_path)
+        handle.seek(0)
+        handle.write(HEADER.pack(MAGIC, token.encode('ascii'), i, num_dirs,
+                                 dir_pos, name_pos))
+    rename(tmp_path, path)
+    logger.info('Wrote snapshot of %d files in %.2f secs.' %
+                (num_files, time.time() - start))
+
+
+class Snapshot(object):
+    '''Read-only view of a snapshot file and the diff against it.
+
+    A snapshot holds the files of the previous scan sorted by (dir, name)
+    in columns: the dirs with the position of their first file and per file
+    its name, mtime, size and inode. Nothing but the mmap is loaded, dirs
+    and names get found by binary search.
+    '''
+
+    def __init__(self, path):
+        super(Snapshot, self).__init__()
+        self._handle = open(path, 'rb')
+        self._mm = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, token, num_files, num_dirs, dirs_len, names_len = \
+            HEADER.unpack(self._mm[:HEADER.size])
+        if magic != MAGIC:
+            self.close()
+            raise Exception('Not a snapshot: %s' % path)
+        self.token = token.rstrip(b'\0').decode('ascii')
+        self.num_files = num_files
+        offsets = _layout(num_files, num_dirs)
+        self._columns = [
+            _column(self._mm, offsets[0], 'Q', num_dirs + 1),
+            _column(self._mm, offsets[1], 'Q', num_dirs + 1),
+            _column(self._mm, offsets[2], 'Q', num_files + 1),
+            _column(self._mm, offsets[3], 'd', num_files),
+        ]
+        dir_offsets, self._dir_starts, name_offsets, self._mtimes = self._columns
+        self._dirs = _Strings(self._mm, dir_offsets, offsets[6])
+        self._names = _Strings(self._mm, name_offsets, offsets[6] + dirs_len)
+        self._seen = bytearray(num_files)
+
+    @staticmethod
+    def load(path, token):
+        '''Returns the snapshot at path if it belongs to token else None.'''
+        if not exists(path):
+            return None
+        try:
+            snapshot = Snapshot(path)
+        except Exception as reason:
+            logger.warning('Could not load snapshot: %s' % reason)
+            return None
+        if snapshot.token != token:
+            snapshot.close()
+            return None
+        return snapshot
+
+    def _find_dir(self, dir_path):
+        # Returns the range of the files of the dir.
+        key = _encode(dir_path)
+        i = bisect_left(self._dirs, key, 0, len(self._dirs))
+        if i < len(self._dirs) and self._dirs[i] == key:
+            return self._dir_starts[i], self._dir_starts[i + 1]
+        return 0, 0
+
+    def diff(self, dir_path, rows):
+        '''Returns the file rows (see FILE_FIELDS) of a dir, or of a batch
+        of its files, with their STATE_* appended.'''
+        lo, hi = self._find_dir(dir_path)
+        if lo == hi:
+            return [row + (STATE_ADDED,) for row in rows]
+        names = self._names
+        mtimes = self._mtimes
+        seen = self._seen
+        results = []
+        pos = lo
+        for key, row in sorted(((_encode(row[1]), row) for row in rows),
+                               key=itemgetter(0)):
+            pos = _gallop(names, key, pos, hi)
+            if pos < hi and names[pos] == key:
+                seen[pos] = 1
+                state = (STATE_UNCHANGED if mtimes[pos] == row[2]
+                         else STATE_MODIFIED)
+                pos += 1
+            else:
+                state = STATE_ADDED
+            results.append(row + (state,))
+        return results
+
+    def get_deleted(self):
+        '''Yields (path, name) of all files which have not been seen by
+        diff.'''
+        seen = self._seen
+        dir_starts = self._dir_starts
+        pos = seen.find(b'\0')
+        while pos != -1:
+            i = bisect_right(dir_starts, pos) - 1
+            yield _decode(self._dirs[i]), _decode(self._names[pos])
+            pos = seen.find(b'\0', pos + 1)
+
+    def close(self):
+        for column in getattr(self, '_columns', ()):
+            if isinstance(column, memoryview):
+                column.release()
+        self._columns = []
+        self._mm.close()
+        self._handle.close()
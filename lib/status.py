@@ -0,0 +1,318 @@
+from os.path import exists, dirname, join, basename
+from os import remove, chmod, getpid, sysconf, stat as os_stat
+from collections import OrderedDict, deque
+from threading import Thread, Lock
+import socket
+import json
+import errno
+import time
+import logging
+try:
+    import resource
+except ImportError:  # Not on every platform.
+    resource = None
+
+from lib.util import make_private_dir
+
+
+logger = logging.getLogger('status')
+
+FORMAT_JSON = 'json'
+FORMAT_OPENMETRICS = 'openmetrics'
+FORMATS = (FORMAT_JSON, FORMAT_OPENMETRICS)
+
+CONTENT_TYPES = {
+    FORMAT_JSON: 'application/json',
+    FORMAT_OPENMETRICS: 'application/openmetrics-text; version=1.0.0; charset=utf-8',
+}
+
+# Seconds of progress the current throughput is averaged over.
+THROUGHPUT_WINDOW = 10
+
+PROGRESS_KEYS = ('files_done', 'files_total', 'bytes_done', 'bytes_total')
+
+
+def get_socket_path(status_dir, profile, kind):
+    '''Returns the path of the socket of a backup or restore (kind) of a
+    profile.'''
+    return join(status_dir, '%s.%s.sock' % (basename(profile), kind))
+
+
+def _get_memory():
+    '''Returns the current and the peak resident set size in bytes.'''
+    rss = max_rss = None
+    try:
+        with open('/proc/self/statm') as handle:
+            rss = int(handle.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    if resource:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if rss is not None:
+            max_rss = max(max_rss, rss)  # Both are sampled.
+    return rss, max_rss
+
+
+class Status(object):
+    '''What a running backup or restore is doing.
+
+    The parts of the process register callables which get asked on every
+    request: add_queue for the sizes of queues (summed by name) and
+    add_progress for dicts of PROGRESS_KEYS (summed over all).
+    '''
+
+    def __init__(self, kind):
+        super(Status, self).__init__()
+        self._kind = kind
+        self._started = time.time()
+        self._stage = None
+        self._stage_started = self._started
+        self._queues = OrderedDict()
+        self._progress = []
+        self._samples = deque()  # (time, files_done, bytes_done)
+        self._lock = Lock()
+
+    def set_stage(self, stage):
+        self._stage = stage
+        self._stage_started = time.time()
+
+    def add_queue(self, name, get_size):
+        self._queues.setdefault(name, []).append(get_size)
+
+    def add_progress(self, get_progress):
+        self._progress.append(get_progress)
+
+    def _get_progress(self):
+        progress = dict((key, 0) for key in PROGRESS_KEYS)
+        for get_progress in self._progress:
+            for key, value in get_progress().items():
+                progress[key] += value
+        progress['files_remaining'] = max(0, progress['files_total'] -
+                                          progress['files_done'])
+        progress['bytes_remaining'] = max(0, progress['bytes_total'] -
+                                          progress['bytes_done'])
+        return progress
+
+    def sample(self):
+        '''Records the progress for the throughput. Gets called regularly by
+        the StatusServer.'''
+        progress = self._get_progress()
+        now = time.time()
+        with self._lock:
+            samples = self._samples
+            samples.append((now, progress['files_done'], progress['bytes_done']))
+            while now - samples[0][0] > THROUGHPUT_WINDOW:
+                samples.popleft()
+            secs = now - samples[0][0]
+            if secs:
+                throughput = dict(
+                    files_per_sec=(samples[-1][1] - samples[0][1]) / secs,
+                    bytes_per_sec=(samples[-1][2] - samples[0][2]) / secs)
+            else:
+                throughput = dict(files_per_sec=0.0, bytes_per_sec=0.0)
+        return progress, throughput
+
+    def get(self):
+        '''Returns the status as a dict.'''
+        progress, throughput = self.sample()
+        now = time.time()
+        rss, max_rss = _get_memory()
+        return OrderedDict((
+            ('kind', self._kind),
+            ('pid', getpid()),
+            ('stage', self._stage),
+            ('stage_secs', now - self._stage_started),
+            ('uptime_secs', now - self._started),
+            ('queues', OrderedDict((name, sum(get_size() for get_size in funcs))
+                                   for name, funcs in self._queues.items())),
+            ('progress', progress),
+            ('throughput', throughput),
+            ('memory', OrderedDict((('rss_bytes', rss),
+                                    ('max_rss_bytes', max_rss)))),
+        ))
+
+    def format(self, format_=FORMAT_JSON):
+        status = self.get()
+        if format_ == FORMAT_JSON:
+            return json.dumps(status, indent=2) + '\n'
+        if format_ == FORMAT_OPENMETRICS:
+            return format_openmetrics(status)
+        raise Exception('Unknown status format: %s' % format_)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_openmetrics(status):
+    '''Returns the dict of Status.get in the OpenMetrics text format.'''
+    lines = []
+
+    def metric(name, type_, samples, unit=None, help_=None):
+        name = 'cronotrigger_' + name
+        lines.append('# TYPE %s %s' % (name, type_))
+        if unit:
+            lines.append('# UNIT %s %s' % (name, unit))
+        if help_:
+            lines.append('# HELP %s %s' % (name, help_))
+        for suffix, labels, value in samples:
+            if value is None:
+                continue
+            labels = ','.join('%s="%s"' % (key, _escape(label))
+                              for key, label in labels)
+            lines.append('%s%s%s %s' % (name, suffix,
+                                        '{%s}' % labels if labels else '',
+                                        repr(float(value))
+                                        if isinstance(value, float) else value))
+
+    progress = status['progress']
+    throughput = status['throughput']
+    memory = status['memory']
+    metric('run', 'info', [('_info', [('kind', status['kind']),
+                                      ('stage', status['stage'] or '')], 1)],
+           help_='Kind and current stage of the running process.')
+    metric('stage_seconds', 'gauge', [('', [], status['stage_secs'])],
+           unit='seconds', help_='Time spent in the current stage.')
+    metric('uptime_seconds', 'gauge', [('', [], status['uptime_secs'])],
+           unit='seconds')
+    metric('queue_items', 'gauge', [('', [('queue', name)], size)
+                                    for name, size in status['queues'].items()],
+           help_='Items waiting in the queues between the threads.')
+    metric('files', 'gauge', [('', [('state', 'done')], progress['files_done']),
+                              ('', [('state', 'remaining')],
+                               progress['files_remaining'])])
+    metric('bytes', 'gauge', [('', [('state', 'done')], progress['bytes_done']),
+                              ('', [('state', 'remaining')],
+                               progress['bytes_remaining'])],
+           unit='bytes')
+    metric('throughput_files_per_second', 'gauge',
+           [('', [], throughput['files_per_sec'])],
+           help_='Files read per second within the last %d seconds.' %
+                 THROUGHPUT_WINDOW)
+    metric('throughput_bytes_per_second', 'gauge',
+           [('', [], throughput['bytes_per_sec'])],
+           help_='Bytes read per second within the last %d seconds.' %
+                 THROUGHPUT_WINDOW)
+    metric('memory_rss_bytes', 'gauge', [('', [], memory['rss_bytes'])],
+           unit='bytes')
+    metric('memory_max_rss_bytes', 'gauge', [('', [], memory['max_rss_bytes'])],
+           unit='bytes')
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class StatusServer(Thread):
+    '''Answers requests for the status on a Unix socket.
+
+    A request is one line: a format name (see FORMATS, default is JSON) or
+    an HTTP GET of /metrics (OpenMetrics) or any other path (JSON), so that
+    e.g. "curl --unix-socket <path> http://localhost/metrics" works.
+    '''
+
+    def __init__(self, status, path):
+        super(StatusServer, self).__init__()
+        self.daemon = True  # Must not keep a finished process alive.
+        self._status = status
+        self._path = path
+        self._running = True
+        make_private_dir(dirname(path))
+        if exists(path):
+            self._remove_stale(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        chmod(path, 0o600)
+        self._inode = os_stat(path).st_ino  # Not to remove another one's.
+        self._socket.listen(5)
+        self._socket.settimeout(1.0)
+
+    @staticmethod
+    def _remove_stale(path):
+        # Only a socket nobody listens on any more is left behind by a
+        # process which got killed.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.settimeout(1.0)
+            probe.connect(path)
+        except socket.error as error:
+            if error.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            if exists(path):
+                remove(path)
+            return
+        finally:
+            probe.close()
+        raise Exception('Status socket is in use by another process: %s' % path)
+
+    def _read_request(self, conn):
+        data = b''
+        while b'\n' not in data and len(data) < 4096:
+            chunk = conn.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        return data.split(b'\n', 1)[0].strip().decode('ascii', 'replace')
+
+    def _handle(self, conn):
+        conn.settimeout(5.0)
+        request = self._read_request(conn)
+        if request.startswith('GET '):
+            path = request.split()[1] if len(request.split()) > 1 else '/'
+            format_ = (FORMAT_OPENMETRICS if path.rstrip('/').endswith('/metrics')
+                       else FORMAT_JSON)
+            body = self._status.format(format_).encode('utf-8')
+            conn.sendall(('HTTP/1.0 200 OK\r\n'
+                          'Content-Type: %s\r\n'
+                          'Content-Length: %d\r\n\r\n' %
+                          (CONTENT_TYPES[format_], len(body))).encode('ascii'))
+            conn.sendall(body)
+        else:
+            format_ = request or FORMAT_JSON
+            if format_ not in FORMATS:
+                conn.sendall(('Unknown format: %s\n' % format_).encode('utf-8'))
+                return
+            conn.sendall(self._status.format(format_).encode('utf-8'))
+
+    def run(self):
+        logger.debug('Listening on: %s' % self._path)
+        while self._running:
+            self._status.sample()
+            try:
+                conn, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break  # Closed by stop.
+            try:
+                self._handle(conn)
+            except Exception as reason:
+                logger.debug('Could not answer status request: %s' % reason)
+            finally:
+                conn.close()
+
+    def stop(self):
+        self._running = False
+        self._socket.close()
+        try:
+            if os_stat(self._path).st_ino == self._inode:
+                remove(self._path)
+        except OSError:
+            pass
+
+
+def query(path, format_=FORMAT_JSON):
+    '''Returns the status of the process listening on path as text.'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(5.0)
+        client.connect(path)
+        client.sendall((format_ + '\n').encode('ascii'))
+        data = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        client.close()
+    return b''.join(data).decode('utf-8')
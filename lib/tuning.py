@@ -0,0 +1,318 @@
+from os.path import join, exists, realpath, dirname
+import os
+import json
+import time
+import random
+import logging
+
+from lib.copy import CHUNK_SIZE, CHUNK_PART_SIZE, QUEUE_SIZE
+from lib.delta import BLOCK_SIZE
+from lib.index import FEEDER_QUEUE_SIZE
+from lib.pagecache import drop, DIRECT_BUFFER_SIZE
+from lib.human_size import human_size
+
+
+logger = logging.getLogger('tuning')
+
+# Measurements of the devices get cached in this file within the user
+# config dir.
+CACHE_NAME = 'tuning.json'
+
+# Bytes written to a destination and read from a source while measuring.
+CALIBRATION_SIZE = 32 * 1024 * 1024
+# Number of small reads or syncs the latency gets averaged over.
+LATENCY_SAMPLES = 16
+# Entries of a source looked at while searching files to read.
+MAX_SAMPLE_ENTRIES = 5000
+IO_SIZE = 1024 * 1024
+LATENCY_IO_SIZE = 4096
+
+# Possible part sizes. Each one divides BLOCK_SIZE and DIRECT_BUFFER_SIZE.
+PART_SIZES = tuple(size for size in (64 * 1024 << i for i in range(5))
+                   if BLOCK_SIZE % size == 0 and DIRECT_BUFFER_SIZE % size == 0)
+# A part is what the source reads in this many seconds, a chunk what it
+# reads in CHUNK_SECS.
+PART_SECS = 0.0005
+CHUNK_SECS = 0.05
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+# The queue in front of a Writer holds what the destination writes in this
+# many seconds.
+QUEUE_SECS = 1.0
+MIN_QUEUE_SIZE = 4
+MAX_QUEUE_BYTES = 256 * 1024 * 1024
+# Devices with a latency below this are solid state and alike. They cope
+# with several restore workers and keep up with the Feeder.
+FAST_LATENCY = 0.002  # Secs
+FAST_FEEDER_QUEUE_SIZE = 10000
+FAST_RESTORE_WORKERS = 4
+
+
+def _timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def _measure_destination(path):
+    '''Writes a file into path and reads it back. Returns write and read
+    bandwidth (bytes/sec) and latency (secs).'''
+    tmp_path = join(path, '.cronotrigger-calibration')
+    data = os.urandom(IO_SIZE)
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        # Latency of small synced writes.
+        latencies = []
+        for i in range(LATENCY_SAMPLES):
+            start = time.time()
+            os.write(fd, data[:LATENCY_IO_SIZE])
+            os.fsync(fd)
+            latencies.append(time.time() - start)
+        write_latency = sorted(latencies)[len(latencies) // 2]
+        os.lseek(fd, 0, os.SEEK_SET)
+        start = time.time()
+        for i in range(CALIBRATION_SIZE // IO_SIZE):
+            os.write(fd, data)
+        os.fsync(fd)
+        write_bw = CALIBRATION_SIZE / (time.time() - start)
+        # Reading back has to come from the device.
+        drop(fd)
+        os.lseek(fd, 0, os.SEEK_SET)
+        start = time.time()
+        while os.read(fd, IO_SIZE):
+            pass
+        read_bw = CALIBRATION_SIZE / (time.time() - start)
+        drop(fd)
+        latencies = []
+        for i in range(LATENCY_SAMPLES):
+            offset = random.randrange(CALIBRATION_SIZE // LATENCY_IO_SIZE) * LATENCY_IO_SIZE
+            os.lseek(fd, offset, os.SEEK_SET)
+            latencies.append(_timed(os.read, fd, LATENCY_IO_SIZE)[0])
+        read_latency = sorted(latencies)[len(latencies) // 2]
+    finally:
+        os.close(fd)
+        os.remove(tmp_path)
+    return dict(read_bw=read_bw, read_latency=read_latency,
+                write_bw=write_bw, write_latency=write_latency)
+
+
+def _sample_files(path):
+    '''Yields (path, size) of regular files below path, at most
+    MAX_SAMPLE_ENTRIES entries get looked at.'''
+    num_entries = 0
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            num_entries += 1
+            if num_entries > MAX_SAMPLE_ENTRIES:
+                return
+            file_path = join(root, name)
+            try:
+                stat = os.lstat(file_path)
+            except OSError:
+                continue
+            if stat.st_size and (stat.st_mode & 0o170000) == 0o100000:
+                yield file_path, stat.st_size
+
+
+def _measure_source(path):
+    '''Reads existing files below path. Returns read bandwidth (bytes/sec)
+    and latency (secs) or None for both if nothing could be read. The pages
+    of the files read get dropped from the page cache before.'''
+    latencies = []
+    num_bytes = 0
+    secs = 0.0
+    for file_path, size in _sample_files(path):
+        if num_bytes >= CALIBRATION_SIZE and len(latencies) >= LATENCY_SAMPLES:
+            break
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            drop(fd)
+            if len(latencies) < LATENCY_SAMPLES:
+                latencies.append(_timed(os.read, fd, LATENCY_IO_SIZE)[0])
+                drop(fd)
+                os.lseek(fd, 0, os.SEEK_SET)
+            if size >= IO_SIZE and num_bytes < CALIBRATION_SIZE:
+                start = time.time()
+                data = os.read(fd, IO_SIZE)
+                while data:
+                    num_bytes += len(data)
+                    data = os.read(fd, IO_SIZE)
+                secs += time.time() - start
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    return dict(read_bw=num_bytes / secs if secs and num_bytes else None,
+                read_latency=(sorted(latencies)[len(latencies) // 2]
+                              if latencies else None))
+
+
+def pick_settings(sources, destination):
+    '''Returns the settings for copying from the measured sources to the
+    measured destination: chunk_size, part_size, queue_size,
+    feeder_queue_size and restore_workers. Unknown values give the
+    defaults.
+
+    Chunk and part size depend on the sources only, so that all Writers of
+    a fan out agree on the part size with the Reader.
+    '''
+    read_bws = [source['read_bw'] for source in sources if source.get('read_bw')]
+    read_bw = min(read_bws) if read_bws else None
+    read_latencies = [source['read_latency'] for source in sources
+                      if source.get('read_latency') is not None]
+    read_latency = max(read_latencies) if read_latencies else None
+    write_bw = destination.get('write_bw')
+    write_latency = destination.get('write_latency')
+
+    part_size = CHUNK_PART_SIZE
+    chunk_size = CHUNK_SIZE
+    if read_bw:
+        part_size = max([PART_SIZES[0]] + [size for size in PART_SIZES
+                                           if size <= read_bw * PART_SECS])
+        chunk_size = int(min(MAX_CHUNK_SIZE,
+                             max(MIN_CHUNK_SIZE, read_bw * CHUNK_SECS)))
+        chunk_size -= chunk_size % part_size
+    queue_size = QUEUE_SIZE
+    if write_bw:
+        queue_size = int(min(MAX_QUEUE_BYTES // chunk_size,
+                             max(MIN_QUEUE_SIZE,
+                                 write_bw * QUEUE_SECS // chunk_size)))
+    feeder_queue_size = FEEDER_QUEUE_SIZE
+    if write_latency is not None and write_latency < FAST_LATENCY:
+        feeder_queue_size = FAST_FEEDER_QUEUE_SIZE
+    restore_workers = None  # As configured.
+    if read_latency is not None:
+        restore_workers = FAST_RESTORE_WORKERS if read_latency < FAST_LATENCY else 1
+    return dict(chunk_size=chunk_size, part_size=part_size,
+                queue_size=queue_size, feeder_queue_size=feeder_queue_size,
+                restore_workers=restore_workers)
+
+
+class Calibration(object):
+    '''Measurements of devices, cached by path in the user config dir.
+
+    Sources only get read, destinations get written to. A measurement is
+    taken again if it is older than max_age days or if the path is on
+    another device by now.
+    '''
+
+    def __init__(self, config_dir, max_age=30):
+        super(Calibration, self).__init__()
+        self._cache_path = join(config_dir, CACHE_NAME)
+        self._max_age = max_age * 24 * 3600
+        self._devices = {}
+        self._changed = False
+        if exists(self._cache_path):
+            try:
+                with open(self._cache_path) as handle:
+                    self._devices = json.load(handle)['devices']
+            except (ValueError, KeyError, IOError) as reason:
+                logger.warning('Could not load tuning cache: %s' % reason)
+
+    def _measure(self, path, kind, measure):
+        path = realpath(path)
+        key = '%s:%s' % (kind, path)
+        dev = os.stat(path).st_dev
+        cached = self._devices.get(key)
+        if (cached and cached['dev'] == dev and
+                time.time() - cached['measured'] < self._max_age):
+            return cached
+        logger.info('Measuring %s: %s' % (kind, path))
+        result = measure(path)
+        result.update(dev=dev, measured=time.time())
+        logger.info('Measured %s: %s' % (kind, ', '.join(
+            '%s %s/s, %.2f ms' % (op, human_size(int(result[op + '_bw'])),
+                                  result[op + '_latency'] * 1000)
+            for op in ('read', 'write')
+            if result.get(op + '_bw') and result.get(op + '_latency') is not None)
+            or 'nothing to read'))
+        self._devices[key] = result
+        self._changed = True
+        return result
+
+    def measure_source(self, path):
+        return self._measure(path, 'source', _measure_source)
+
+    def measure_destination(self, path):
+        return self._measure(path, 'destination', _measure_destination)
+
+    def get_settings(self, source_paths, destination_path):
+        return pick_settings([self.measure_source(path) for path in source_paths],
+                             self.measure_destination(destination_path))
+
+    def save(self):
+        if not self._changed:
+            return
+        if not exists(dirname(self._cache_path)):
+            os.makedirs(dirname(self._cache_path))
+        tmp_path = self._cache_path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump(dict(devices=self._devices), handle, indent=2, sort_keys=True)
+        os.rename(tmp_path, self._cache_path)
+        self._changed = False
+
+
+def resize_queue(queue, maxsize):
+    '''Changes the maximum size of a Queue.Queue in place. Waiting putters
+    get woken up if it grew.'''
+    with queue.mutex:
+        queue.maxsize = maxsize
+        queue.not_full.notify_all()
+
+
+class DepthTuner(object):
+    '''Grows a queue while copying as long as that makes it faster.
+
+    Every interval the throughput gets compared with the one before. Once it
+    does not change much anymore the queue is doubled. If the next interval
+    is not faster by at least GAIN, the queue is shrunk again and left alone
+    for a while.
+    '''
+
+    GAIN = 0.05
+    BACKOFF = 6  # Intervals.
+
+    def __init__(self, queue, max_size, interval=5.0):
+        super(DepthTuner, self).__init__()
+        self._queue = queue
+        self._max_size = max_size
+        self._interval = interval
+        self._last_time = None
+        self._last_bytes = 0
+        self._last_rate = None
+        self._grown_from = None  # Size before the last growth.
+        self._backoff = 0
+        self._logger = logging.getLogger('tuning.depth')
+
+    def update(self, bytes_done):
+        '''Has to be called regularly with the bytes copied so far.'''
+        now = time.time()
+        if self._last_time is None:
+            self._last_time, self._last_bytes = now, bytes_done
+            return
+        if now - self._last_time < self._interval:
+            return
+        rate = (bytes_done - self._last_bytes) / (now - self._last_time)
+        self._last_time, self._last_bytes = now, bytes_done
+        last_rate, self._last_rate = self._last_rate, rate
+        if not rate or last_rate is None:
+            return
+        size = self._queue.maxsize
+        if self._grown_from is not None:
+            if rate < last_rate * (1 + self.GAIN):
+                self._logger.debug('Queue size %d did not help, back to %d.' %
+                                   (size, self._grown_from))
+                resize_queue(self._queue, self._grown_from)
+                self._backoff = self.BACKOFF
+            self._grown_from = None
+        elif self._backoff:
+            self._backoff -= 1
+        elif abs(rate - last_rate) <= last_rate * self.GAIN and size * 2 <= self._max_size:
+            self._logger.debug('Throughput plateaued, trying queue size %d.' %
+                               (size * 2))
+            self._grown_from = size
+            resize_queue(self._queue, size * 2)
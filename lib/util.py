@@ -1,14 +1,49 @@
-from os.path import expanduser
+from os.path import expanduser, dirname, exists
 from string import Template
 import socket
+import stat
+import os
 
 
 _custom_vars = {
     'hostname': socket.gethostname(),
+    'xdg_cache_home': os.environ.get('XDG_CACHE_HOME', '~/.cache'),
+    # Without a session there is no runtime dir, a private one in /tmp has
+    # to do then (see make_private_dir).
+    'xdg_runtime_dir': (os.environ.get('XDG_RUNTIME_DIR') or
+                        '/tmp/cronotrigger-%d' % os.getuid()),
 }
 
 
+def which(program):
+    '''Returns the path of program if it is found in $PATH else None.'''
+    try:
+        from shutil import which as which_  # Python 3.3+
+    except ImportError:
+        from distutils.spawn import find_executable as which_
+    return which_(program)
+
+
 def expandvars(template):
     template = Template(template).safe_substitute(_custom_vars)
     template = expanduser(template)
     return template
+
+
+def make_private_dir(path):
+    '''Creates path and its missing parents with mode 0700. Raises an
+    exception unless path and its parent are dirs (no symlinks) of the
+    current user, or root for the parent, and path is private to it.'''
+    if not exists(path):
+        parent = dirname(path)
+        if not exists(parent):
+            make_private_dir(parent)
+        os.mkdir(path, 0o700)
+    uid = os.getuid()
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or
+            stat.S_IMODE(st.st_mode) & 0o077):
+        raise Exception('Dir is not private to the user: %s' % path)
+    st = os.lstat(dirname(path))
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid not in (uid, 0):
+        raise Exception('Dir is not owned by the user: %s' % dirname(path))
@@ -0,0 +1,175 @@
+from os.path import exists, join
+from os import listdir
+from multiprocessing import Pool, cpu_count
+import sqlite3
+import hashlib
+import logging
+import time
+import re
+
+from lib.delta import get_layers, DeltaFile
+
+
+# Number of files handed to each process per batch.
+BATCH_SIZE_PER_PROCESS = 32
+READ_SIZE = 1024 * 1024  # Bytes
+
+# Kept next to the index instead of within it. The index must stay as it
+# is, else every verify run would make local copies of it outdated (see
+# IndexCache) and clash with a backup running meanwhile.
+STATE_NAME = 'verify.sqlite3'
+
+STATUS_OK = 'ok'
+STATUS_MISSING = 'missing'
+STATUS_CORRUPTED = 'corrupted'
+
+
+def _check(args):
+    # Runs within the worker processes.
+    rowid, filepath, layers, size, hash_name, hexdigest = args
+    hash_ = hashlib.new(hash_name)
+    num_bytes = 0
+    try:
+        # Delta objects only hold the changed blocks of a file.
+        with (DeltaFile(layers, size) if layers else open(filepath, 'rb')) as handle:
+            read = handle.read
+            update = hash_.update
+            data = read(READ_SIZE)
+            while data:
+                num_bytes += len(data)
+                update(data)
+                data = read(READ_SIZE)
+    except (IOError, OSError):
+        return rowid, filepath, STATUS_MISSING, 0
+    if num_bytes != size or hash_.hexdigest() != hexdigest:
+        return rowid, filepath, STATUS_CORRUPTED, num_bytes
+    return rowid, filepath, STATUS_OK, num_bytes
+
+
+class VerifyState(object):
+    '''Progress of the incremental verification per generation.'''
+
+    def __init__(self, base_path):
+        super(VerifyState, self).__init__()
+        self._db_conn = sqlite3.connect(join(base_path, STATE_NAME))
+        self._db_conn.text_factory = str
+        with self._db_conn as cur:
+            cur.execute('''CREATE TABLE IF NOT EXISTS verify_state
+                           (generation text PRIMARY KEY, position integer,
+                            verified real)''')
+
+    def get(self):
+        '''Returns a dict of generation -> (position, verified).'''
+        cur = self._db_conn.cursor()
+        sql = '''SELECT generation, position, verified FROM verify_state'''
+        return dict((row[0], row[1:]) for row in cur.execute(sql))
+
+    def set(self, generation, position, verified):
+        with self._db_conn as cur:
+            sql = '''INSERT OR REPLACE INTO verify_state
+                     (generation, position, verified) VALUES (?, ?, ?)'''
+            cur.execute(sql, (generation, position, verified))
+
+    def forget(self, generations):
+        '''Lets the generations get verified again from the start.'''
+        with self._db_conn as cur:
+            cur.executemany('''DELETE FROM verify_state WHERE generation = ?''',
+                            [(generation,) for generation in generations])
+
+    def close(self):
+        self._db_conn.close()
+
+
+class Verify(object):
+    '''Rechecks the files of all generations against the checksum catalog.
+
+    Only the backup medium is read. Each run spends at most time_budget
+    seconds and continues where the previous run stopped. Generations which
+    were never verified or verified longest ago come first. The index is
+    only read from, the progress is kept in a VerifyState.
+    '''
+
+    def __init_generations(self):
+        pattern = re.compile(r'^\d+\.\d+$')
+        generations = filter(lambda item: pattern.match(item),
+                             listdir(self._base_path))
+        self._generations = sorted(generations, key=lambda v: float(v))
+
+    def __init__(self, base_path, index, hash_name, processes=0):
+        super(Verify, self).__init__()
+        self._base_path = base_path
+        self._index = index
+        self._hash_name = hash_name
+        self._processes = processes or cpu_count()
+        self._logger = logging.getLogger('verify')
+        if not exists(base_path):
+            raise Exception('Backup path not found: %s' % base_path)
+        self.__init_generations()
+        self._state = VerifyState(base_path)
+        self._deltas = None  # Loaded when starting to verify.
+        self.num_files = 0
+        self.num_bytes = 0
+        self.missing = []
+        self.corrupted = []
+
+    def _get_queue(self):
+        state = self._state.get()
+        def sort_key(generation):
+            position, verified = state.get(generation, (0, None))
+            if position:  # Unfinished, continue with it first.
+                return (0, 0)
+            return (1, verified or 0)
+        queue = sorted(self._generations, key=sort_key)
+        return [(generation, state.get(generation, (0, None))[0])
+                for generation in queue]
+
+    def _get_layers(self, generation, path, name):
+        if (generation, path, name) not in self._deltas:
+            return None
+        return get_layers(self._base_path, self._deltas, generation, path, name)
+
+    def _verify_generation(self, pool, generation, position, deadline):
+        gen_path = join(self._base_path, generation)
+        batch_size = self._processes * BATCH_SIZE_PER_PROCESS
+        while time.time() < deadline:
+            rows = self._index.get_checksums(generation, position, batch_size)
+            if not rows:
+                self._state.set(generation, 0, time.time())
+                self._logger.info('Verified generation: %s' % generation)
+                return True
+            jobs = [(rowid, join(gen_path, path.lstrip('./'), name),
+                     self._get_layers(generation, path, name), size,
+                     self._hash_name, hash_)
+                    for rowid, path, name, size, hash_ in rows]
+            for rowid, filepath, status, num_bytes in pool.imap(_check, jobs):
+                self.num_files += 1
+                self.num_bytes += num_bytes
+                if status == STATUS_MISSING:
+                    self._logger.error('Missing file: %s' % filepath)
+                    self.missing.append(filepath)
+                elif status == STATUS_CORRUPTED:
+                    self._logger.error('Corrupted file: %s' % filepath)
+                    self.corrupted.append(filepath)
+            position = rows[-1][0]
+            self._state.set(generation, position, None)
+        return False
+
+    def run(self, time_budget):
+        deadline = time.time() + time_budget
+        self._deltas = self._index.get_deltas()
+        pool = Pool(self._processes)
+        try:
+            for generation, position in self._get_queue():
+                if time.time() >= deadline:
+                    break
+                self._logger.info('Verifying generation: %s' % generation)
+                if not self._verify_generation(pool, generation, position,
+                                               deadline):
+                    self._logger.info('Time budget used up. '
+                                      'Will continue next time.')
+                    break
+        finally:
+            pool.close()
+            pool.join()
+            self._state.close()
+        return not (self.missing or self.corrupted)
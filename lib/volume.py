@@ -1,28 +1,54 @@
-# TODO implement shell workaround if gi cannot be loaded.
-
-from os.path import join
-from gi.repository import Gio, GObject
-from gi.repository.GLib import GError
+from os.path import join, exists, realpath
+from collections import OrderedDict
+import subprocess
 import logging
+import os
+import re
 
-
-logger = logging.getLogger('volume')
+from lib.util import which
 
 
-def __mount_done_cb(obj, res, user_data):
-    user_data['status'] = obj.mount_finish(res)
-    user_data['loop'].quit()
+logger = logging.getLogger('volume')
 
 
-def mount(uri):
+def _split_uri(uri):
     protocol, path = uri.split('://', 1)
     # print(protocol, path)
-    if protocol == 'volume':
-        volume_name, path = path.split('/', 1)
-        mo = Gio.MountOperation()
+    if protocol != 'volume':
+        raise Exception('Unknown protocol: %s' % protocol)
+    volume_name, path = path.split('/', 1)
+    return volume_name, path
+
+
+class GioVolumes(object):
+    '''Mounts volumes through GIO like the file manager does. Needs a
+    desktop session.'''
+
+    name = 'gio'
+
+    def __init__(self):
+        super(GioVolumes, self).__init__()
+        # Headless, e.g. from cron, mounting through GIO would hang or fail.
+        if not os.environ.get('DBUS_SESSION_BUS_ADDRESS'):
+            raise ImportError('No desktop session')
+        # Loaded only here as importing gi takes its time.
+        from gi.repository import Gio, GObject
+        from gi.repository.GLib import GError
+        self._Gio = Gio
+        self._GObject = GObject
+        self._GError = GError
+
+    @staticmethod
+    def __mount_done_cb(obj, res, user_data):
+        user_data['status'] = obj.mount_finish(res)
+        user_data['loop'].quit()
+
+    def mount(self, uri):
+        volume_name, path = _split_uri(uri)
+        mo = self._Gio.MountOperation()
         mo.set_anonymous(True)
-        vm = Gio.VolumeMonitor.get()
-        loop = GObject.MainLoop()
+        vm = self._Gio.VolumeMonitor.get()
+        loop = self._GObject.MainLoop()
         user_data = dict(loop=loop, status=None)
         volume_found = False
         volume_mounted = False
@@ -31,7 +57,7 @@ def mount(uri):
             if name == volume_name:
                 mount = volume.get_mount()
                 if not mount:
-                    volume.mount(0, mo, None, __mount_done_cb, user_data)
+                    volume.mount(0, mo, None, self.__mount_done_cb, user_data)
                     volume_mounted = True
                 volume_found = volume
         if volume_mounted:
@@ -44,27 +70,120 @@ def mount(uri):
         path = join(volume_path, path)
         logger.info('Mounted volume: "%s" -> %s' % (volume_name, volume_path))
         return volume_found, path
+
+    def __unmount_done_cb(self, obj, res, user_data):
+        try:
+            user_data['status'] = obj.unmount_with_operation_finish(res)
+        except self._GError as reason:
+            user_data['status'] = False
+            user_data['message'] = reason
+        user_data['loop'].quit()
+
+    def umount(self, volume):
+        mount = volume.get_mount()
+        loop = self._GObject.MainLoop()
+        user_data = dict(loop=loop, status=None, message=None)
+        mount.unmount_with_operation(0, None, None, self.__unmount_done_cb,
+                                     user_data)
+        loop.run()
+        if not user_data['status']:
+            logger.warning('Could not unmount volume: "%s" -> %s' % (
+                           volume.get_name(), user_data['message']))
+        else:
+            logger.info('Unmounted volume: "%s"' % volume.get_name())
+
+
+class UdisksVolumes(object):
+    '''Mounts volumes by their filesystem label with udisksctl. Works
+    without a desktop session, e.g. from cron.'''
+
+    name = 'udisks'
+
+    def __init__(self):
+        super(UdisksVolumes, self).__init__()
+        if not which('udisksctl'):
+            raise ImportError('udisksctl not found')
+
+    @staticmethod
+    def _get_device(volume_name):
+        # udev escapes all ASCII but these characters in label links.
+        label = re.sub(r'[^A-Za-z0-9#+\-.:=@_]',
+                       lambda match: (match.group(0) if ord(match.group(0)) > 127
+                                      else '\\x%02x' % ord(match.group(0))),
+                       volume_name)
+        return join('/dev/disk/by-label', label)
+
+    @staticmethod
+    def _get_mount_point(device):
+        device = realpath(device)
+        with open('/proc/mounts') as handle:
+            for line in handle:
+                fields = line.split()
+                if realpath(fields[0]) == device:
+                    # Spaces and the like are octal escapes.
+                    return re.sub(r'\\([0-7]{3})',
+                                  lambda match: chr(int(match.group(1), 8)),
+                                  fields[1])
+        return None
+
+    def mount(self, uri):
+        volume_name, path = _split_uri(uri)
+        device = self._get_device(volume_name)
+        if not exists(device):
+            raise Exception('Volume not found: %s' % volume_name)
+        volume_path = self._get_mount_point(device)
+        if not volume_path:
+            if subprocess.call(['udisksctl', 'mount', '--no-user-interaction',
+                                '-b', device]) != 0:
+                raise Exception('Could not mount volume: %s' % volume_name)
+            volume_path = self._get_mount_point(device)
+            if not volume_path:
+                raise Exception('Could not mount volume: %s' % volume_name)
+        logger.info('Mounted volume: "%s" -> %s' % (volume_name, volume_path))
+        return device, join(volume_path, path)
+
+    def umount(self, device):
+        if subprocess.call(['udisksctl', 'unmount', '--no-user-interaction',
+                            '-b', device]) != 0:
+            logger.warning('Could not unmount volume: %s' % device)
+        else:
+            logger.info('Unmounted volume: %s' % device)
+
+
+# Tried in this order unless one is asked for by name.
+BACKENDS = OrderedDict((backend.name, backend)
+                       for backend in (GioVolumes, UdisksVolumes))
+
+_backend = None
+
+
+def get_backend(name='auto'):
+    '''Returns the volume backend of the given name or the first one which
+    is available. The backend is kept for all further calls.'''
+    global _backend
+    if _backend is not None and name in ('auto', _backend.name):
+        return _backend
+    if name == 'auto':
+        names = list(BACKENDS)
+    elif name in BACKENDS:
+        names = [name]
     else:
-        raise Exception('Unknown protocol: %s' % protocol)
+        raise Exception('Unknown volume backend: %s' % name)
+    reasons = []
+    for name_ in names:
+        try:
+            _backend = BACKENDS[name_]()
+        except ImportError as reason:
+            reasons.append('%s: %s' % (name_, reason))
+            continue
+        logger.debug('Using volume backend: %s' % name_)
+        return _backend
+    raise Exception('No volume backend available (%s)' % '; '.join(reasons))
 
 
-def __unmount_done_cb(obj, res, user_data):
-    try:
-        user_data['status'] = obj.unmount_with_operation_finish(res)
-    except GError as reason:
-        user_data['status'] = False
-        user_data['message'] = reason
-    user_data['loop'].quit()
+def mount(uri):
+    return get_backend().mount(uri)
 
 
 def umount(volume):
-    mount = volume.get_mount()
-    loop = GObject.MainLoop()
-    user_data = dict(loop=loop, status=None, message=None)
-    mount.unmount_with_operation(0, None, None, __unmount_done_cb, user_data)
-    loop.run()
-    if not user_data['status']:
-        logger.warning('Could not unmount volume: "%s" -> %s' % (
-                       volume.get_name(), user_data['message']))
-    else:
-        logger.info('Unmounted volume: "%s"' % volume.get_name())
+    get_backend().umount(volume)
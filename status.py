@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# Prints the status of a running backup or restore.
+#
+# Usage: status.py <profile> [backup|restore] [json|openmetrics]
+
+from os.path import exists
+import socket
+import sys
+
+from lib.config import get_config
+from lib.status import query, get_socket_path, FORMATS, FORMAT_JSON
+from lib.util import expandvars
+
+
+def main():
+    try:
+        profile = sys.argv[1]
+        kind = sys.argv[2] if len(sys.argv) > 2 else 'backup'
+        format_ = sys.argv[3] if len(sys.argv) > 3 else FORMAT_JSON
+        if kind not in ('backup', 'restore') or format_ not in FORMATS:
+            raise IndexError()
+    except IndexError:
+        print('Usage: %s <profile> [backup|restore] [%s]' %
+              (sys.argv[0], '|'.join(FORMATS)))
+        sys.exit(1)
+
+    # Load and extract our config.
+    config = get_config('%s.ini' % profile)
+    STATUS_PATH = config.get('status', 'path')
+
+    # Support ~, ~user and other constructions.
+    STATUS_PATH = expandvars(STATUS_PATH)
+
+    if not STATUS_PATH:
+        print('Status endpoint is disabled.')
+        sys.exit(1)
+    socket_path = get_socket_path(STATUS_PATH, profile, kind)
+    if not exists(socket_path):
+        print('No %s running.' % kind)
+        sys.exit(1)
+    try:
+        sys.stdout.write(query(socket_path, format_))
+    except socket.error as reason:
+        print('Could not query status: %s' % reason)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.dtree import scan
+from lib.index import Index
+from lib.backup import Backup, fan_out
+
+
+FILE_SIZE = 1000
+NUM_FILES = 6
+
+
+class FanOutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.src, name))
+            for i in range(NUM_FILES // 2):
+                with open(os.path.join(self.src, name, str(i)), 'wb') as handle:
+                    handle.write(b'x' * FILE_SIZE)
+        self.targets = []
+        for name in ('d1', 'd2'):
+            path = os.path.join(self.tmp, name)
+            os.makedirs(path)
+            self.targets.append((Backup(path),
+                                 Index(os.path.join(path, 'index.sqlite3'))))
+
+    def tearDown(self):
+        for backup, index in self.targets:
+            del backup, index
+        self.targets = []
+        shutil.rmtree(self.tmp)
+
+    def test_progress_per_destination(self):
+        Index.update_many([index for backup, index in self.targets],
+                          scan(self.src, excludes=[]))
+        for backup, index in self.targets:
+            backup.create(index.get_added_bytes(), NUM_FILES)
+            backup.create_tree(index.get_added_or_modified_dirs())
+        # The files below b cannot be written to the second destination.
+        failing, _ = self.targets[1]
+        failing_dir = os.path.join(failing.get_path(), self.src.lstrip('/'), 'b')
+        for i in range(NUM_FILES // 2):
+            os.makedirs(os.path.join(failing_dir, str(i)))
+        fan_out([backup for backup, index in self.targets],
+                lambda: [index.get_added_or_modified_files(pending_first=False)
+                         for backup, index in self.targets],
+                Index.priority_key((), ()))
+        total = dict(files_total=NUM_FILES, bytes_total=NUM_FILES * FILE_SIZE)
+        self.assertEqual(self.targets[0][0].get_progress(),
+                         dict(total, files_done=NUM_FILES,
+                              bytes_done=NUM_FILES * FILE_SIZE))
+        self.assertEqual(self.targets[1][0].get_progress(),
+                         dict(total, files_done=NUM_FILES // 2,
+                              bytes_done=NUM_FILES // 2 * FILE_SIZE))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # Python 2
+
+from lib import fiemap
+
+
+def _fake_ioctl(flags, physical=4096):
+    # Answers FS_IOC_FIEMAP with a single extent carrying the given flags.
+    def ioctl(fd, request, buf, mutate):
+        header = list(fiemap.FIEMAP_HEADER.unpack_from(buf, 0))
+        header[3] = 1  # Mapped extents.
+        fiemap.FIEMAP_HEADER.pack_into(buf, 0, *header)
+        fiemap.FIEMAP_EXTENT.pack_into(buf, fiemap.FIEMAP_HEADER.size,
+                                       0, physical, 4096, 0, 0, flags, 0, 0, 0)
+        return 0
+    return ioctl
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_known_extent(self):
+        with mock.patch('fcntl.ioctl', _fake_ioctl(0)):
+            self.assertEqual(fiemap._query(self.path), 4096)
+
+    def test_unknown_extent(self):
+        with mock.patch('fcntl.ioctl', _fake_ioctl(fiemap.FIEMAP_EXTENT_UNKNOWN)):
+            self.assertIsNone(fiemap._query(self.path))
+
+    def test_reserved_fields_ignored(self):
+        # The flag must be read from fe_flags, not from a reserved field.
+        def ioctl(fd, request, buf, mutate):
+            _fake_ioctl(0)(fd, request, buf, mutate)
+            extent = list(fiemap.FIEMAP_EXTENT.unpack_from(buf, fiemap.FIEMAP_HEADER.size))
+            extent[6] = fiemap.FIEMAP_EXTENT_UNKNOWN
+            fiemap.FIEMAP_EXTENT.pack_into(buf, fiemap.FIEMAP_HEADER.size, *extent)
+            return 0
+        with mock.patch('fcntl.ioctl', ioctl):
+            self.assertEqual(fiemap._query(self.path), 4096)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import logging
+from os.path import join
+from time import time
+import sys
+
+from lib.config import get_config
+from lib.index import Index, OPEN_READ_ONLY
+from lib.verify import Verify
+from lib.human_size import human_size
+from lib.util import expandvars
+from lib import volume
+
+
+def main():
+    start = time()
+
+    # Determine profile to use.
+    try:
+        profile = sys.argv[1]
+    except IndexError:
+        profile = 'default'
+
+    # Load and extract our config.
+    config = get_config('%s.ini' % profile)
+    BACKUP_PATH = config.get('destination', 'path')
+    LOG_LEVEL = config.get('logging', 'level')
+    LOG_FORMAT = config.get('logging', 'format')
+    HASH_NAME = config.get('verify', 'algorithm')
+    TIME_BUDGET = float(config.get('verify', 'time_budget'))
+    PROCESSES = int(config.get('verify', 'processes'))
+
+    # Support ~, ~user and other constructions.
+    BACKUP_PATH = expandvars(BACKUP_PATH)
+
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    logger = logging.getLogger('process')
+
+    if not HASH_NAME:
+        logger.error('No hash algorithm configured. Nothing to verify.')
+        sys.exit(1)
+
+    BACKUP_PATH_REAL = BACKUP_PATH
+    mounted_volume = None
+    try:
+        if BACKUP_PATH.startswith('volume://'):
+            mounted_volume, BACKUP_PATH_REAL = volume.mount(BACKUP_PATH)
+        index = Index(join(BACKUP_PATH_REAL, 'index.sqlite3'),
+                      open_mode=OPEN_READ_ONLY)
+        verify = Verify(BACKUP_PATH_REAL, index, HASH_NAME, PROCESSES)
+    except Exception as reason:
+        logger.error(reason)
+        sys.exit(1)
+
+    intact = False
+    try:
+        logger.info('Verifying backups for up to %.0f secs.' % TIME_BUDGET)
+        intact = verify.run(TIME_BUDGET)
+        logger.info('Checked %d files (%s).' % (verify.num_files,
+                                                human_size(verify.num_bytes)))
+        if not intact:
+            logger.error('Found %d missing and %d corrupted files.' %
+                         (len(verify.missing), len(verify.corrupted)))
+    finally:
+        if mounted_volume:
+            volume.umount(mounted_volume)
+
+    secs = time() - start
+    logger.info('Verification finished after %.2f secs.' % secs)
+    if not intact:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()